@@ -0,0 +1,92 @@
+"""Benchmark of Ergo message decoding through ``ErgoChannel._message_to_python``.
+
+Compares the single-pass decoding with the previous conversion, which
+parsed every body twice and re-serialized it for Celery to parse again,
+for small and large kwargs payloads.
+
+Usage:
+    python -m benchmarks.decode [--messages 20000]
+"""
+import argparse
+import json
+from time import perf_counter
+
+from kombu.message import Message
+from kombu.serialization import dumps, loads
+
+from ergo_celery.request.message import SQSMessage
+from ergo_celery.request.transport import ErgoChannel
+
+QUEUE_URL = 'http://localhost:9324/queue/fifo_req_calipso'
+
+
+class LegacyErgoChannel(ErgoChannel):
+    """Channel decoding Ergo messages as it did before the single-pass fast path."""
+
+    def _to_proto1(self, orig_payload, sqs_msg):
+        payload = dict()
+        payload.update(orig_payload)
+        payload.setdefault('content-type', self.DEFAULT_CONTENT_TYPE)
+        payload.setdefault('content-encoding', self.DEFAULT_CONTENT_ENCODING)
+        payload['headers'] = {}
+        body = payload['body'] or '{}'
+        safe_kwargs = body
+        body = loads(body, payload['content-type'], payload['content-encoding'])
+        body['task'] = sqs_msg['Attributes']['MessageGroupId']
+        body['id'] = sqs_msg['MessageId']
+        body['kwargs'] = loads(safe_kwargs, payload['content-type'], payload['content-encoding'])
+        _, _, payload['body'] = dumps(body, 'json')
+        return payload
+
+    def _message_to_python(self, message, queue_name, queue):
+        payload = super(ErgoChannel, self)._message_to_python(message, queue_name, queue)
+        sqs_msg = payload['properties']['delivery_info']['sqs_message']
+        if 'headers' not in payload and sqs_msg['Attributes'].get('MessageGroupId', None):
+            payload = self._to_proto1(payload, sqs_msg)
+        return payload
+
+
+def make_message(idx, kwargs):
+    return {
+        'MessageId': f'msg-{idx}',
+        'ReceiptHandle': f'receipt-{idx}',
+        'Body': json.dumps(kwargs),
+        'Attributes': {'MessageGroupId': 'calipso.function', 'ApproximateReceiveCount': '1'},
+    }
+
+
+def consume(channel, payload):
+    # What the consumer does with a payload: wrap it in a message and decode the body
+    message = SQSMessage(payload, channel=channel)
+    return Message.decode(message)
+
+
+def run(channel, kwargs, count):
+    messages = [make_message(idx, kwargs) for idx in range(count)]
+    start = perf_counter()
+    for message in messages:
+        consume(channel, channel._message_to_python(message, 'fifo_req_calipso', QUEUE_URL))
+    return count / (perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=20000)
+    args = parser.parse_args()
+
+    payloads = {
+        'small': {'noOfDays': 3},
+        'large': {f'field{idx}': {'values': list(range(20)), 'name': 'x' * 32} for idx in range(200)},
+    }
+    for size, kwargs in payloads.items():
+        results = {}
+        for label, cls in (('legacy', LegacyErgoChannel), ('single-pass', ErgoChannel)):
+            channel = object.__new__(cls)
+            count = args.messages if size == 'small' else max(args.messages // 50, 1)
+            results[label] = run(channel, kwargs, count)
+            print(f'{size:>5} {label:>12}: {results[label]:10.1f} messages/sec')
+        print(f'{size:>5} {"speedup":>12}: {results["single-pass"] / results["legacy"]:10.2f}x')
+
+
+if __name__ == '__main__':
+    main()
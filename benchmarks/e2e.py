@@ -0,0 +1,228 @@
+"""End-to-end benchmark of the worker against an in-process SQS stand-in.
+
+Runs a real worker (SQSTransport, SQSRequest, SQSBackend, SQSPingTimerStep
+and ResultTimerStep) with the thread pool. SQS is replaced by
+:mod:`benchmarks.fake_sqs`. The result buffer is kept in memory or in
+Redis, served by fakeredis, or in SQLite. Ergo messages are queued up front. Every
+result is then awaited on the result queue.
+
+The report gives tasks/sec, result latency percentiles (from sending the
+message to publishing its result) and SQS calls per task. Pass
+``--baseline`` to compare against a previous ``--save`` and exit with an
+error if throughput or p95 latency regressed beyond ``--threshold``.
+
+Usage:
+    python -m benchmarks.e2e [--tasks 2000] [--groups 4] [--buffer redis|sqlite]
+        [--latency-ms 2] [--failure-rate 0.01] [--task-ms 0]
+        [--save baseline.json] [--baseline baseline.json --threshold 0.15]
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import sys
+import tempfile
+import threading
+from time import monotonic, sleep, time
+
+from celery import Celery, Task
+from celery.contrib.testing.worker import start_worker
+from kombu.transport import TRANSPORT_ALIASES
+from kombu.utils.json import loads
+
+from benchmarks import fake_sqs
+from ergo_celery.request.ping_timer import SQSPingTimerStep
+from ergo_celery.result.drain_timer import ResultTimerStep
+from ergo_celery.result.redis.buffer import (CLAIM_SCRIPT, LEASE_SCRIPT,
+                                             RECLAIM_SCRIPT, RELEASE_SCRIPT,
+                                             REQUEUE_SCRIPT)
+from ergo_celery.warmup import WarmupStep
+
+REQUEST_QUEUE = 'fifo_req_bench'
+RESULT_QUEUE = 'fifo_res_bench'
+
+
+class BenchTask(Task):
+    Request = 'ergo_celery.request.request:SQSRequest'
+
+
+def start_fake_redis():
+    import redis
+    from fakeredis import TcpFakeServer
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    server = TcpFakeServer(('127.0.0.1', port), server_type='redis')
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # The fake server drops the connection on any error reply, NOSCRIPT included
+    client = redis.Redis(host='127.0.0.1', port=port)
+    for script in (CLAIM_SCRIPT, REQUEUE_SCRIPT, RECLAIM_SCRIPT, LEASE_SCRIPT, RELEASE_SCRIPT):
+        client.script_load(script)
+    client.close()
+    return server, f'redis://127.0.0.1:{port}/0'
+
+
+def make_app(args, redis_url):
+    TRANSPORT_ALIASES['fakesqs'] = 'benchmarks.fake_sqs:FakeSQSTransport'
+    app = Celery('bench', task_cls=BenchTask, set_as_current=True)
+    app.conf.update(
+        broker_read_url='fakesqs://',
+        broker_write_url=redis_url or 'memory://',
+        broker_transport_options={
+            'predefined_queues': {
+                name: {'url': f'{fake_sqs.BASE_URL}/{name}'} for name in (REQUEST_QUEUE, RESULT_QUEUE)
+            },
+            'visibility_timeout': args.visibility_timeout,
+            'wait_time_seconds': 1,
+        },
+        result_backend=f'benchmarks.fake_sqs:FakeSQSBackend://{fake_sqs.BASE_URL}/{RESULT_QUEUE}',
+        task_default_queue=REQUEST_QUEUE,
+        worker_prefetch_multiplier=args.prefetch_multiplier,
+        worker_hijack_root_logger=False,
+        broker_connection_retry_on_startup=True,
+        ergo_result_buffer_timeout_secs=1,
+        ergo_task_ping_interval_secs=1,
+    )
+    if args.buffer == 'sqlite':
+        app.conf.ergo_result_buffer_cls = 'ergo_celery.result.sqlite.buffer:SQLiteResultBuffer'
+        app.conf.ergo_result_buffer_sqlite_path = os.path.join(args.workdir, 'results.sqlite3')
+    elif args.buffer == 'redis':
+        app.conf.ergo_result_buffer_cls = 'ergo_celery.result.redis.buffer:RedisResultBuffer'
+    app.steps['worker'].add(ResultTimerStep)
+    app.steps['worker'].add(SQSPingTimerStep)
+    app.steps['worker'].add(WarmupStep)
+
+    task_ms = args.task_ms
+
+    def work(seq=None):
+        if task_ms:
+            sleep(task_ms / 1000)
+        return {'seq': seq}
+
+    for group in range(args.groups):
+        app.task(name=f'bench.work{group}')(work)
+    return app
+
+
+def seed(fake, args):
+    url = f'{fake_sqs.BASE_URL}/{REQUEST_QUEUE}'
+    sent_at = {}
+    for seq in range(args.tasks):
+        message_id = fake.send(url, json.dumps({'seq': seq}), group_id=f'bench.work{seq % args.groups}',
+                               deduplication_id=str(seq))
+        sent_at[message_id] = fake.sent_log[message_id][1]
+    return sent_at
+
+
+def collect_results(fake, sent_at, timeout):
+    """Wait for a result per message, returning the latency of each result."""
+    queue = fake.queues[RESULT_QUEUE]
+    latencies = {}
+    deadline = monotonic() + timeout
+    while len(latencies) < len(sent_at) and monotonic() < deadline:
+        for message in list(queue.messages):
+            job_id = loads(message['Body'])['jobId']
+            if job_id in sent_at and job_id not in latencies:
+                latencies[job_id] = fake.sent_log[message['MessageId']][1] - sent_at[job_id]
+        sleep(0.01)
+    return latencies
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+
+def run(args):
+    fake = fake_sqs.FakeSQS(
+        (REQUEST_QUEUE, RESULT_QUEUE), latency=args.latency_ms / 1000,
+        failure_rate=args.failure_rate, seed=args.seed)
+    fake_sqs.install(fake)
+    redis_url = None
+    if args.buffer == 'redis':
+        _, redis_url = start_fake_redis()
+    app = make_app(args, redis_url)
+
+    with start_worker(app, pool='threads', concurrency=args.concurrency, perform_ping_check=False,
+                      queues=[REQUEST_QUEUE], loglevel='WARNING', shutdown_timeout=30):
+        fake.calls.clear()
+        start = time()
+        sent_at = seed(fake, args)
+        latencies = collect_results(fake, sent_at, args.timeout)
+        calls = dict(fake.calls)
+    if len(latencies) < args.tasks:
+        print(f'Only {len(latencies)}/{args.tasks} results were published within {args.timeout}s', file=sys.stderr)
+    done = max((sent_at[job_id] + latency for job_id, latency in latencies.items()), default=start) - start
+    values = [latency * 1000 for latency in latencies.values()]
+    return {
+        'tasks': args.tasks,
+        'completed': len(latencies),
+        'tasks_per_sec': len(latencies) / done if done > 0 else 0,
+        'latency_ms': {f'p{pct}': percentile(values, pct) for pct in (50, 95, 99)},
+        'sqs_calls_per_task': sum(calls.values()) / max(len(latencies), 1),
+        'sqs_calls': calls,
+    }
+
+
+def regressions(report, baseline, threshold):
+    found = []
+    if report['completed'] < report['tasks']:
+        found.append(f'{report["tasks"] - report["completed"]} results are missing')
+    if report['tasks_per_sec'] < baseline['tasks_per_sec'] * (1 - threshold):
+        found.append(f'throughput dropped from {baseline["tasks_per_sec"]:.1f} to {report["tasks_per_sec"]:.1f} tasks/sec')
+    if report['latency_ms']['p95'] > baseline['latency_ms']['p95'] * (1 + threshold):
+        found.append(f'p95 latency rose from {baseline["latency_ms"]["p95"]:.1f} to {report["latency_ms"]["p95"]:.1f} ms')
+    if report['sqs_calls_per_task'] > baseline['sqs_calls_per_task'] * (1 + threshold):
+        found.append(f'SQS calls per task rose from {baseline["sqs_calls_per_task"]:.2f} to {report["sqs_calls_per_task"]:.2f}')
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tasks', type=int, default=2000)
+    parser.add_argument('--groups', type=int, default=4, help='Message groups, each one a task name')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--prefetch-multiplier', type=int, default=4)
+    parser.add_argument('--buffer', choices=('memory', 'redis', 'sqlite'), default='redis')
+    parser.add_argument('--task-ms', type=float, default=0, help='Time spent by each task')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Latency added to every SQS call')
+    parser.add_argument('--failure-rate', type=float, default=0, help='Ratio of SQS calls and batch entries failing')
+    parser.add_argument('--visibility-timeout', type=int, default=30)
+    parser.add_argument('--timeout', type=float, default=120, help='Seconds to wait for every result')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--save', help='Write the report to this file, to be used as a baseline')
+    parser.add_argument('--baseline', help='Report to compare against')
+    parser.add_argument('--threshold', type=float, default=0.15, help='Tolerated regression ratio')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as args.workdir:
+        report = run(args)
+    print(f'tasks/sec:          {report["tasks_per_sec"]:10.1f} ({report["completed"]}/{report["tasks"]} completed)')
+    for name, value in report['latency_ms'].items():
+        print(f'latency {name:>3}:        {value:10.1f} ms')
+    print(f'SQS calls per task: {report["sqs_calls_per_task"]:10.2f}')
+    for operation, count in sorted(report['sqs_calls'].items()):
+        print(f'  {operation:<30} {count}')
+
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            found = regressions(report, json.load(fp), args.threshold)
+        for regression in found:
+            print(f'REGRESSION: {regression}', file=sys.stderr)
+        if found:
+            sys.exit(1)
+    elif report['completed'] < report['tasks']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
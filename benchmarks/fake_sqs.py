@@ -0,0 +1,401 @@
+"""In-process stand-in for SQS, used to benchmark the worker offline.
+
+:class:`FakeSQS` keeps queues in memory with the semantics the worker
+relies on: FIFO message groups, deduplication, visibility timeouts,
+receipt handles expiring on redelivery, long polling and the limits of
+batch requests. Latency and
+failures can be injected in every call, and calls are counted per API.
+
+:class:`FakeSQSTransport` is :class:`~ergo_celery.request.transport.SQSTransport`
+talking to the stand-in set with :func:`install`, and
+:class:`FakeSQSBackend` the result backend publishing through it.
+"""
+import os
+import random
+import threading
+import uuid
+from collections import Counter
+from time import monotonic, sleep, time
+
+from botocore.exceptions import ClientError
+
+from ergo_celery.request.transport import ErgoChannel, SQSTransport
+from ergo_celery.result.sqs_backend import SQSBackend
+
+BASE_URL = 'http://fake-sqs/queue'
+
+# Entries of a batch request, and bytes of the messages sent by a request
+MAX_BATCH_ENTRIES = 10
+MAX_PAYLOAD_BYTES = 256 * 1024
+
+# Stand-in used by every channel of this process
+_fake = None
+
+
+def install(fake):
+    global _fake
+    _fake = fake
+
+
+def client_error(code, message, operation):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+class FakeQueue(object):
+    def __init__(self, name) -> None:
+        self.name = name
+        self.url = f'{BASE_URL}/{name}'
+        self.fifo = name.startswith('fifo') or name.endswith('.fifo')
+        self.messages = []
+        self.deduplication_ids = {}
+
+
+class FakeSQS(object):
+    """SQS queues kept in memory."""
+
+    # SQS deduplicates FIFO messages sent within 5 minutes
+    DEDUPLICATION_WINDOW = 300
+
+    def __init__(self, queues, latency=0.0, failure_rate=0.0, max_wait=1.0, seed=None) -> None:
+        self.queues = {name: FakeQueue(name) for name in queues}
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.max_wait = max_wait
+        self.calls = Counter()
+        self.sent_log = {}
+        self._random = random.Random(seed)
+        self._cond = threading.Condition()
+        self._listeners = []
+
+    def subscribe(self, listener):
+        """Call ``listener`` whenever messages may have become available."""
+        self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        self._listeners.remove(listener)
+
+    def _notify(self):
+        for listener in list(self._listeners):
+            listener()
+
+    def queue(self, url):
+        return self.queues[url.rsplit('/', 1)[-1]]
+
+    def call(self, operation, delay=True):
+        """Account for an API call, applying the injected latency and failures."""
+        with self._cond:
+            self.calls[operation] += 1
+        if delay and self.latency:
+            sleep(self.latency)
+        if self.failure_rate and self._random.random() < self.failure_rate:
+            raise client_error('InternalError', 'Injected failure', operation)
+
+    def injected_failure(self):
+        return bool(self.failure_rate) and self._random.random() < self.failure_rate
+
+    def send(self, url, body, group_id=None, deduplication_id=None, sent_at=None):
+        queue = self.queue(url)
+        now = time() if sent_at is None else sent_at
+        with self._cond:
+            if queue.fifo:
+                if group_id is None:
+                    raise client_error('MissingParameter', 'MessageGroupId is required', 'SendMessage')
+                deduplication_id = deduplication_id or str(uuid.uuid4())
+                sent = queue.deduplication_ids.get(deduplication_id)
+                if sent is not None and now - sent[1] < self.DEDUPLICATION_WINDOW:
+                    return sent[0]
+            message = {
+                'MessageId': str(uuid.uuid4()),
+                'Body': body,
+                'GroupId': group_id,
+                'SentTimestamp': int(now * 1000),
+                'ReceiveCount': 0,
+                'VisibleAt': 0,
+                'ReceiptHandle': None,
+            }
+            if queue.fifo:
+                queue.deduplication_ids[deduplication_id] = (message['MessageId'], now)
+            queue.messages.append(message)
+            self.sent_log[message['MessageId']] = (queue.name, now)
+            self._cond.notify_all()
+        self._notify()
+        return message['MessageId']
+
+    def _take(self, queue, count, visibility_timeout):
+        now = monotonic()
+        taken, blocked = [], set()
+        for message in queue.messages:
+            if len(taken) >= count:
+                break
+            group = message['GroupId'] if queue.fifo else None
+            if group is not None and group in blocked:
+                continue
+            if message['VisibleAt'] > now:
+                # Later messages of a group wait until the in flight ones are done
+                if group is not None:
+                    blocked.add(group)
+                continue
+            message['ReceiveCount'] += 1
+            message['VisibleAt'] = now + visibility_timeout
+            message['ReceiptHandle'] = str(uuid.uuid4())
+            taken.append(message)
+        return [self._to_sqs_message(message) for message in taken]
+
+    @staticmethod
+    def _to_sqs_message(message):
+        attributes = {
+            'ApproximateReceiveCount': str(message['ReceiveCount']),
+            'SentTimestamp': str(message['SentTimestamp']),
+        }
+        if message['GroupId'] is not None:
+            attributes['MessageGroupId'] = message['GroupId']
+        return {
+            'MessageId': message['MessageId'],
+            'ReceiptHandle': message['ReceiptHandle'],
+            'Body': message['Body'],
+            'Attributes': attributes,
+        }
+
+    def receive(self, url, count=1, visibility_timeout=30, wait_time=0):
+        queue = self.queue(url)
+        deadline = monotonic() + min(wait_time or 0, self.max_wait)
+        with self._cond:
+            while True:
+                messages = self._take(queue, count, visibility_timeout)
+                remaining = deadline - monotonic()
+                if messages or remaining <= 0:
+                    return messages
+                self._cond.wait(remaining)
+
+    def _find(self, queue, receipt_handle):
+        for message in queue.messages:
+            if message['ReceiptHandle'] == receipt_handle:
+                return message
+        return None
+
+    def delete(self, url, receipt_handle):
+        queue = self.queue(url)
+        with self._cond:
+            message = self._find(queue, receipt_handle)
+            if message is None:
+                raise client_error('ReceiptHandleIsInvalid', 'The receipt handle is invalid', 'DeleteMessage')
+            queue.messages.remove(message)
+            self._cond.notify_all()
+        self._notify()
+
+    def change_visibility(self, url, receipt_handle, visibility_timeout):
+        queue = self.queue(url)
+        with self._cond:
+            message = self._find(queue, receipt_handle)
+            if message is None or message['VisibleAt'] <= monotonic():
+                raise client_error(
+                    'InvalidParameterValue',
+                    f'Value {receipt_handle} for parameter ReceiptHandle is invalid. '
+                    'Reason: The receipt handle has expired.',
+                    'ChangeMessageVisibility')
+            message['VisibleAt'] = monotonic() + visibility_timeout
+            self._cond.notify_all()
+        self._notify()
+
+    def size(self, url):
+        with self._cond:
+            return len(self.queue(url).messages)
+
+
+class FakeSQSClient(object):
+    """boto3 SQS client API backed by a :class:`FakeSQS`."""
+
+    def __init__(self, fake) -> None:
+        self.fake = fake
+
+    @staticmethod
+    def _check_payload(operation, bodies):
+        size = sum(len(body.encode()) for body in bodies)
+        if size > MAX_PAYLOAD_BYTES:
+            if operation == 'SendMessage':
+                raise client_error(
+                    'InvalidParameterValue',
+                    f'One or more parameters are invalid. Reason: Message must be shorter than {MAX_PAYLOAD_BYTES} bytes.',
+                    operation)
+            raise client_error(
+                'AWS.SimpleQueueService.BatchRequestTooLong',
+                f'Batch requests cannot be longer than {MAX_PAYLOAD_BYTES} bytes. '
+                f'You have sent {size} bytes.',
+                operation)
+
+    def _batch(self, operation, entries, handle, body=None):
+        self.fake.call(operation)
+        # The whole request is refused, as SQS does
+        if not entries:
+            raise client_error('AWS.SimpleQueueService.EmptyBatchRequest', 'There should be at least one entry in the request.', operation)
+        if len(entries) > MAX_BATCH_ENTRIES:
+            raise client_error(
+                'AWS.SimpleQueueService.TooManyEntriesInBatchRequest',
+                f'Maximum number of entries per request are {MAX_BATCH_ENTRIES}. You have sent {len(entries)}.',
+                operation)
+        if len({entry['Id'] for entry in entries}) != len(entries):
+            raise client_error('AWS.SimpleQueueService.BatchEntryIdsNotDistinct', 'Id of entries must be distinct.', operation)
+        if body is not None:
+            self._check_payload(operation, [body(entry) for entry in entries])
+        successful, failed = [], []
+        for entry in entries:
+            if self.fake.injected_failure():
+                failed.append({'Id': entry['Id'], 'SenderFault': False, 'Code': 'InternalError', 'Message': 'Injected failure'})
+                continue
+            try:
+                result = handle(entry)
+            except ClientError as e:
+                error = e.response['Error']
+                failed.append({'Id': entry['Id'], 'SenderFault': True, 'Code': error['Code'], 'Message': error['Message']})
+            else:
+                successful.append(dict(result or {}, Id=entry['Id']))
+        return {'Successful': successful, 'Failed': failed}
+
+    def get_queue_url(self, QueueName, **kwargs):
+        self.fake.call('GetQueueUrl')
+        return {'QueueUrl': self.fake.queues[QueueName].url}
+
+    def get_queue_attributes(self, QueueUrl, **kwargs):
+        self.fake.call('GetQueueAttributes')
+        return {'Attributes': {'ApproximateNumberOfMessages': str(self.fake.size(QueueUrl))}}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, VisibilityTimeout=30, **kwargs):
+        self.fake.call('ReceiveMessage')
+        messages = self.fake.receive(QueueUrl, MaxNumberOfMessages, VisibilityTimeout, WaitTimeSeconds)
+        return {'Messages': messages} if messages else {}
+
+    def delete_message(self, QueueUrl, ReceiptHandle, **kwargs):
+        self.fake.call('DeleteMessage')
+        self.fake.delete(QueueUrl, ReceiptHandle)
+        return {}
+
+    def delete_message_batch(self, QueueUrl, Entries, **kwargs):
+        return self._batch(
+            'DeleteMessageBatch', Entries,
+            lambda entry: self.fake.delete(QueueUrl, entry['ReceiptHandle']))
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout, **kwargs):
+        self.fake.call('ChangeMessageVisibility')
+        self.fake.change_visibility(QueueUrl, ReceiptHandle, VisibilityTimeout)
+        return {}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries, **kwargs):
+        return self._batch(
+            'ChangeMessageVisibilityBatch', Entries,
+            lambda entry: self.fake.change_visibility(QueueUrl, entry['ReceiptHandle'], entry['VisibilityTimeout']))
+
+    def send_message(self, QueueUrl, MessageBody, MessageGroupId=None, MessageDeduplicationId=None, **kwargs):
+        self.fake.call('SendMessage')
+        self._check_payload('SendMessage', [MessageBody])
+        return {'MessageId': self.fake.send(QueueUrl, MessageBody, MessageGroupId, MessageDeduplicationId)}
+
+    def send_message_batch(self, QueueUrl, Entries, **kwargs):
+        return self._batch(
+            'SendMessageBatch', Entries,
+            lambda entry: {'MessageId': self.fake.send(
+                QueueUrl, entry['MessageBody'], entry.get('MessageGroupId'), entry.get('MessageDeduplicationId'))},
+            body=lambda entry: entry['MessageBody'])
+
+
+class FakeAsyncSQSConnection(object):
+    """Asynchronous SQS connection of kombu, answering through the event loop.
+
+    Receives wait in the connection until messages are available or their
+    wait time is over. They are answered when a pipe registered on the hub
+    becomes readable, as the sockets of the real connection would: without
+    any file descriptor the event loop sleeps 100ms on every iteration.
+    """
+
+    def __init__(self, fake, hub) -> None:
+        self.fake = fake
+        self.hub = hub
+        self._pending = []
+        self._reader, self._writer = os.pipe()
+        os.set_blocking(self._reader, False)
+        os.set_blocking(self._writer, False)
+        hub.add_reader(self._reader, self._on_readable)
+        fake.subscribe(self.wakeup)
+
+    def wakeup(self):
+        try:
+            os.write(self._writer, b'.')
+        except BlockingIOError:
+            # The pipe is full, the hub is already woken up
+            pass
+
+    def receive_message(self, queue, queue_url, number_messages=1, visibility_timeout=None,
+                        attributes=None, wait_time_seconds=None, callback=None):
+        now = monotonic()
+        ready_at = now + self.fake.latency
+        deadline = ready_at + min(wait_time_seconds or 0, self.fake.max_wait)
+        try:
+            self.fake.call('ReceiveMessage', delay=False)
+        except ClientError:
+            # Failed receives come back empty, the channel polls again
+            deadline = ready_at
+            number_messages = 0
+        self._pending.append((ready_at, deadline, queue_url, number_messages, visibility_timeout or 30, callback))
+        for at in {ready_at, deadline}:
+            self.hub.call_later(max(at - now, 0), self.wakeup)
+
+    def _on_readable(self):
+        try:
+            while os.read(self._reader, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        now = monotonic()
+        # Callbacks receive again, adding to the pending receives
+        pending, self._pending = self._pending, []
+        waiting = []
+        for entry in pending:
+            ready_at, deadline, queue_url, number_messages, visibility_timeout, callback = entry
+            if ready_at > now:
+                waiting.append(entry)
+                continue
+            messages = self.fake.receive(queue_url, number_messages, visibility_timeout) if number_messages else []
+            if messages or now >= deadline:
+                callback({'Messages': messages} if messages else {})
+            else:
+                waiting.append(entry)
+        self._pending[:0] = waiting
+
+    def delete_message(self, queue, receipt_handle, callback=None):
+        self.fake.call('DeleteMessage')
+        self.fake.delete(queue, receipt_handle)
+        if callback is not None:
+            callback()
+
+    def close(self):
+        self.fake.unsubscribe(self.wakeup)
+        self.hub.remove_reader(self._reader)
+        os.close(self._reader)
+        os.close(self._writer)
+
+
+class FakeSQSChannel(ErgoChannel):
+    _fake_asynsqs = None
+
+    def sqs(self, queue=None):
+        return FakeSQSClient(_fake)
+
+    def asynsqs(self, queue=None):
+        if self._fake_asynsqs is None:
+            self._fake_asynsqs = FakeAsyncSQSConnection(_fake, self.hub)
+        return self._fake_asynsqs
+
+    def close(self):
+        super().close()
+        if self._fake_asynsqs is not None:
+            self._fake_asynsqs.close()
+            self._fake_asynsqs = None
+
+
+class FakeSQSTransport(SQSTransport):
+    Channel = FakeSQSChannel
+
+
+class FakeSQSBackend(SQSBackend):
+    def connection_for_write(self):
+        return self.ensure_connected(
+            self.app.connection_for_write(self.as_uri(), transport=FakeSQSTransport))
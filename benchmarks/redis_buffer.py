@@ -0,0 +1,85 @@
+"""Micro-benchmark of the Redis result buffer hot path.
+
+Compares ``RedisResultBuffer.put`` and ``len()`` through the process-wide
+pooled client against the previous behaviour, which opened a new broker
+connection for every operation. Redis is served by fakeredis unless
+``--redis-url`` is given.
+
+Usage:
+    python -m benchmarks.redis_buffer [--redis-url redis://localhost:6379/15] [--ops 5000]
+"""
+import argparse
+from time import perf_counter
+
+from celery import Celery
+from kombu.utils.json import dumps
+
+from benchmarks.e2e import start_fake_redis
+from ergo_celery.result.redis.buffer import RedisResultBuffer
+
+BUFFER_NAME = 'ergo.bench.results'
+
+
+class PerOperationRedisResultBuffer(RedisResultBuffer):
+    """Buffer connecting to Redis on every operation, as it did before pooling."""
+
+    def _per_operation_client(self):
+        conn = self.celery_app.connection_for_write()
+        channel = conn.channel()
+        return conn, channel
+
+    def __len__(self):
+        conn, channel = self._per_operation_client()
+        with channel.conn_or_acquire() as client:
+            size = client.llen(self.name)
+        channel.close()
+        conn.close()
+        return size
+
+    def put(self, msg):
+        conn, channel = self._per_operation_client()
+        with channel.conn_or_acquire() as client:
+            client.rpush(self.name, dumps(msg))
+        channel.close()
+        conn.close()
+        return len(self)
+
+
+def run(buffer, ops):
+    msg = {'taskId': 'bench.task', 'jobId': '0', 'data': {'value': 'x' * 64}, 'metadata': {'status': 200, 'error': None}}
+    start = perf_counter()
+    for _ in range(ops):
+        buffer.put(msg)
+    return ops / (perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--redis-url')
+    parser.add_argument('--ops', type=int, default=5000)
+    args = parser.parse_args()
+
+    server, redis_url = None, args.redis_url
+    if redis_url is None:
+        server, redis_url = start_fake_redis()
+    try:
+        run_all(Celery('bench', broker_write_url=redis_url), args.ops)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+
+def run_all(app, ops):
+    results = {}
+    for label, cls in (('per-operation', PerOperationRedisResultBuffer), ('pooled', RedisResultBuffer)):
+        buffer = cls(BUFFER_NAME, app, max_size=10)
+        buffer.put({'jobId': 'warmup'})
+        results[label] = run(buffer, ops)
+        RedisResultBuffer(BUFFER_NAME, app, max_size=10)._client().delete(BUFFER_NAME)
+        print(f'{label:>14}: {results[label]:10.1f} put+len ops/sec')
+    print(f'{"speedup":>14}: {results["pooled"] / results["per-operation"]:10.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+import logging
+import socket
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from celery import bootsteps, signals
+from celery.utils.imports import symbol_by_name
+from celery.utils.log import current_process_index
+
+from ergo_celery.result.buffer import buffer_seen_by_worker
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets, fit for durations in seconds and batch sizes
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 300)
+
+
+class Metrics(object):
+    """Counters, gauges and histograms of the worker, handed to an exporter.
+
+    Nothing is recorded until an exporter is configured, and instrumented
+    code checks :attr:`enabled` first so disabled metrics cost nothing.
+    """
+
+    def __init__(self, exporter=None) -> None:
+        self.exporter = exporter
+
+    @property
+    def enabled(self):
+        return self.exporter is not None
+
+    def configure(self, exporter):
+        self.exporter = exporter
+
+    def incr(self, name, value=1, **labels):
+        if self.exporter is not None:
+            self.exporter.incr(name, value, labels)
+
+    def gauge(self, name, value, **labels):
+        if self.exporter is not None:
+            self.exporter.gauge(name, value, labels)
+
+    def observe(self, name, value, **labels):
+        if self.exporter is not None:
+            self.exporter.observe(name, value, labels)
+
+
+# Metrics of this process, shared by the transport, the requests and the backend
+metrics = Metrics()
+
+
+class PrometheusExporter(object):
+    """Aggregates metrics in memory and serves them in the Prometheus text format.
+
+    The metrics of the main process are served on ``ergo_metrics_prometheus_port``
+    once started. Pool processes record results drained and published on their
+    own, so the process of index N serves its metrics on that port plus N, which
+    must be scraped as well.
+    """
+
+    def __init__(self, celery_app, buckets=DEFAULT_BUCKETS) -> None:
+        self.base_port = self.port = celery_app.conf.get('ergo_metrics_prometheus_port', 9808)
+        self.buckets = tuple(buckets)
+        self._reset()
+        self._server = None
+        signals.worker_process_init.connect(self._on_process_init, weak=False)
+
+    def _reset(self):
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def _on_process_init(self, **kwargs):
+        # The serving thread isn't forked, and metrics of the main process aren't this process'
+        if self._server is not None:
+            self._server.server_close()
+            self._server = None
+        self._reset()
+        self.port = self.base_port + current_process_index()
+        self.start()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def incr(self, name, value, labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name, value, labels):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # Bucket counts, then the sum and the count of observations
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            histogram[bisect_left(self.buckets, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @staticmethod
+    def _labels(labels, **extra):
+        labels = list(labels) + list(extra.items())
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for kind, values in (('counter', self._counters), ('gauge', self._gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f'# TYPE {name} {kind}')
+                    lines.extend(
+                        f'{name}{self._labels(labels)} {value}'
+                        for (key, labels), value in values.items() if key == name
+                    )
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f'# TYPE {name} histogram')
+                for (key, labels), histogram in self._histograms.items():
+                    if key != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + ('+Inf',), histogram):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{self._labels(labels, le=bound)} {cumulative}')
+                    lines.append(f'{name}_sum{self._labels(labels)} {histogram[-2]}')
+                    lines.append(f'{name}_count{self._labels(labels)} {histogram[-1]}')
+        return '\n'.join(lines) + '\n'
+
+    def start(self):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = exporter.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('', self.port), Handler)
+        threading.Thread(target=self._server.serve_forever, name='ergo-metrics', daemon=True).start()
+        logger.info(f'Serving metrics on port {self.port}')
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+class StatsdExporter(object):
+    """Sends every metric right away to a StatsD server over UDP.
+
+    Labels are appended to the metric name, so processes of every worker
+    are aggregated by the StatsD server.
+    """
+
+    def __init__(self, celery_app) -> None:
+        conf = celery_app.conf
+        self.address = (conf.get('ergo_metrics_statsd_host', 'localhost'), conf.get('ergo_metrics_statsd_port', 8125))
+        self.prefix = conf.get('ergo_metrics_statsd_prefix')
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def _name(self, name, labels):
+        parts = [self.prefix, name] if self.prefix else [name]
+        return '.'.join(parts + [str(value).replace('.', '_') for value in labels.values()])
+
+    def _send(self, line):
+        try:
+            self._socket.sendto(line.encode(), self.address)
+        except OSError:
+            # Metrics are best effort
+            pass
+
+    def incr(self, name, value, labels):
+        self._send(f'{self._name(name, labels)}:{value}|c')
+
+    def gauge(self, name, value, labels):
+        self._send(f'{self._name(name, labels)}:{value}|g')
+
+    def observe(self, name, value, labels):
+        self._send(f'{self._name(name, labels)}:{value * 1000 if name.endswith("_seconds") else value}|ms')
+
+    def start(self):
+        pass
+
+    def stop(self):
+        self._socket.close()
+
+
+def load_exporter(celery_app, path):
+    return symbol_by_name(path)(celery_app)
+
+
+class MetricsStep(bootsteps.StartStopStep):
+    """Exports the worker metrics through ``ergo_metrics_exporter``.
+
+    Also samples the result buffer depth every ``ergo_metrics_interval_secs``,
+    unless the results are buffered in the memory of prefork pool processes
+    which the main process can't see.
+    """
+    requires = {'celery.worker.components:Timer'}
+
+    def __init__(self, worker, *args, **kwargs):
+        self.tref = None
+        self.interval = worker.app.conf.get('ergo_metrics_interval_secs', 10)
+        path = worker.app.conf.get('ergo_metrics_exporter')
+        self.exporter = load_exporter(worker.app, path) if path else None
+        if self.exporter is not None:
+            # Configured before the pool starts, so child processes inherit it
+            metrics.configure(self.exporter)
+
+    def start(self, worker):
+        if self.exporter is None:
+            return
+        self.exporter.start()
+        if not buffer_seen_by_worker(worker):
+            logger.info('Results are buffered in the memory of the pool processes, their depth is not sampled')
+            return
+        self.tref = worker.timer.call_repeatedly(self.interval, self.sample, (worker,))
+
+    def stop(self, worker):
+        if self.tref:
+            self.tref.cancel()
+            self.tref = None
+        if self.exporter is not None:
+            self.exporter.stop()
+
+    def sample(self, worker):
+        buffer_depth = getattr(worker.app.backend, 'buffer_depth', None)
+        if buffer_depth is None:
+            return
+        try:
+            metrics.gauge('ergo_result_buffer_depth', buffer_depth())
+        except Exception:
+            logger.exception('Unable to get the result buffer depth')
@@ -0,0 +1,105 @@
+import logging
+import threading
+from time import monotonic, sleep
+
+from kombu.transport.SQS import SQS_MAX_MESSAGES
+
+logger = logging.getLogger(__name__)
+
+
+class AckCoalescer(threading.Thread):
+    """Deletes acknowledged messages with DeleteMessageBatch.
+
+    Deletes are grouped per queue and sent once a queue has a full batch,
+    once the oldest pending delete waited ``linger`` seconds, or on close.
+    Only the entries SQS reports as failed are retried.
+    """
+
+    def __init__(self, channel, linger=0.05, max_attempts=3, retry_backoff=0.1) -> None:
+        super().__init__(name='ergo-ack-coalescer', daemon=True)
+        self.channel = channel
+        self.linger = linger
+        self.max_attempts = max(max_attempts, 1)
+        self.retry_backoff = retry_backoff
+        self._cond = threading.Condition()
+        self._pending = {}  # (queue URL, queue name) => receipt handles
+        self._oldest = None
+        self._shutdown = False
+
+    def add(self, queue_url, queue, receipt_handle):
+        with self._cond:
+            if self.ident is None and not self._shutdown:
+                self.start()
+            handles = self._pending.setdefault((queue_url, queue), [])
+            handles.append(receipt_handle)
+            if self._oldest is None:
+                self._oldest = monotonic()
+                # The thread waits without a timeout while nothing is pending
+                self._cond.notify()
+            elif len(handles) >= SQS_MAX_MESSAGES or self._shutdown:
+                self._cond.notify()
+
+    def _lingered(self):
+        return self._oldest is not None and monotonic() - self._oldest >= self.linger
+
+    def _take(self):
+        if self._shutdown or self._lingered():
+            batches, self._pending, self._oldest = self._pending, {}, None
+            return batches
+        batches = {}
+        for key, handles in self._pending.items():
+            full = len(handles) - len(handles) % SQS_MAX_MESSAGES
+            if full:
+                batches[key] = handles[:full]
+                del handles[:full]
+        return batches
+
+    def _wait_timeout(self):
+        if self._oldest is None:
+            return None
+        return max(self._oldest + self.linger - monotonic(), 0)
+
+    def run(self):
+        while True:
+            with self._cond:
+                batches = self._take()
+                while not batches and not self._shutdown:
+                    self._cond.wait(self._wait_timeout())
+                    batches = self._take()
+                if not batches and self._shutdown:
+                    return
+            for (queue_url, queue), handles in batches.items():
+                for start in range(0, len(handles), SQS_MAX_MESSAGES):
+                    self._delete_batch(queue_url, queue, handles[start:start + SQS_MAX_MESSAGES])
+
+    def _delete_batch(self, queue_url, queue, handles):
+        pending = {str(idx): handle for idx, handle in enumerate(handles)}
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                resp = self.channel.sqs(queue=queue).delete_message_batch(
+                    QueueUrl=queue_url,
+                    Entries=[{'Id': entry_id, 'ReceiptHandle': handle} for entry_id, handle in pending.items()]
+                )
+            except Exception as e:
+                logger.warn(f'[{attempt}/{self.max_attempts}] Unable to delete {len(pending)} messages', exc_info=e)
+            else:
+                for res in resp.get('Successful', []):
+                    pending.pop(res['Id'], None)
+                for res in resp.get('Failed', []):
+                    if res.get('SenderFault'):
+                        # e.g. the receipt handle expired, the message will be redelivered anyway
+                        logger.warn(f'Unable to delete message: {res.get("Message") or res.get("Code")}')
+                        pending.pop(res['Id'], None)
+            if not pending:
+                return
+            if attempt < self.max_attempts:
+                sleep(self.retry_backoff * 2 ** (attempt - 1))
+        logger.error(f'Gave up deleting {len(pending)} messages from {queue_url}')
+
+    def close(self, timeout=None):
+        """Send every pending delete and stop."""
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify()
+        if self.is_alive():
+            self.join(timeout)
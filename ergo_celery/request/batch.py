@@ -0,0 +1,227 @@
+import threading
+from time import monotonic
+
+from billiard.einfo import ExceptionInfo
+from celery import Task, current_app, signals, states
+from celery._state import _task_stack
+from celery.app.task import Context
+from celery.app.trace import TraceInfo
+from celery.exceptions import Ignore, Reject, Retry, TaskRevokedError
+from celery.utils.saferepr import saferepr
+from celery.worker.strategy import default
+
+
+def _handle_error(task, request, exc):
+    """Store and report the error of one item as the tracer does, returning its state and einfo."""
+    try:
+        raise exc
+    except Reject:
+        info, einfo = TraceInfo(states.REJECTED, exc), ExceptionInfo(internal=True)
+        info.handle_reject(task, request)
+    except Ignore:
+        info, einfo = TraceInfo(states.IGNORED, exc), ExceptionInfo(internal=True)
+        info.handle_ignore(task, request)
+    except Retry:
+        info = TraceInfo(states.RETRY, exc)
+        einfo = info.handle_error_state(task, request, call_errbacks=False)
+    except Exception:
+        info = TraceInfo(states.FAILURE, exc)
+        einfo = info.handle_error_state(task, request)
+    return info.state, einfo
+
+
+def trace_batch(task_name, items, hostname=None):
+    """Run a batch task once for ``items`` and store the result of every item.
+
+    Executed by the pool. Every item goes through the signals, hooks and
+    error states of :mod:`celery.app.trace`, while the task body runs once
+    with a request whose ``batch_ids`` are the ids of every item. Returns
+    the outcome of every item, in the format expected by
+    :meth:`celery.worker.request.Request.on_success`.
+    """
+    task = current_app.tasks[task_name]
+    requests = [
+        Context(request_dict, id=task_id, args=(), kwargs=kwargs, hostname=hostname)
+        for task_id, request_dict, kwargs in items
+    ]
+    for request in requests:
+        signals.task_prerun.send(sender=task, task_id=request.id, task=task, args=(), kwargs=request.kwargs)
+    start = monotonic()
+    _task_stack.push(task)
+    task.request_stack.push(Context(
+        items[0][1], id=requests[0].id, args=([request.kwargs for request in requests],), kwargs={},
+        hostname=hostname, batch_ids=[request.id for request in requests]))
+    try:
+        results = task.run([request.kwargs for request in requests])
+        if len(results) != len(items):
+            raise ValueError(f'Batch task {task_name} returned {len(results)} results for {len(items)} messages')
+    except Exception as exc:
+        results = [exc] * len(items)
+    finally:
+        task.pop_request()
+        _task_stack.pop()
+    runtime = monotonic() - start
+
+    outcomes = []
+    for request, result in zip(requests, results):
+        task.request_stack.push(request)
+        try:
+            if isinstance(result, Exception):
+                state, einfo = _handle_error(task, request, result)
+                outcomes.append((1, einfo, runtime))
+            else:
+                state, einfo = states.SUCCESS, None
+                task.backend.mark_as_done(request.id, result, request=request, store_result=not task.ignore_result)
+                task.on_success(result, request.id, (), request.kwargs)
+                signals.task_success.send(sender=task, result=result)
+                outcomes.append((0, saferepr(result), runtime))
+            task.after_return(state, result, request.id, (), request.kwargs, einfo)
+            signals.task_postrun.send(sender=task, task_id=request.id, task=task, args=(),
+                                      kwargs=request.kwargs, retval=result, state=state)
+        finally:
+            task.pop_request()
+    return outcomes
+
+
+class RequestBatch(object):
+    """Requests of a batch task sent to the pool as a single job.
+
+    Every request keeps its own message, so acks, visibility extensions and
+    failures are still handled per message.
+    """
+
+    def __init__(self, task, requests) -> None:
+        self.task = task
+        self.requests = requests
+
+    def execute_using_pool(self, pool, **kwargs):
+        self.requests = [req for req in self.requests if not req.revoked()]
+        if not self.requests:
+            raise TaskRevokedError(f'Every request of the {self.task.name} batch was revoked')
+        time_limit, soft_time_limit = self.requests[0].time_limits
+        return pool.apply_async(
+            trace_batch,
+            args=(self.task.name, [(req.task_id, req.request_dict, req.kwargs) for req in self.requests],
+                  self.requests[0].hostname),
+            accept_callback=self.on_accepted,
+            timeout_callback=self.on_timeout,
+            callback=self.on_success,
+            error_callback=self.on_failure,
+            soft_timeout=soft_time_limit or self.task.soft_time_limit,
+            timeout=time_limit or self.task.time_limit,
+            correlation_id=self.requests[0].task_id,
+        )
+
+    def on_accepted(self, pid, time_accepted):
+        for req in self.requests:
+            req.on_accepted(pid, time_accepted)
+
+    def on_timeout(self, soft, timeout):
+        for req in self.requests:
+            req.on_timeout(soft, timeout)
+
+    def on_success(self, outcomes, **kwargs):
+        for req, outcome in zip(self.requests, outcomes):
+            req.on_success(outcome, **kwargs)
+
+    def on_failure(self, exc_info, **kwargs):
+        for req in self.requests:
+            req.on_failure(exc_info, **kwargs)
+
+
+class Batcher(object):
+    """Collects the requests of a batch task per message group.
+
+    A batch is handed over once it holds ``task.batch_size`` requests, or
+    ``task.batch_linger_ms`` after its first request arrived.
+    """
+
+    def __init__(self, task, consumer, handle) -> None:
+        self.task = task
+        self.timer = consumer.timer
+        self.handle = handle
+        self.size = max(task.batch_size, 1)
+        self.linger = task.batch_linger_ms / 1000
+        # Batches are flushed by the consumer and by the timer, which may run in its own thread
+        self._lock = threading.Lock()
+        self._batches = {}
+        self._timers = {}
+
+    @staticmethod
+    def group_id(req):
+        sqs_message = req.message.delivery_info.get('sqs_message', {})
+        return sqs_message.get('Attributes', {}).get('MessageGroupId')
+
+    def add(self, req):
+        group = self.group_id(req)
+        with self._lock:
+            batch = self._batches.setdefault(group, [])
+            batch.append(req)
+            if len(batch) < self.size:
+                if len(batch) == 1:
+                    self._timers[group] = self.timer.call_after(self.linger, self.flush, (group, batch))
+                return
+            self._take(group)
+        self.handle(RequestBatch(self.task, batch))
+
+    def flush(self, group, batch=None):
+        """Hand the batch of ``group`` over, unless ``batch`` was already handed over."""
+        with self._lock:
+            if batch is not None and self._batches.get(group) is not batch:
+                return
+            batch = self._take(group)
+        if batch:
+            self.handle(RequestBatch(self.task, batch))
+
+    def _take(self, group):
+        tref = self._timers.pop(group, None)
+        if tref is not None:
+            tref.cancel()
+        return self._batches.pop(group, None)
+
+
+class _BatchingConsumer(object):
+    """Consumer handing the requests of a task to a :class:`Batcher`."""
+
+    def __init__(self, consumer, batcher) -> None:
+        self._consumer = consumer
+        self.on_task_request = batcher.add
+
+    def __getattr__(self, name):
+        return getattr(self._consumer, name)
+
+
+def batch_strategy(task, app, consumer, **kwargs):
+    batcher = Batcher(task, consumer, consumer.on_task_request)
+    return default(task, app, _BatchingConsumer(consumer, batcher), **kwargs)
+
+
+class BatchTask(Task):
+    """Base class of tasks called once for many messages.
+
+    The task receives the list of kwargs of up to ``batch_size`` messages of
+    the same message group, or of those received within ``batch_linger_ms``,
+    and returns a list with the result of every message, in order. A result
+    which is an exception fails its message only, and may be one of
+    :class:`~celery.exceptions.Retry`, :class:`~celery.exceptions.Ignore` or
+    :class:`~celery.exceptions.Reject`. Messages delayed by an ETA or a rate
+    limit are run in a batch of their own. Heartbeats sent by the task
+    apply to every message of the batch.
+
+        @app.task(base=BatchTask, name='calipso.lookup', batch_size=20)
+        def lookup(kwargs_list):
+            return [find(**kwargs) for kwargs in kwargs_list]
+    """
+    Request = 'ergo_celery.request.request:SQSRequest'
+    Strategy = 'ergo_celery.request.batch:batch_strategy'
+
+    batch_size = 10
+    batch_linger_ms = 50
+
+    def __call__(self, *args, **kwargs):
+        if args:
+            return super().__call__(*args)
+        result = super().__call__([kwargs])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
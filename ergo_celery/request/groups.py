@@ -0,0 +1,81 @@
+import threading
+from collections import Counter, OrderedDict, deque
+from time import monotonic
+
+from ergo_celery.metrics import metrics
+
+
+class GroupScheduler(object):
+    """Delivers the messages of FIFO message groups fairly.
+
+    At most ``max_in_flight`` messages of a group are delivered at once,
+    the others are held in their arrival order. Held messages are delivered
+    round-robin over the groups as their slots are released, so one busy
+    group can't take every slot of the pool. A held message is dropped once
+    its visibility timeout passed, as SQS delivers it again by then.
+    """
+
+    def __init__(self, max_in_flight=1) -> None:
+        self.max_in_flight = max(max_in_flight, 1)
+        self.in_flight = Counter()
+        self._held = OrderedDict()
+        self._held_count = 0
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._held_count
+
+    def hold(self, group, payload, queue, visibility_timeout, now=None):
+        now = monotonic() if now is None else now
+        with self._lock:
+            self._held.setdefault(group, deque()).append((now + visibility_timeout, payload, queue))
+            self._held_count += 1
+
+    def release(self, delivery_tag):
+        """Free the slot of a delivered message, returning True if it had one."""
+        with self._lock:
+            group = self._tags.pop(delivery_tag, None)
+            if group is None:
+                return False
+            self.in_flight[group] -= 1
+            if self.in_flight[group] <= 0:
+                del self.in_flight[group]
+            return True
+
+    def take(self, now=None):
+        """Return the (payload, queue) of every held message that may be delivered now."""
+        now = monotonic() if now is None else now
+        ready, expired = [], 0
+        with self._lock:
+            progress = True
+            while progress:
+                progress = False
+                for group in list(self._held):
+                    if self.in_flight[group] >= self.max_in_flight:
+                        continue
+                    held = self._held[group]
+                    deadline, payload, queue = held.popleft()
+                    self._held_count -= 1
+                    if not held:
+                        del self._held[group]
+                    else:
+                        # Rotate so the next round starts with another group
+                        self._held.move_to_end(group)
+                    progress = True
+                    if deadline <= now:
+                        expired += 1
+                        continue
+                    self.in_flight[group] += 1
+                    self._tags[payload['properties']['delivery_tag']] = group
+                    ready.append((payload, queue))
+        if expired:
+            metrics.incr('ergo_held_messages_expired_total', expired)
+        return ready
+
+    def clear(self):
+        """Drop every held message, returning how many were dropped."""
+        with self._lock:
+            count, self._held_count = self._held_count, 0
+            self._held.clear()
+            return count
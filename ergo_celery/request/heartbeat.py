@@ -0,0 +1,155 @@
+import json
+import logging
+import os
+import socket
+import threading
+from time import time
+
+from celery import current_task
+
+logger = logging.getLogger(__name__)
+
+# Heartbeat operations: report progress, keep the message invisible, make it visible again
+PROGRESS = 'progress'
+EXTEND = 'extend'
+RELEASE = 'release'
+
+
+class Heartbeats(object):
+    """Carries the heartbeats of running tasks to the main process of the worker.
+
+    Opened in the main process before the pool forks: pool processes send a
+    datagram per call through the inherited socket, calls made in the main
+    process (thread and solo pools) are recorded right away. Heartbeats of a
+    task are coalesced until the main process takes them, the last
+    visibility change winning. They are advisory, so they are dropped when
+    the socket is full rather than blocking the task.
+    """
+
+    def __init__(self) -> None:
+        self.pid = None
+        self._reader = None
+        self._writer = None
+        self._lock = threading.Lock()
+        self._pending = {}  # task id => {'progress': ..., 'visibility': (op, value, sent at)}
+
+    @property
+    def enabled(self):
+        return self._writer is not None
+
+    def open(self):
+        if self.enabled:
+            return
+        self._reader, self._writer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._reader.setblocking(False)
+        self._writer.setblocking(False)
+        self.pid = os.getpid()
+
+    def close(self):
+        if self.enabled:
+            self._reader.close()
+            self._writer.close()
+            self._reader = self._writer = None
+        with self._lock:
+            self._pending.clear()
+
+    def fileno(self):
+        return self._reader.fileno()
+
+    def send(self, task_id, op, value=None) -> bool:
+        """Send a heartbeat of ``task_id``, returning False if it was dropped."""
+        if not self.enabled:
+            return False
+        if os.getpid() == self.pid:
+            self._record(task_id, op, value, time())
+            return True
+        try:
+            self._writer.send(json.dumps((task_id, op, value, time())).encode())
+        except OSError as e:
+            logger.debug(f'Dropped heartbeat of task {task_id}: {e!r}')
+            return False
+        return True
+
+    def _record(self, task_id, op, value, sent_at):
+        with self._lock:
+            beat = self._pending.setdefault(task_id, {})
+            if op == PROGRESS:
+                beat['progress'] = value
+            else:
+                beat['visibility'] = (op, value, sent_at)
+
+    def receive(self):
+        """Record the heartbeats sent by pool processes."""
+        if not self.enabled or os.getpid() != self.pid:
+            return
+        while True:
+            try:
+                data = self._reader.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                self._record(*json.loads(data))
+            except (ValueError, TypeError):
+                logger.warn(f'Ignoring malformed heartbeat {data!r}')
+
+    def take(self):
+        """Return the heartbeats received since the last call, per task id."""
+        self.receive()
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def pop(self, task_id):
+        """Return the heartbeats received for ``task_id`` since the last call, if any."""
+        self.receive()
+        with self._lock:
+            return self._pending.pop(task_id, None)
+
+
+# Heartbeats of this worker, opened by SQSPingTimerStep
+heartbeats = Heartbeats()
+
+
+def _send(op, value=None, task_id=None):
+    if task_id is not None:
+        return heartbeats.send(task_id, op, value)
+    task = current_task._get_current_object()
+    task_id = task.request.id if task is not None else None
+    if task_id is None:
+        raise RuntimeError('Heartbeats must be sent from a running task, or given its task_id')
+    # A batch task runs for the messages of every task of the batch
+    task_ids = getattr(task.request, 'batch_ids', None) or [task_id]
+    return all([heartbeats.send(task_id, op, value) for task_id in task_ids])
+
+
+def heartbeat(progress=None, task_id=None):
+    """Report the progress of the current task, shown by ``celery inspect active``."""
+    return _send(PROGRESS, progress, task_id)
+
+
+def extend_visibility(seconds, task_id=None):
+    """Keep the message of the current task invisible for ``seconds`` from now.
+
+    Replaces the extensions guessed by the visibility policy, for tasks
+    that know how long they still need. If the task is still running once
+    most of that time passed, the message is extended again by the policy.
+    """
+    return _send(EXTEND, seconds, task_id)
+
+
+def release_visibility(delay=0, task_id=None):
+    """Make the message of the current task visible again in ``delay`` seconds.
+
+    The message is no longer extended, and it is not deleted when the task
+    ends unless it succeeded, so SQS delivers it again right after ``delay``
+    rather than once its visibility timeout is over:
+
+        @app.task(bind=True)
+        def lookup(self, **kwargs):
+            try:
+                return find(**kwargs)
+            except Unavailable:
+                release_visibility(delay=10)
+                raise Ignore()
+    """
+    return _send(RELEASE, delay, task_id)
@@ -5,6 +5,15 @@ from kombu.transport.virtual import base
 logger = logging.getLogger(__name__)
 
 class SQSMessage(base.Message):
+    # Payload key of a body already decoded by the channel
+    DECODED_BODY_KEY = 'ergo_decoded_body'
+
+    def __init__(self, payload, channel=None, **kwargs):
+        super().__init__(payload, channel=channel, **kwargs)
+        decoded = payload.get(self.DECODED_BODY_KEY)
+        if decoded is not None:
+            self._decoded_cache = decoded
+
     def change_visibility_timeout(self, new_timeout):
         if self.channel is None:
             raise self.MessageStateError(
@@ -1,26 +1,102 @@
 import logging
+from time import perf_counter, time
 
 from celery import bootsteps
 
+from ergo_celery.metrics import metrics
+from ergo_celery.request.heartbeat import heartbeats
+from ergo_celery.request.visibility import VisibilityScheduler
+
 logger = logging.getLogger(__name__)
 
 class SQSPingTimerStep(bootsteps.StartStopStep):
+    """Extends the visibility timeout of the messages of running tasks.
+
+    Extensions follow the visibility policy, unless the task asked for
+    another one through :mod:`ergo_celery.request.heartbeat` (enabled with
+    ``ergo_task_heartbeats_enabled``). Every change due is sent in batches
+    every ``ergo_task_ping_interval_secs``.
+    """
     requires = {'celery.worker.components:Timer'}
 
     def __init__(self, worker, *args, **kwargs):
         self.tref = None
+        self.hub = None
         self._backend = worker.app.backend
         self.interval = worker.app.conf.get('ergo_task_ping_interval_secs', 2)
+        self.scheduler = VisibilityScheduler.for_app(worker.app)
+        if worker.app.conf.get('ergo_task_heartbeats_enabled', True):
+            # Opened before the pool starts, so child processes inherit it
+            heartbeats.open()
 
     def start(self, worker):
         self.tref = worker.timer.call_repeatedly(
             self.interval, self.ping_active_tasks, (worker,))
+        if heartbeats.enabled and getattr(worker, 'hub', None) is not None:
+            # Received as they come, so that the socket never fills up
+            self.hub = worker.hub
+            self.hub.add_reader(heartbeats.fileno(), heartbeats.receive)
 
     def stop(self, worker):
         if self.tref:
             self.tref.cancel()
             self.tref = None
+        if self.hub is not None:
+            self.hub.remove_reader(heartbeats.fileno())
+            self.hub = None
+        heartbeats.close()
+
+    def collect_heartbeats(self, worker, due):
+        """Add the visibility changes asked by running tasks to ``due``."""
+        beats = heartbeats.take()
+        if not beats:
+            return
+        requests = {req.id: req for req in worker.state.active_requests}
+        for task_id, beat in beats.items():
+            on_heartbeat = getattr(requests.get(task_id), 'on_heartbeat', None)
+            if on_heartbeat is None:
+                continue
+            new_timeout = on_heartbeat(beat)
+            if new_timeout is not None:
+                req = requests[task_id]
+                self.scheduler.discard(req)
+                due.setdefault(req.message.channel, []).append((req, new_timeout))
 
     def ping_active_tasks(self, worker):
-        for req in tuple(worker.state.active_requests):
-            req.ping_message(worker)
+        due = {}
+        self.collect_heartbeats(worker, due)
+        # Only the requests whose extension deadline passed are looked at
+        self.scheduler.retain(worker.state.active_requests)
+        next_deadline = self.scheduler.next_deadline()
+        if next_deadline is not None and next_deadline <= time():
+            for req in self.scheduler.pop_due(time()):
+                if req not in worker.state.active_requests:
+                    continue
+                new_timeout = req.visibility_timeout_due()
+                if new_timeout:
+                    due.setdefault(req.message.channel, []).append((req, new_timeout))
+                else:
+                    self.scheduler.add(req)
+
+        for channel, extensions in due.items():
+            started = perf_counter()
+            try:
+                failed = channel.change_visibility_timeout_batch([
+                    (req.message.delivery_tag, new_timeout)
+                    for req, new_timeout in extensions
+                ])
+            except Exception as e:
+                logger.exception('Unable to change visibility timeouts')
+                failed = {req.message.delivery_tag: repr(e) for req, _ in extensions}
+            metrics.observe('ergo_visibility_extension_seconds', perf_counter() - started)
+            metrics.incr('ergo_visibility_extensions_total', len(extensions) - len(failed))
+            if failed:
+                metrics.incr('ergo_visibility_extension_failures_total', len(failed))
+            for req, new_timeout in extensions:
+                error = failed.get(req.message.delivery_tag)
+                if error is None:
+                    req.on_visibility_timeout_changed(new_timeout)
+                else:
+                    req.on_visibility_timeout_failed(error, worker)
+                if req in worker.state.active_requests:
+                    self.scheduler.add(req)
@@ -0,0 +1,95 @@
+from math import ceil
+from time import monotonic
+
+# Longest long polling wait allowed by ReceiveMessage
+SQS_MAX_WAIT_TIME_SECONDS = 20
+
+
+class QueueActivity(object):
+    """Recent receive statistics of a queue."""
+
+    __slots__ = ('rate', 'empty_ratio', 'consecutive_empty', 'last_receive_at')
+
+    def __init__(self) -> None:
+        self.rate = 0.0
+        self.empty_ratio = 0.0
+        self.consecutive_empty = 0
+        self.last_receive_at = None
+
+    @property
+    def busy(self):
+        return self.consecutive_empty == 0 and self.rate > 0
+
+
+class AdaptivePoller(object):
+    """Adapts how each queue is polled to its recent traffic.
+
+    The arrival rate and the ratio of empty receives of every queue are
+    tracked as exponentially weighted averages. Busy queues are polled with
+    batches sized to their arrival rate, while idle queues back off
+    exponentially, up to ``max_idle_interval`` seconds, and use longer waits
+    so they cost fewer empty receives without ever being starved.
+    """
+
+    def __init__(self, decay=0.3, batch_window=1.0, busy_wait_time=1,
+                 max_wait_time=SQS_MAX_WAIT_TIME_SECONDS, idle_backoff=0.5, max_idle_interval=10) -> None:
+        self.decay = decay
+        self.batch_window = batch_window
+        self.busy_wait_time = busy_wait_time
+        self.max_wait_time = min(max_wait_time, SQS_MAX_WAIT_TIME_SECONDS)
+        self.idle_backoff = idle_backoff
+        self.max_idle_interval = max_idle_interval
+        self._activity = {}
+
+    def activity(self, queue):
+        try:
+            return self._activity[queue]
+        except KeyError:
+            activity = self._activity[queue] = QueueActivity()
+            return activity
+
+    def record(self, queue, received, now=None):
+        """Account for a receive of ``queue`` that returned ``received`` messages."""
+        now = monotonic() if now is None else now
+        activity = self.activity(queue)
+        if activity.last_receive_at is not None:
+            elapsed = max(now - activity.last_receive_at, 1e-3)
+            activity.rate += self.decay * (received / elapsed - activity.rate)
+        elif received:
+            activity.rate = float(received)
+        activity.empty_ratio += self.decay * ((0.0 if received else 1.0) - activity.empty_ratio)
+        activity.consecutive_empty = 0 if received else activity.consecutive_empty + 1
+        activity.last_receive_at = now
+
+    def others_busy(self, queue):
+        return any(activity.busy for name, activity in self._activity.items() if name != queue)
+
+    def poll_delay(self, queue, now=None):
+        """Seconds to wait before ``queue`` should be polled again."""
+        activity = self.activity(queue)
+        if not activity.consecutive_empty or activity.last_receive_at is None:
+            return 0
+        interval = min(self.idle_backoff * 2 ** (activity.consecutive_empty - 1), self.max_idle_interval)
+        now = monotonic() if now is None else now
+        return max(activity.last_receive_at + interval - now, 0)
+
+    def wait_time_seconds(self, queue, default, shared=False):
+        """Long polling wait for the next receive of ``queue``.
+
+        ``shared`` tells if queues are polled one after the other, in which
+        case a wait on a quiet queue delays the busy ones.
+        """
+        activity = self.activity(queue)
+        if activity.busy:
+            return min(default, self.busy_wait_time) if shared and self.others_busy(queue) else default
+        if shared and self.others_busy(queue):
+            return 0
+        # The emptier the queue, the longer we wait for a message to arrive
+        return round(default + (self.max_wait_time - default) * activity.empty_ratio)
+
+    def max_messages(self, queue, limit):
+        """Batch size for the next receive of ``queue``, at most ``limit``."""
+        activity = self.activity(queue)
+        if activity.last_receive_at is None:
+            return limit
+        return max(min(ceil(activity.rate * self.batch_window), limit), 1)
@@ -0,0 +1,112 @@
+import json
+import logging
+import threading
+
+from kombu.transport.SQS import SQS_MAX_MESSAGES
+
+from ergo_celery.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class FileQuarantineSink(object):
+    """Appends quarantined messages to a local file, one JSON document per line."""
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+    def put(self, entries):
+        lines = ''.join(json.dumps(entry) + '\n' for entry in entries)
+        with self._lock:
+            with open(self.path, 'a') as fp:
+                fp.write(lines)
+        return entries
+
+
+class QueueQuarantineSink(object):
+    """Sends quarantined messages to a dead-letter SQS queue."""
+
+    def __init__(self, channel, queue) -> None:
+        self.channel = channel
+        self.queue = queue
+
+    def put(self, entries):
+        q_url = self.channel._new_queue(self.queue)
+        c = self.channel.sqs(queue=self.channel.canonical_queue_name(self.queue))
+        fifo = 'fifo' in q_url
+        stored = []
+        for start in range(0, len(entries), SQS_MAX_MESSAGES):
+            batch = entries[start:start + SQS_MAX_MESSAGES]
+            request_entries = []
+            for idx, entry in enumerate(batch):
+                request_entry = {
+                    'Id': str(idx),
+                    'MessageBody': entry['body'],
+                    'MessageAttributes': {
+                        'ErgoQuarantineReason': {'DataType': 'String', 'StringValue': entry['error']},
+                        'ErgoQuarantineQueue': {'DataType': 'String', 'StringValue': entry['queue']},
+                    },
+                }
+                if fifo:
+                    request_entry['MessageGroupId'] = entry['group'] or 'quarantine'
+                    request_entry['MessageDeduplicationId'] = entry['messageId']
+                request_entries.append(request_entry)
+            try:
+                resp = c.send_message_batch(QueueUrl=q_url, Entries=request_entries)
+            except Exception:
+                logger.exception(f'Unable to move {len(batch)} messages to quarantine queue {self.queue}')
+                continue
+            stored.extend(batch[int(res['Id'])] for res in resp.get('Successful', []))
+        return stored
+
+
+class Quarantine(object):
+    """Moves messages that repeatedly fail to decode out of their queue.
+
+    Once a message was received ``max_receives`` times, it is stored into the ``sink`` and deleted from
+    its queue on the next :meth:`flush`.
+    """
+
+    def __init__(self, channel, max_receives=5, sink=None) -> None:
+        self.channel = channel
+        self.max_receives = max_receives
+        self.sink = sink
+        self._lock = threading.Lock()
+        self._pending = []
+
+    def add(self, message, queue_name, queue_url, exc):
+        receive_count = int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1))
+        if self.sink is None or receive_count < self.max_receives:
+            return False
+        entry = {
+            'messageId': message.get('MessageId'),
+            'group': message.get('Attributes', {}).get('MessageGroupId'),
+            'queue': queue_name,
+            'receiveCount': receive_count,
+            'error': f'{type(exc).__name__}: {exc}',
+            'body': message.get('Body', ''),
+        }
+        with self._lock:
+            self._pending.append((entry, queue_name, queue_url, message['ReceiptHandle']))
+        return True
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        try:
+            stored = self.sink.put([entry for entry, _, _, _ in pending])
+        except Exception:
+            logger.exception(f'Unable to quarantine {len(pending)} messages')
+            metrics.incr('ergo_quarantine_failures_total', len(pending))
+            return
+        stored_ids = {id(entry) for entry in stored}
+        for entry, queue_name, queue_url, receipt_handle in pending:
+            if id(entry) in stored_ids:
+                self.channel.delete_message_later(queue_url, queue_name, receipt_handle)
+        metrics.incr('ergo_messages_quarantined_total', len(stored_ids))
+        if len(stored_ids) < len(pending):
+            metrics.incr('ergo_quarantine_failures_total', len(pending) - len(stored_ids))
+        logger.warn(f'Quarantined {len(stored_ids)} undecodable messages')
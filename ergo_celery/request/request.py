@@ -6,7 +6,11 @@ from botocore.exceptions import ClientError
 from celery.worker.request import Request
 from kombu.transport.SQS import Channel
 
-MAX_VISIBILITY_TIMEOUT = 43199
+from ergo_celery.metrics import metrics
+from ergo_celery.request.heartbeat import RELEASE, heartbeats
+from ergo_celery.request.visibility import (MAX_VISIBILITY_TIMEOUT,
+                                            VisibilityScheduler,
+                                            get_visibility_policy)
 
 logger = logging.getLogger(__name__)
 
@@ -16,11 +20,128 @@ class SQSRequest(Request):
         self._lock = threading.Lock()
         self._attempt = 1
         self.init_visible_timeout = self.app.conf.broker_transport_options.get('visibility_timeout', Channel.default_visibility_timeout)
+        self.visibility_policy = get_visibility_policy(self.app, self.init_visible_timeout)
+        self.progress = None
+        self._ping_after = None
+        self._released = False
+        self._release_timeout = None
+        self._succeeded = False
+
+    def next_ping_at(self):
+        if self.time_start is None or self._released:
+            return None
+        if self._ping_after is not None:
+            # Once the task set its own visibility, it expires relative to the last change
+            return self._ping_after
+        return self.visibility_policy.deadline(self.time_start, self._attempt)
 
     def need_more_exec_time(self):
-        duration = time() - self.time_start
-        logger.debug(f'PING {self.humaninfo()}! Duration: {duration}')
-        return duration >= 0.69 * (self._attempt * self.init_visible_timeout)
+        deadline = self.next_ping_at()
+        if deadline is None:
+            return False
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'PING {self.humaninfo()}! Duration: {time() - self.time_start}')
+        return time() >= deadline
+
+    def on_accepted(self, pid, time_accepted):
+        super().on_accepted(pid, time_accepted)
+        if metrics.enabled:
+            sent_timestamp = self.message.delivery_info.get('sqs_message', {}).get('Attributes', {}).get('SentTimestamp')
+            if sent_timestamp:
+                metrics.observe('ergo_queue_to_start_seconds', max(time() - int(sent_timestamp) / 1000, 0), task=self.task_name)
+        VisibilityScheduler.for_app(self.app).add(self)
+
+    def on_success(self, failed__retval__runtime, **kwargs):
+        VisibilityScheduler.for_app(self.app).discard(self)
+        self._succeeded = not failed__retval__runtime[0]
+        return super().on_success(failed__retval__runtime, **kwargs)
+
+    def on_failure(self, *args, **kwargs):
+        VisibilityScheduler.for_app(self.app).discard(self)
+        return super().on_failure(*args, **kwargs)
+
+    def info(self, safe=False):
+        info = super().info(safe=safe)
+        info['progress'] = self.progress
+        return info
+
+    def on_heartbeat(self, beat):
+        """Apply the heartbeats of the task, returning the visibility timeout to change the message to, if any."""
+        with self._lock:
+            if 'progress' in beat:
+                self.progress = beat['progress']
+            if beat.get('visibility') is None or self._released:
+                return None
+            op, value, _ = beat['visibility']
+            new_timeout = min(max(int(value or 0), 0), MAX_VISIBILITY_TIMEOUT)
+            if op == RELEASE:
+                logger.debug(f'Task "{self.humaninfo()}" released its message in {new_timeout}s')
+                self._released = True
+                self._release_timeout = new_timeout
+            else:
+                self._ping_after = time() + self.visibility_policy.factor * new_timeout
+            return new_timeout
+
+    def acknowledge(self):
+        if not self.acknowledged and not self._succeeded:
+            # The task may have released its message right before it ended
+            beat = heartbeats.pop(self.id)
+            if beat is not None:
+                self.on_heartbeat(beat)
+            if self._released:
+                self._forget_message()
+                return
+        super().acknowledge()
+
+    def _forget_message(self):
+        """Leave the released message in the queue, so SQS delivers it again once its visibility timeout is over."""
+        channel = self.message.channel
+        tag = self.message.delivery_tag
+        if self._release_timeout is not None:
+            try:
+                failed = channel.change_visibility_timeout_batch([(tag, self._release_timeout)])
+            except Exception as e:
+                failed = {tag: repr(e)}
+            if failed:
+                logger.warn(f'Unable to release the message of {self.humaninfo()}: {failed[tag]}')
+            self._release_timeout = None
+        channel.forget_message(tag)
+        self.acknowledged = True
+        metrics.incr('ergo_visibility_releases_total', task=self.task_name)
+
+    def visibility_timeout_due(self):
+        """Return the visibility timeout to extend the message to if it's due, else None."""
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            if not self.need_more_exec_time():
+                return None
+            logger.debug(f'Task "{self.humaninfo()}" still pending (attempt {self._attempt}). Increasing visibility timeout...')
+            self._attempt += 1
+            new_timeout = self.visibility_policy.visibility_timeout(self._attempt)
+            if self._ping_after is not None:
+                self._ping_after = time() + self.visibility_policy.factor * new_timeout
+            return new_timeout
+        finally:
+            self._lock.release()
+
+    def on_visibility_timeout_changed(self, new_timeout):
+        if self._released:
+            self._release_timeout = None
+        logger.debug(f'Task "{self.humaninfo()}" changed visibility timeout to {new_timeout}')
+
+    def on_visibility_timeout_failed(self, error, worker):
+        task_str = self.humaninfo()
+        logger.warn(f'Unable to change visibility timeout of {task_str}: {error}')
+        # maybe expired? cancel request
+        if 'receipt handle has expired' not in error:
+            return
+        try:
+            self.cancel(worker.pool)
+        except NotImplementedError:
+            pass
+        except Exception as ex:
+            logger.warn(f'Unable to kill expired task {task_str}', exc_info=ex)
 
     def increase_visibility_timeout(self, new_timeout, worker):
         task_str = self.humaninfo()
@@ -29,29 +150,13 @@ class SQSRequest(Request):
         except self._connection_errors as e:
             logger.warn(f'Unable to change visibility timeout of {task_str}', exc_info=e)
         except ClientError as e:
-            # maybe expired? cancel request
-            logger.warn(f'Unable to change visibility timeout of {task_str}', exc_info=e)
-            try:
-                if 'receipt handle has expired' in e.response.get('Error', {}).get('Message', 'Unknown'):
-                    self.cancel(worker.pool)
-            except NotImplementedError:
-                pass
-            except Exception as ex:
-                logger.warn(f'Unable to kill expired task {task_str}', exc_info=ex)
+            self.on_visibility_timeout_failed(e.response.get('Error', {}).get('Message', 'Unknown'), worker)
         except Exception:
             logger.exception(f'Unable to change visibility timeout of {task_str}')
         else:
-            logger.info(f'Task "{task_str}" changed visibility timeout to {new_timeout}')
+            self.on_visibility_timeout_changed(new_timeout)
 
     def ping_message(self, worker):
-        if self._lock.acquire(blocking=False):
-            try:
-                if self.need_more_exec_time():
-                    logger.info(f'Task "{self.humaninfo()}" still pending (attempt {self._attempt}). Increasing visibility timeout...')
-                    self._attempt += 1
-                    self.increase_visibility_timeout(
-                        min(self._attempt * self.init_visible_timeout, MAX_VISIBILITY_TIMEOUT),
-                        worker
-                    )
-            finally:
-                self._lock.release()
+        new_timeout = self.visibility_timeout_due()
+        if new_timeout:
+            self.increase_visibility_timeout(new_timeout, worker)
@@ -1,28 +1,254 @@
-import uuid
-from json.decoder import JSONDecodeError
+import hashlib
+import logging
+import os
+import threading
+from collections import namedtuple
 from queue import Empty
+from time import perf_counter
 
-from kombu.asynchronous.aws.sqs.message import AsyncMessage
-from kombu.serialization import dumps, loads
-from kombu.transport import SQS
+import boto3
+from botocore.config import Config
+from kombu.serialization import dumps
+from kombu.transport import SQS, virtual
+from kombu.utils.encoding import bytes_to_str
+from vine import ensure_promise, transform
 
+from ergo_celery.metrics import metrics
+from ergo_celery.request.ack import AckCoalescer
+from ergo_celery.request.groups import GroupScheduler
 from ergo_celery.request.message import SQSMessage
+from ergo_celery.request.polling import AdaptivePoller
+from ergo_celery.request.quarantine import (FileQuarantineSink, Quarantine,
+                                            QueueQuarantineSink)
+from ergo_celery.serialization import loads as json_loads
 
 logger = SQS.logger
 
+# How messages are received from a queue, computed once per queue
+ReceiveProfile = namedtuple('ReceiveProfile', (
+    'url', 'attributes', 'wait_time_seconds', 'visibility_timeout', 'max_messages'
+))
+
+_clients_lock = threading.Lock()
+_clients_pid = None
+_predefined_clients_pid = None  # process which the clients cached on the kombu channel class belong to
+_sessions = {}  # client settings => boto3 session, kept by forked child processes
+_clients = {}  # client settings => boto3 SQS client of the current process
+
+
+def get_sqs_client(region, access_key_id, secret_access_key, endpoint_url=None, use_ssl=True, client_config=None):
+    """Return the process-wide boto3 SQS client of these settings.
+
+    boto3 clients are thread safe, so every channel of the process shares
+    them. Forked child processes build their own client from the parent's
+    session, which already loaded the service model, instead of sharing the
+    parent's connection pool.
+    """
+    global _clients_pid
+    client_config = client_config or {}
+    key = (region, access_key_id, secret_access_key, endpoint_url, use_ssl, repr(sorted(client_config.items())))
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            _clients.clear()
+            _clients_pid = os.getpid()
+        client = _clients.get(key)
+        if client is None:
+            session = _sessions.get(key)
+            if session is None:
+                session = _sessions[key] = boto3.session.Session(
+                    region_name=region,
+                    aws_access_key_id=access_key_id,
+                    aws_secret_access_key=secret_access_key,
+                )
+            client_kwargs = {'use_ssl': use_ssl}
+            if endpoint_url is not None:
+                client_kwargs['endpoint_url'] = endpoint_url
+            client = _clients[key] = session.client('sqs', config=Config(**client_config), **client_kwargs)
+        return client
+
 
 class ErgoChannel(SQS.Channel):
     Message = SQSMessage
     
     DEFAULT_CONTENT_TYPE = 'application/json'
     DEFAULT_CONTENT_ENCODING = 'utf-8'
-    MESSAGE_ATTRIBUTES = ['ApproximateReceiveCount']
+    MESSAGE_ATTRIBUTES = ('ApproximateReceiveCount', 'SentTimestamp')
+    # Errors raised by messages that can't be converted to a task
+    DECODE_ERRORS = (ValueError, KeyError, TypeError)
+
+    _ack_coalescer = None
+    _quarantine = None
+    _poller = None
+    _group_scheduler = None
+    _polling_paused = False
+    _clients_pid = None
+
+    def __init__(self, *args, **kwargs):
+        self._receive_profiles = {}  # queue name (and SQS queue name) => ReceiveProfile
+        super().__init__(*args, **kwargs)
+
+    def new_sqs_client(self, region, access_key_id, secret_access_key, session_token=None):
+        if session_token is not None:
+            # Credentials of an assumed role expire, so their clients are not shared
+            return super().new_sqs_client(region, access_key_id, secret_access_key, session_token)
+        return get_sqs_client(
+            region, access_key_id, secret_access_key,
+            endpoint_url=self.endpoint_url,
+            use_ssl=self.is_secure if self.is_secure is not None else True,
+            client_config=self.transport_options.get('client-config'),
+        )
+
+    def _check_clients_pid(self):
+        global _predefined_clients_pid
+        if self._clients_pid == os.getpid():
+            return
+        with _clients_lock:
+            if _predefined_clients_pid != os.getpid():
+                # kombu caches the clients of predefined queues on the class, so they
+                # are inherited by forked child processes along with their sockets
+                self._predefined_queue_clients.clear()
+                self._predefined_queue_async_clients.clear()
+                _predefined_clients_pid = os.getpid()
+        # Clients of a channel opened before the fork
+        self._sqs = None
+        self._asynsqs = None
+        self._clients_pid = os.getpid()
+
+    def sqs(self, queue=None):
+        self._check_clients_pid()
+        return super().sqs(queue)
+
+    def asynsqs(self, queue=None):
+        self._check_clients_pid()
+        return super().asynsqs(queue)
+
+    def receive_profile(self, queue):
+        """Return the :class:`ReceiveProfile` of ``queue``, built on first use."""
+        try:
+            return self._receive_profiles[queue]
+        except KeyError:
+            pass
+        sqs_qname = self.canonical_queue_name(queue)
+        q_url = self._new_queue(queue)
+        options = self.predefined_queues.get(sqs_qname, {})
+        attributes = self.MESSAGE_ATTRIBUTES
+        # For FIFO queue, also fetch MessageGroupId attribute
+        if 'fifo' in q_url:
+            attributes += ('MessageGroupId',)
+        profile = ReceiveProfile(
+            url=q_url,
+            attributes=attributes,
+            wait_time_seconds=options.get('wait_time_seconds', self.wait_time_seconds),
+            visibility_timeout=options.get('visibility_timeout', self.visibility_timeout),
+            max_messages=min(options.get('max_messages', SQS.SQS_MAX_MESSAGES), SQS.SQS_MAX_MESSAGES)
+        )
+        self._receive_profiles[queue] = self._receive_profiles[sqs_qname] = profile
+        return profile
+
+    def basic_consume(self, queue, no_ack, *args, **kwargs):
+        self.receive_profile(queue)
+        return super().basic_consume(queue, no_ack, *args, **kwargs)
+
+    @property
+    def poller(self):
+        if self._poller is None and self.transport_options.get('adaptive_polling', True):
+            options = self.transport_options
+            self._poller = AdaptivePoller(
+                batch_window=options.get('adaptive_batch_window_secs', 1.0),
+                busy_wait_time=options.get('adaptive_busy_wait_time_seconds', 1),
+                max_idle_interval=options.get('adaptive_max_idle_interval_secs', 10),
+            )
+        return self._poller
+
+    @property
+    def group_scheduler(self):
+        if self._group_scheduler is None and self.transport_options.get('max_in_flight_per_group'):
+            self._group_scheduler = GroupScheduler(self.transport_options['max_in_flight_per_group'])
+        return self._group_scheduler
+
+    def _get_message_estimate(self, max_if_unlimited=SQS.SQS_MAX_MESSAGES):
+        estimate = super()._get_message_estimate(max_if_unlimited)
+        scheduler = self.group_scheduler
+        if scheduler is not None:
+            # Held messages already use part of the prefetch budget
+            estimate = max(estimate - len(scheduler), 0)
+        return estimate
+
+    def _get_bulk_async(self, queue, max_if_unlimited=SQS.SQS_MAX_MESSAGES, callback=None):
+        if self._get_message_estimate(max_if_unlimited):
+            return super()._get_bulk_async(queue, max_if_unlimited, callback)
+        # Held messages use the whole prefetch budget, so polling again right away would spin
+        callback = ensure_promise(callback)
+        self.hub.call_later(self.transport_options.get('held_poll_interval_secs', 0.1), callback, [])
+        return callback
+
+    def _deliver_messages(self, payloads, queue):
+        scheduler = self.group_scheduler
+        if scheduler is None:
+            for payload in payloads:
+                self.connection._deliver(payload, queue)
+            return
+        visibility_timeout = self.receive_profile(queue).visibility_timeout
+        for payload in payloads:
+            sqs_message = payload['properties']['delivery_info']['sqs_message']
+            group = sqs_message.get('Attributes', {}).get('MessageGroupId')
+            if group is None:
+                self.connection._deliver(payload, queue)
+            else:
+                scheduler.hold(group, payload, queue, visibility_timeout)
+        self._deliver_held()
+
+    def _deliver_held(self):
+        scheduler = self._group_scheduler
+        if scheduler is None or self.closed:
+            return
+        for payload, queue in scheduler.take():
+            self.connection._deliver(payload, queue)
+
+    def _release_group_slot(self, delivery_tag):
+        scheduler = self._group_scheduler
+        if scheduler is None or not scheduler.release(delivery_tag) or not len(scheduler):
+            return
+        if self.hub is not None:
+            self.hub.call_soon(self._deliver_held)
+        # Without an event loop, held messages are delivered on the next drain_events
+
+    @property
+    def polling_paused(self):
+        return self._polling_paused
+
+    def pause_polling(self):
+        """Stop receiving messages until :meth:`resume_polling` is called."""
+        if not self._polling_paused:
+            logger.warn('Pausing consumption of messages')
+            self._polling_paused = True
+
+    def resume_polling(self):
+        if self._polling_paused:
+            logger.info('Resuming consumption of messages')
+            self._polling_paused = False
+
+    def drain_events(self, timeout=None, callback=None, **kwargs):
+        self._deliver_held()
+        if self._polling_paused:
+            raise Empty()
+        return super().drain_events(timeout=timeout, callback=callback, **kwargs)
+
+    def _schedule_queue(self, queue):
+        if self._polling_paused and queue in self._active_queues:
+            self.hub.call_later(
+                self.transport_options.get('paused_poll_interval_secs', 1),
+                self._schedule_queue, queue)
+            return
+        super()._schedule_queue(queue)
 
     def basic_reject(self, delivery_tag, requeue=False):
-        logger.info(f'Rejecting message "{delivery_tag}"')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'Rejecting message "{delivery_tag}"')
         if not requeue:
             self.basic_ack(delivery_tag, requeue)
         else:
+            self._release_group_slot(delivery_tag)
             super().basic_reject(delivery_tag, requeue)
 
     def _message_humaninfo(self, delivery_tag):
@@ -34,65 +260,177 @@ class ErgoChannel(SQS.Channel):
             logger.warn('Unable to generate string repr', exc_info=ex)
             return delivery_tag
 
+    @property
+    def ack_coalescer(self):
+        if self._ack_coalescer is None and self.transport_options.get('batch_acks', True):
+            self._ack_coalescer = AckCoalescer(
+                self,
+                linger=self.transport_options.get('ack_linger_secs', 0.05),
+                max_attempts=self.transport_options.get('ack_max_attempts', 3)
+            )
+        return self._ack_coalescer
+
     def basic_ack(self, delivery_tag, multiple=False):
-        super().basic_ack(delivery_tag, multiple=multiple)
-        logger.info(f'Acknowledged message "{self._message_humaninfo(delivery_tag)}"')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'Acknowledging message "{self._message_humaninfo(delivery_tag)}"')
+        self._release_group_slot(delivery_tag)
+        coalescer = self.ack_coalescer
+        if coalescer is None or self.closed:
+            return super().basic_ack(delivery_tag, multiple=multiple)
+        try:
+            message = self.qos.get(delivery_tag).delivery_info
+            sqs_message = message['sqs_message']
+        except KeyError:
+            return super().basic_ack(delivery_tag, multiple=multiple)
+        queue = None
+        if 'routing_key' in message:
+            queue = self.canonical_queue_name(message['routing_key'])
+        coalescer.add(message['sqs_queue'], queue, sqs_message['ReceiptHandle'])
+        # The delete is sent later on, but the prefetch slot can be released right away
+        virtual.Channel.basic_ack(self, delivery_tag, multiple=multiple)
+
+    def forget_message(self, delivery_tag):
+        """Stop tracking a message without deleting it, so SQS delivers it again."""
+        self._release_group_slot(delivery_tag)
+        virtual.Channel.basic_ack(self, delivery_tag)
+
+    def delete_message_later(self, queue_url, queue, receipt_handle):
+        """Delete a message through the ack coalescer, or right away if acks aren't batched."""
+        sqs_qname = self.canonical_queue_name(queue)
+        coalescer = self.ack_coalescer
+        if coalescer is not None and not self.closed:
+            coalescer.add(queue_url, sqs_qname, receipt_handle)
+        else:
+            self.sqs(queue=sqs_qname).delete_message(QueueUrl=queue_url, ReceiptHandle=receipt_handle)
+
+    @property
+    def quarantine(self):
+        if self._quarantine is None:
+            sink = None
+            if self.transport_options.get('quarantine_queue'):
+                sink = QueueQuarantineSink(self, self.transport_options['quarantine_queue'])
+            elif self.transport_options.get('quarantine_path'):
+                sink = FileQuarantineSink(self.transport_options['quarantine_path'])
+            self._quarantine = Quarantine(
+                self,
+                max_receives=self.transport_options.get('quarantine_max_receives', 5),
+                sink=sink
+            )
+        return self._quarantine
 
-    def put_bulk(self, queue, messages, **kwargs):
+    def close(self):
+        if self._group_scheduler is not None:
+            dropped = self._group_scheduler.clear()
+            if dropped:
+                logger.info(f'Dropped {dropped} held messages, SQS will deliver them again')
+        if self._quarantine is not None:
+            self._quarantine.flush()
+        if self._ack_coalescer is not None:
+            self._ack_coalescer.close()
+        super().close()
+
+    def result_entry(self, entry_id, msg, group_id=None):
+        body = dumps(msg, 'json')[2]
+        # Same job and same result give the same ID, so FIFO queues drop republished results
+        dedup_id = hashlib.sha256(f'{msg["jobId"]}\0{body}'.encode()).hexdigest()
+        return {
+            'Id': entry_id,
+            'MessageBody': body,
+            'MessageGroupId': group_id or msg['taskId'],
+            'MessageDeduplicationId': dedup_id
+        }
+
+    def put_bulk(self, queue, entries, **kwargs):
+        """Send a single SendMessageBatch request of prepared result ``entries``.
+
+        Use :class:`~ergo_celery.result.publisher.ResultPublisher` to push
+        an arbitrary number of results.
+        """
         q_url = self._new_queue(queue)
-        entries = [
-            {
-                'Id': str(idx),
-                'MessageBody': dumps(msg, 'json')[2],
-                'MessageGroupId': msg['taskId'],
-                'MessageDeduplicationId': str(uuid.uuid4())
-            }
-            for idx, msg in enumerate(messages)
-        ]
-        logger.info(f'Request to push: {entries}')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'Request to push: {entries}')
         c = self.sqs(queue=self.canonical_queue_name(queue))
         resp = c.send_message_batch(QueueUrl=q_url, Entries=entries, **kwargs)
         return (resp.get('Successful', []), resp.get('Failed', []))
 
-    def _to_proto1(self, orig_payload, sqs_msg):
-        payload = dict()
-        payload.update(orig_payload)
-
-        # Set content type/encoding of the payload
-        payload.setdefault('content-type', self.DEFAULT_CONTENT_TYPE)
-        payload.setdefault('content-encoding', self.DEFAULT_CONTENT_ENCODING)
-        payload['headers'] = {}  # empty headers in Proto 1
+    def _to_proto1(self, kwargs, sqs_msg):
+        """Build the Proto 1 body of an Ergo message, whose SQS body holds the task kwargs."""
+        return {
+            'task': sqs_msg['Attributes']['MessageGroupId'],
+            'id': sqs_msg['MessageId'],
+            'kwargs': kwargs,
+        }
 
-        body = payload['body'] or '{}'
-        safe_kwargs = body # the body in ergo refers to function kwargs
-        body = loads(body, payload['content-type'], payload['content-encoding'])
-        body['task'] = sqs_msg['Attributes']['MessageGroupId']
-        body['id'] = sqs_msg['MessageId']
-        body['kwargs'] = loads(safe_kwargs, payload['content-type'], payload['content-encoding'])
-
-        # Dump the payload back to string for later deserialization by the consumer
-        _, _, payload['body'] = dumps(body, 'json')
-        return payload
+    def _ergo_to_python(self, message, kwargs, queue_name, q_url):
+        if queue_name in self._noack_queues:
+            q_url = self._new_queue(queue_name)
+            self.asynsqs(queue=queue_name).delete_message(q_url, message['ReceiptHandle'])
+        return {
+            'body': message['Body'],
+            'content-type': self.DEFAULT_CONTENT_TYPE,
+            'content-encoding': self.DEFAULT_CONTENT_ENCODING,
+            'headers': {},  # empty headers in Proto 1
+            'properties': {
+                'delivery_info': {'sqs_message': message, 'sqs_queue': q_url},
+                'delivery_tag': message['ReceiptHandle'],
+            },
+            # Handed over to the consumer as the decoded body, so it's never serialized again
+            SQSMessage.DECODED_BODY_KEY: self._to_proto1(kwargs, message),
+        }
 
     def _message_to_python(self, message, queue_name, queue):
+        if message.get('Attributes', {}).get('MessageGroupId', None):
+            body = message['Body']
+            if not body.startswith('{'):
+                body = bytes_to_str(self._optional_b64_decode(body.encode()))
+            kwargs = json_loads(body or '{}')
+            if isinstance(kwargs, dict) and 'headers' not in kwargs:
+                # Detected Ergo Protocol, so convert it to Proto 1-compatible schema
+                return self._ergo_to_python(message, kwargs, queue_name, queue)
         payload = super()._message_to_python(message, queue_name, queue)
         logger.debug(payload)
-        sqs_msg = payload['properties']['delivery_info']['sqs_message']
-        if 'headers' not in payload and sqs_msg['Attributes'].get('MessageGroupId', None):
-            # Detected Ergo Protocol, so convert it to Proto 1-compatible schema
-            payload = self._to_proto1(payload, sqs_msg)
         return payload
 
-    def _on_messages_ready(self, queue, qname, messages):
-        if 'Messages' in messages and messages['Messages']:
-            callbacks = self.connection._callbacks
-            for msg in messages['Messages']:
-                try:
-                    msg_parsed = self._message_to_python(msg, qname, queue)
-                except JSONDecodeError as e:
-                    logger.error(f'Received undecodable message', exc_info=e)
-                    continue
-                callbacks[qname](msg_parsed)
+    def _decode_messages(self, messages, queue_name, q_url):
+        payloads = []
+        quarantined = False
+        timed = metrics.enabled
+        for msg in messages:
+            try:
+                if timed:
+                    started = perf_counter()
+                    payloads.append(self._message_to_python(msg, queue_name, q_url))
+                    metrics.observe('ergo_decode_seconds', perf_counter() - started, queue=queue_name)
+                else:
+                    payloads.append(self._message_to_python(msg, queue_name, q_url))
+            except self.DECODE_ERRORS as e:
+                metrics.incr('ergo_decode_errors_total', queue=queue_name, kind=type(e).__name__)
+                logger.error(f'Received undecodable message', exc_info=e)
+                quarantined |= self.quarantine.add(msg, queue_name, q_url, e)
+        if quarantined:
+            self.quarantine.flush()
+        return payloads
+
+    def _messages_to_python(self, messages, queue):
+        return self._decode_messages(messages, queue, self._new_queue(queue))
+
+    @staticmethod
+    def _record_receive(queue, started, received):
+        if started is not None:
+            metrics.observe('ergo_receive_seconds', perf_counter() - started, queue=queue)
+        metrics.observe('ergo_receive_messages', received, queue=queue)
+        if not received:
+            metrics.incr('ergo_empty_receives_total', queue=queue)
+
+    def _on_messages_ready(self, queue, qname, messages, started=None):
+        # kombu hands an empty list over when SQS times out or fails with a 5XX
+        msgs = messages['Messages'] if isinstance(messages, dict) and 'Messages' in messages else []
+        if metrics.enabled:
+            self._record_receive(self.canonical_queue_name(qname), started, len(msgs))
+        if self.poller is not None:
+            self.poller.record(self.canonical_queue_name(qname), len(msgs))
+        if msgs:
+            self._deliver_messages(self._decode_messages(msgs, qname, queue), qname)
     
     def change_visibility_timeout(self, delivery_tag, new_visibility_timeout):
         try:
@@ -110,6 +448,51 @@ class ErgoChannel(SQS.Channel):
             VisibilityTimeout=int(new_visibility_timeout)
         )
 
+    def change_visibility_timeout_batch(self, changes):
+        """Change the visibility timeout of many messages with ChangeMessageVisibilityBatch.
+
+        Arguments:
+            changes (List[Tuple[str, int]]): delivery tags along with their new timeout.
+
+        Returns:
+            Dict[str, str]: error message of every delivery tag that failed.
+        """
+        failed = {}
+        by_queue = {}
+        for delivery_tag, new_visibility_timeout in changes:
+            try:
+                message = self.qos.get(delivery_tag).delivery_info
+                sqs_message = message['sqs_message']
+            except KeyError:
+                failed[delivery_tag] = 'Unable to get message info'
+                continue
+            queue = None
+            if 'routing_key' in message:
+                queue = self.canonical_queue_name(message['routing_key'])
+            by_queue.setdefault((message['sqs_queue'], queue), []).append(
+                (delivery_tag, sqs_message['ReceiptHandle'], int(new_visibility_timeout)))
+
+        for (q_url, queue), entries in by_queue.items():
+            c = self.sqs(queue)
+            for start in range(0, len(entries), SQS.SQS_MAX_MESSAGES):
+                batch = entries[start:start + SQS.SQS_MAX_MESSAGES]
+                try:
+                    resp = c.change_message_visibility_batch(
+                        QueueUrl=q_url,
+                        Entries=[
+                            {'Id': str(idx), 'ReceiptHandle': receipt_handle, 'VisibilityTimeout': timeout}
+                            for idx, (_, receipt_handle, timeout) in enumerate(batch)
+                        ]
+                    )
+                except Exception as e:
+                    logger.warn(f'Unable to change visibility timeout of {len(batch)} messages', exc_info=e)
+                    for delivery_tag, _, _ in batch:
+                        failed[delivery_tag] = repr(e)
+                    continue
+                for res in resp.get('Failed', []):
+                    failed[batch[int(res['Id'])][0]] = res.get('Message') or res.get('Code', 'Unknown')
+        return failed
+
 
     # TODO: Better to add the FIFO queue support in Kombu itself (reminder: Raise a PR)
     def _get_bulk(self, queue,
@@ -139,47 +522,66 @@ class ErgoChannel(SQS.Channel):
         # one message.
 
         # Note: ignoring max_messages for SQS with boto3
-        max_count = self._get_message_estimate()
+        profile = self.receive_profile(queue)
+        max_count = min(self._get_message_estimate(), profile.max_messages)
+        wait_time_seconds = profile.wait_time_seconds
+        poller = self.poller
+        if poller is not None:
+            qname = self.canonical_queue_name(queue)
+            # Queues are polled one after the other here, skip the idle ones
+            if poller.poll_delay(qname):
+                raise Empty()
+            max_count = min(max_count, poller.max_messages(qname, profile.max_messages))
+            wait_time_seconds = poller.wait_time_seconds(qname, wait_time_seconds, shared=True)
         if max_count:
-            q_url = self._new_queue(queue)
+            started = perf_counter() if metrics.enabled else None
             resp = self.sqs(queue=queue).receive_message(
-                QueueUrl=q_url, MaxNumberOfMessages=max_count,
-                WaitTimeSeconds=self.wait_time_seconds,
-                VisibilityTimeout=self.visibility_timeout,
-                AttributeNames=['MessageGroupId'])
+                QueueUrl=profile.url, MaxNumberOfMessages=max_count,
+                WaitTimeSeconds=wait_time_seconds,
+                VisibilityTimeout=profile.visibility_timeout,
+                AttributeNames=profile.attributes)
+            if started is not None:
+                self._record_receive(self.canonical_queue_name(queue), started, len(resp.get('Messages', ())))
+            if poller is not None:
+                poller.record(qname, len(resp.get('Messages', ())))
             if resp.get('Messages'):
-                for m in resp['Messages']:
-                    m['Body'] = AsyncMessage(body=m['Body']).decode()
-                for msg in self._messages_to_python(resp['Messages'], queue):
-                    self.connection._deliver(msg, queue)
+                self._deliver_messages(self._messages_to_python(resp['Messages'], queue), queue)
                 return
         raise Empty()
 
+    def _get_async(self, queue, count=1, callback=None):
+        profile = self.receive_profile(queue)
+        qname = self.canonical_queue_name(queue)
+        count = min(count, profile.max_messages)
+        if self.poller is not None:
+            count = min(count, self.poller.max_messages(qname, profile.max_messages))
+        return self._get_from_sqs(
+            queue_name=qname, queue_url=profile.url,
+            count=count,
+            connection=self.asynsqs(queue=qname),
+            callback=transform(
+                self._on_messages_ready, callback, profile.url, queue,
+                started=perf_counter() if metrics.enabled else None,
+            ),
+        )
+
     # TODO: Better to add the FIFO queue support in Kombu itself (reminder: Raise a PR)
-    def _get_from_sqs(self, queue,
-                      count=1, connection=None, callback=None):
+    def _get_from_sqs(self, queue_name, queue_url,
+                      connection, count=1, callback=None):
         """Retrieve and handle messages from SQS.
 
         Uses long polling and returns :class:`~vine.promises.promise`.
         """
-        connection = connection if connection is not None else queue.connection
-        if self.predefined_queues:
-            if queue not in self._queue_cache:
-                raise SQS.UndefinedQueueException((
-                    "Queue with name '{}' must be defined in "
-                    "'predefined_queues'."
-                ).format(queue))
-            queue_url = self._queue_cache[queue]
-        else:
-            queue_url = connection.get_queue_url(queue)
-        attributes = self.MESSAGE_ATTRIBUTES
-        # For FIFO queue, also fetch MessageGroupId attribute
-        if 'fifo' in queue_url: ## TODO: BETTER IS queue.endswith('.fifo')
-            attributes += ['MessageGroupId']
+        profile = self.receive_profile(queue_name)
+        wait_time_seconds = profile.wait_time_seconds
+        if self.poller is not None:
+            # Every queue has its own polling loop, a long wait delays no other queue
+            wait_time_seconds = self.poller.wait_time_seconds(queue_name, wait_time_seconds)
         return connection.receive_message(
-            queue, queue_url, number_messages=count,
-            attributes=attributes,
-            wait_time_seconds=self.wait_time_seconds,
+            queue_name, queue_url, number_messages=count,
+            visibility_timeout=profile.visibility_timeout,
+            attributes=profile.attributes,
+            wait_time_seconds=wait_time_seconds,
             callback=callback,
         )
 
@@ -0,0 +1,136 @@
+import heapq
+import itertools
+import threading
+import weakref
+from functools import lru_cache
+
+from celery.utils.imports import symbol_by_name
+
+MAX_VISIBILITY_TIMEOUT = 43199
+
+
+class VisibilityPolicy(object):
+    """Decides when a running task's message needs more time and how much.
+
+    ``timeout(attempt)`` is the visibility timeout granted at ``attempt`` (the
+    first one being the queue's own). The next extension is due once the task
+    ran for ``factor`` of it.
+    """
+
+    def __init__(self, init_timeout, factor=0.69, max_timeout=MAX_VISIBILITY_TIMEOUT) -> None:
+        self.init_timeout = init_timeout
+        self.factor = factor
+        self.max_timeout = max_timeout
+
+    def timeout(self, attempt):
+        raise NotImplementedError
+
+    def deadline(self, time_start, attempt):
+        return time_start + self.factor * self.timeout(attempt)
+
+    def visibility_timeout(self, attempt):
+        return min(self.timeout(attempt), self.max_timeout)
+
+
+class LinearVisibilityPolicy(VisibilityPolicy):
+    def timeout(self, attempt):
+        return attempt * self.init_timeout
+
+
+class ExponentialVisibilityPolicy(VisibilityPolicy):
+    def __init__(self, init_timeout, factor=0.69, max_timeout=MAX_VISIBILITY_TIMEOUT, base=2) -> None:
+        super().__init__(init_timeout, factor=factor, max_timeout=max_timeout)
+        self.base = base
+
+    def timeout(self, attempt):
+        return self.init_timeout * self.base ** (attempt - 1)
+
+
+VISIBILITY_POLICIES = {
+    'linear': LinearVisibilityPolicy,
+    'exponential': ExponentialVisibilityPolicy,
+}
+
+
+@lru_cache(maxsize=None)
+def _load_policy(name, init_timeout, factor):
+    clstype = VISIBILITY_POLICIES.get(name) or symbol_by_name(name)
+    return clstype(init_timeout, factor=factor)
+
+
+def get_visibility_policy(app, init_timeout) -> VisibilityPolicy:
+    """Return the policy set by ``ergo_visibility_policy``, either a known name or a 'module:Class' path."""
+    return _load_policy(
+        app.conf.get('ergo_visibility_policy', 'linear'),
+        init_timeout,
+        app.conf.get('ergo_visibility_extension_factor', 0.69)
+    )
+
+
+class VisibilityScheduler(object):
+    """Min-heap of the next visibility extension deadline of every running request."""
+
+    _schedulers = weakref.WeakKeyDictionary()  # app => scheduler
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._heap = []
+        self._entries = {}  # request => heap entry
+        self._counter = itertools.count()
+
+    @classmethod
+    def for_app(cls, app):
+        try:
+            return cls._schedulers[app]
+        except KeyError:
+            return cls._schedulers.setdefault(app, cls())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, req):
+        deadline = req.next_ping_at()
+        if deadline is None:
+            return
+        with self._lock:
+            self._discard(req)
+            entry = [deadline, next(self._counter), req]
+            self._entries[req] = entry
+            heapq.heappush(self._heap, entry)
+
+    def _discard(self, req):
+        entry = self._entries.pop(req, None)
+        if entry is not None:
+            # Removed lazily from the heap
+            entry[-1] = None
+
+    def discard(self, req):
+        with self._lock:
+            self._discard(req)
+
+    def next_deadline(self):
+        with self._lock:
+            while self._heap and self._heap[0][-1] is None:
+                heapq.heappop(self._heap)
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        """Remove and return the requests whose deadline is past ``now``."""
+        due = []
+        with self._lock:
+            while self._heap and (self._heap[0][-1] is None or self._heap[0][0] <= now):
+                _, _, req = heapq.heappop(self._heap)
+                if req is not None:
+                    del self._entries[req]
+                    due.append(req)
+        return due
+
+    def retain(self, active_requests):
+        """Drop requests that finished without being discarded, once they make up most of the heap."""
+        with self._lock:
+            if len(self._heap) <= 2 * len(active_requests) + 64:
+                return
+            for req in [req for req in self._entries if req not in active_requests]:
+                self._discard(req)
+            self._heap = [entry for entry in self._heap if entry[-1] is not None]
+            heapq.heapify(self._heap)
@@ -0,0 +1,88 @@
+import logging
+
+from celery import bootsteps
+
+from ergo_celery.result.buffer import buffer_seen_by_worker
+
+logger = logging.getLogger(__name__)
+
+
+class ResultBackpressureStep(bootsteps.StartStopStep):
+    """Pauses consumption of tasks while too many results wait to be pushed.
+
+    Polling stops once the result buffer holds ``ergo_result_buffer_high_watermark``
+    results and resumes when it's back to ``ergo_result_buffer_low_watermark``.
+    The prefetch count may also be lowered to ``ergo_backpressure_prefetch_count``
+    meanwhile. The buffer depth is reported in the worker stats.
+
+    The depth is read by the main process, so under the prefork pool the
+    results must be buffered in Redis or SQLite: results buffered in memory
+    by the pool processes can't be seen and backpressure is disabled.
+    """
+    requires = {'celery.worker.components:Timer', 'celery.worker.components:Consumer'}
+
+    def __init__(self, worker, *args, **kwargs):
+        self.tref = None
+        conf = worker.app.conf
+        self.high_watermark = conf.get('ergo_result_buffer_high_watermark')
+        self.low_watermark = conf.get('ergo_result_buffer_low_watermark', (self.high_watermark or 0) // 2)
+        self.interval = conf.get('ergo_backpressure_interval_secs', 1)
+        self.paused_prefetch_count = conf.get('ergo_backpressure_prefetch_count')
+        self.depth = 0
+        self.paused = False
+        self._prefetch_count = None
+
+    def start(self, worker):
+        if not self.high_watermark:
+            return
+        if not buffer_seen_by_worker(worker):
+            logger.warn('Results are buffered in the memory of the pool processes, '
+                        'backpressure needs a Redis or SQLite result buffer and is disabled')
+            return
+        self.tref = worker.timer.call_repeatedly(
+            self.interval, self.check_buffer, (worker,))
+
+    def stop(self, worker):
+        if self.tref:
+            self.tref.cancel()
+            self.tref = None
+
+    def info(self, worker):
+        return {'ergo': {'result_buffer_depth': self.depth, 'consumption_paused': self.paused}}
+
+    @staticmethod
+    def _channel(consumer):
+        task_consumer = getattr(consumer, 'task_consumer', None)
+        channel = getattr(task_consumer, 'channel', None)
+        return channel if hasattr(channel, 'pause_polling') else None
+
+    def check_buffer(self, worker):
+        try:
+            self.depth = worker.app.backend.buffer_depth()
+        except Exception:
+            logger.exception('Unable to get the result buffer depth')
+            return
+        if not self.paused and self.depth >= self.high_watermark:
+            self.pause(worker.consumer)
+        elif self.paused and self.depth <= self.low_watermark:
+            self.resume(worker.consumer)
+
+    def pause(self, consumer):
+        channel = self._channel(consumer)
+        if channel is None:
+            return
+        logger.warn(f'{self.depth} results are waiting to be pushed, pausing consumption')
+        channel.pause_polling()
+        if self.paused_prefetch_count is not None and consumer.qos is not None:
+            self._prefetch_count = consumer.qos.value
+            consumer.qos.set(self.paused_prefetch_count)
+        self.paused = True
+
+    def resume(self, consumer):
+        channel = self._channel(consumer)
+        if channel is not None:
+            channel.resume_polling()
+        if self._prefetch_count is not None and consumer.qos is not None:
+            consumer.qos.set(self._prefetch_count)
+            self._prefetch_count = None
+        self.paused = False
@@ -0,0 +1,114 @@
+import threading
+import uuid
+from time import time
+from typing import Dict, List, Optional, Tuple
+
+from celery.concurrency.prefork import TaskPool as PreforkPool
+
+
+def buffer_seen_by_worker(worker):
+    """Return whether the main process of ``worker`` sees the results buffered by its pool."""
+    return not issubclass(worker.pool_cls, PreforkPool) or getattr(worker.app.backend, 'buffer_shared', False)
+
+
+class ResultBuffer(object):
+    """Protocol of the buffers holding results until they're pushed to SQS.
+
+    Results are claimed in batches: a claimed batch is kept in-flight until
+    it is either acknowledged (after SQS confirmed it) or requeued (on
+    failure), so results are never lost in between. Claims that are neither
+    acknowledged nor requeued within ``claim_timeout`` are reclaimed.
+    """
+
+    #: Whether every process of the worker sees the same results
+    shared = False
+
+    def __init__(self, name, celery_app, max_size) -> None:
+        self.name = name
+        self.celery_app = celery_app
+        self.max_size = max_size
+        self.claim_timeout = celery_app.conf.get('ergo_result_buffer_claim_timeout_secs', 300)
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def put(self, msg) -> int:
+        """Buffer ``msg`` and return the number of buffered results."""
+        raise NotImplementedError
+
+    def claim(self) -> Tuple[Optional[str], List[Dict]]:
+        """Move a batch of results in-flight and return its token along with the results."""
+        raise NotImplementedError
+
+    def ack(self, token):
+        """Drop the in-flight batch once all of its results were pushed."""
+        raise NotImplementedError
+
+    def requeue(self, token, msgs=None):
+        """Put back ``msgs`` (or the whole batch) of the in-flight batch to be pushed again."""
+        raise NotImplementedError
+
+    def reclaim(self) -> int:
+        """Requeue the in-flight batches that outlived the claim timeout."""
+        raise NotImplementedError
+
+    def acquire_drain_lease(self) -> bool:
+        """Return whether this process may drain the buffer, for buffers shared between workers."""
+        return True
+
+    def release_drain_lease(self):
+        pass
+
+
+class MemoryResultBuffer(ResultBuffer):
+    def __init__(self, name, celery_app, max_size) -> None:
+        super().__init__(name, celery_app, max_size)
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Dict] = {}
+        self._claims: Dict[str, Tuple[float, List[Dict]]] = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, msg):
+        with self._lock:
+            self._pending.setdefault(msg['jobId'], msg)
+            return len(self._pending)
+
+    def claim(self):
+        with self._lock:
+            if not self._pending:
+                return None, []
+            msgs = []
+            for job_id in list(self._pending)[:self.max_size]:
+                msgs.append(self._pending.pop(job_id))
+            token = uuid.uuid4().hex
+            self._claims[token] = (time(), msgs)
+            return token, msgs
+
+    def ack(self, token):
+        with self._lock:
+            self._claims.pop(token, None)
+
+    def _requeue(self, msgs):
+        # Requeued results go first, so they are pushed by the next claim
+        pending = {msg['jobId']: msg for msg in msgs}
+        for job_id, msg in self._pending.items():
+            pending.setdefault(job_id, msg)
+        self._pending = pending
+
+    def requeue(self, token, msgs=None):
+        with self._lock:
+            _, claimed = self._claims.pop(token, (None, []))
+            self._requeue(claimed if msgs is None else msgs)
+
+    def reclaim(self):
+        deadline = time() - self.claim_timeout
+        count = 0
+        with self._lock:
+            for token, (claimed_at, msgs) in list(self._claims.items()):
+                if claimed_at <= deadline:
+                    del self._claims[token]
+                    self._requeue(msgs)
+                    count += len(msgs)
+        return count
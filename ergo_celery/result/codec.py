@@ -0,0 +1,131 @@
+import base64
+import hashlib
+import os
+import tempfile
+import zlib
+
+from celery.utils.imports import symbol_by_name
+from kombu.utils.json import dumps, loads
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+# Fields of a result meta that may be encoded: name => (parent keys, key)
+ENCODABLE_FIELDS = {
+    'data': ((), 'data'),
+    'traceback': (('metadata', 'error'), 'traceback'),
+}
+
+
+class LocalBlobStore(object):
+    """Blob store keeping offloaded payloads as files of a local directory."""
+
+    def __init__(self, celery_app) -> None:
+        self.root = celery_app.conf.get(
+            'ergo_result_blob_store_path', os.path.join(tempfile.gettempdir(), 'ergo-results'))
+        os.makedirs(self.root, exist_ok=True)
+
+    def put(self, key, value: bytes) -> str:
+        path = os.path.join(self.root, key)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(value)
+        os.replace(tmp_path, path)
+        return f'file://{path}'
+
+    def get(self, ref) -> bytes:
+        with open(ref[len('file://'):], 'rb') as fp:
+            return fp.read()
+
+
+class ResultCodec(object):
+    """Shrinks the payload of result metas before they're published.
+
+    ``data`` and the error ``traceback`` are compressed once their JSON
+    exceeds ``compress_threshold`` bytes, and the codec is recorded in the
+    meta's ``encoding``. If the meta still exceeds ``offload_threshold``
+    bytes, those fields are moved to the ``blob_store`` and only their
+    reference is kept in the meta's ``blob``.
+    """
+
+    def __init__(self, compress_threshold=None, offload_threshold=None,
+                 blob_store=None, compression='zlib', level=6) -> None:
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError('zstd compression of results requires the zstandard package')
+        if compression not in ('zlib', 'zstd'):
+            raise ValueError(f'Unknown result compression "{compression}"')
+        if offload_threshold is not None and blob_store is None:
+            raise ValueError('Offloading results requires a blob store')
+        self.compress_threshold = compress_threshold
+        self.offload_threshold = offload_threshold
+        self.blob_store = blob_store
+        self.compression = compression
+        self.level = level
+
+    @staticmethod
+    def _dumps(value) -> bytes:
+        return dumps(value).encode()
+
+    def _compress(self, raw: bytes) -> str:
+        if self.compression == 'zstd':
+            compressed = zstandard.ZstdCompressor(level=self.level).compress(raw)
+        else:
+            compressed = zlib.compress(raw, self.level)
+        return base64.b64encode(compressed).decode()
+
+    @staticmethod
+    def _decompress(encoding, value: str) -> bytes:
+        compressed = base64.b64decode(value)
+        if encoding == 'zstd':
+            return zstandard.ZstdDecompressor().decompress(compressed)
+        return zlib.decompress(compressed)
+
+    @staticmethod
+    def _parent(meta, parents):
+        for key in parents:
+            meta = meta.get(key) if isinstance(meta, dict) else None
+        return meta if isinstance(meta, dict) else None
+
+    def _fields(self, meta):
+        for name, (parents, key) in ENCODABLE_FIELDS.items():
+            parent = self._parent(meta, parents)
+            if parent is not None and parent.get(key) is not None:
+                yield name, parent, key
+
+    def encode(self, meta):
+        encoding, blobs = {}, {}
+        if self.compress_threshold is not None:
+            for name, parent, key in self._fields(meta):
+                raw = self._dumps(parent[key])
+                if len(raw) > self.compress_threshold:
+                    parent[key] = self._compress(raw)
+                    encoding[name] = self.compression
+        if encoding:
+            meta['encoding'] = encoding
+        if self.offload_threshold is not None and len(self._dumps(meta)) > self.offload_threshold:
+            for name, parent, key in self._fields(meta):
+                blob_key = hashlib.sha256(f'{meta["jobId"]}\0{name}'.encode()).hexdigest()
+                blobs[name] = self.blob_store.put(blob_key, self._dumps(parent[key]))
+                parent[key] = None
+            meta['blob'] = blobs
+        return meta
+
+    def decode(self, meta):
+        """Revert :meth:`encode`, as done by consumers of the result queue."""
+        blobs = meta.pop('blob', {})
+        encoding = meta.pop('encoding', {})
+        for name, (parents, key) in ENCODABLE_FIELDS.items():
+            parent = self._parent(meta, parents)
+            if parent is None:
+                continue
+            if name in blobs:
+                parent[key] = loads(self.blob_store.get(blobs[name]))
+            if name in encoding:
+                parent[key] = loads(self._decompress(encoding[name], parent[key]))
+        return meta
+
+
+def load_blob_store(celery_app, path):
+    return symbol_by_name(path)(celery_app)
@@ -19,3 +19,9 @@ class ResultTimerStep(bootsteps.StartStopStep):
         if self.tref:
             self.tref.cancel()
             self.tref = None
+        # Push whatever results are still waiting in this process
+        self._backend.stop_flusher()
+
+    def terminate(self, worker):
+        # A cold shutdown skips stop, and results must not be left behind either way
+        self.stop(worker)
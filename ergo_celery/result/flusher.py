@@ -0,0 +1,101 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Full, Queue
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+# Polling interval while every drain slot is busy
+BUSY_WAIT_SECS = 0.01
+
+
+class ResultFlusher(threading.Thread):
+    """Moves results to the backend's buffer and drains it in the background.
+
+    Results are handed over through a bounded queue, so storing a result never
+    waits on I/O. The buffer is drained as soon as it holds a full batch or the
+    oldest result reached ``max_age`` seconds, with up to ``concurrency`` drains
+    in flight.
+    """
+
+    def __init__(self, backend, max_age=0.2, queue_size=10000, concurrency=4) -> None:
+        super().__init__(name='ergo-result-flusher', daemon=True)
+        self.backend = backend
+        self.max_age = max_age
+        self.concurrency = max(concurrency, 1)
+        self._queue = Queue(maxsize=queue_size)
+        self._shutdown = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='ergo-result-drain')
+        self._slots = threading.BoundedSemaphore(self.concurrency)
+        self._oldest = None
+        self._size = 0
+
+    def submit(self, task_id, result) -> bool:
+        """Queue ``result`` for buffering, returning False if the queue is full."""
+        if self._shutdown.is_set():
+            return False
+        try:
+            self._queue.put_nowait((task_id, result))
+        except Full:
+            return False
+        return True
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def _next_timeout(self):
+        if self._oldest is None:
+            return self.max_age
+        return max(self._oldest + self.max_age - monotonic(), BUSY_WAIT_SECS)
+
+    def _should_flush(self):
+        if self._oldest is None:
+            return False
+        return self._size >= self.backend.max_buffer_size or monotonic() - self._oldest >= self.max_age
+
+    def _buffer(self, task_id, result):
+        size = self.backend.add_pending_result_safe(task_id, result)
+        if size is not None:
+            self._size = size
+            if self._oldest is None:
+                self._oldest = monotonic()
+
+    def _drain(self):
+        try:
+            self.backend.drain_results()
+        except Exception:
+            logger.exception('Failed draining results')
+        finally:
+            self._slots.release()
+
+    def _flush(self):
+        if not self._slots.acquire(blocking=False):
+            return
+        self._oldest = None
+        self._size = 0
+        self._executor.submit(self._drain)
+
+    def run(self):
+        while not self._shutdown.is_set():
+            try:
+                self._buffer(*self._queue.get(timeout=self._next_timeout()))
+                while not self._should_flush():
+                    self._buffer(*self._queue.get_nowait())
+            except Empty:
+                pass
+            if self._should_flush():
+                self._flush()
+
+    def stop(self, timeout=None):
+        """Stop the flusher, buffering and draining everything still queued."""
+        self._shutdown.set()
+        if self.is_alive():
+            self.join(timeout)
+        while True:
+            try:
+                self._buffer(*self._queue.get_nowait())
+            except Empty:
+                break
+        self._executor.shutdown(wait=True)
+        self.backend.drain_results(force=True)
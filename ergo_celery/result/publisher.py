@@ -0,0 +1,157 @@
+import logging
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+
+logger = logging.getLogger(__name__)
+
+# Entries of a SendMessageBatch request, as kombu.transport.SQS.SQS_MAX_MESSAGES
+# which is not imported so that loading the backend doesn't load boto3
+SQS_MAX_MESSAGES = 10
+
+# SQS rejects a SendMessageBatch request whose payloads add up to more than 256 KiB
+SQS_MAX_BATCH_BYTES = 256 * 1024
+
+# How results are spread over the FIFO message groups of the result queue
+GROUP_BY_TASK = 'task'
+GROUP_BY_JOB = 'job'
+GROUP_BY_SHARD = 'shard'
+
+
+class ResultPublisher(object):
+    """Publishes results to a SQS queue in valid batches.
+
+    Entries are packed by count and by payload size, batches are sent
+    concurrently and only the entries SQS reports as failed are retried.
+    """
+
+    def __init__(self, connection, queue, max_workers=4, max_attempts=3,
+                 retry_backoff=0.2, max_batch_bytes=SQS_MAX_BATCH_BYTES,
+                 group_by=GROUP_BY_TASK, group_shards=8) -> None:
+        if group_by not in (GROUP_BY_TASK, GROUP_BY_JOB, GROUP_BY_SHARD):
+            raise ValueError(f'Unknown result grouping "{group_by}"')
+        self.connection = connection
+        self.queue = queue
+        self.group_by = group_by
+        self.group_shards = max(group_shards, 1)
+        self.max_workers = max(max_workers, 1)
+        self.max_attempts = max(max_attempts, 1)
+        self.retry_backoff = retry_backoff
+        self.max_batch_bytes = max_batch_bytes
+        self._executor = None
+
+    @property
+    def channel(self):
+        return self.connection.default_channel
+
+    def connect(self):
+        """Open the channel now, rather than in whichever thread publishes first."""
+        return self.channel
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix='ergo-publisher')
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def group_id(self, msg):
+        if self.group_by == GROUP_BY_JOB:
+            return str(msg['jobId'])
+        if self.group_by == GROUP_BY_SHARD:
+            # Results of a job always land in the same shard, so they stay ordered
+            shard = zlib.crc32(str(msg['jobId']).encode()) % self.group_shards
+            return f'{msg["taskId"]}:{shard}'
+        return msg['taskId']
+
+    @staticmethod
+    def _entry_size(entry):
+        return len(entry['MessageBody'].encode())
+
+    def pack(self, entries):
+        """Split ``entries`` into batches valid for SendMessageBatch.
+
+        Returns a tuple of (batches, oversized) where oversized entries
+        can never be sent.
+        """
+        batches, oversized = [], []
+        batch, batch_size = [], 0
+        for entry in entries:
+            size = self._entry_size(entry)
+            if size > self.max_batch_bytes:
+                oversized.append(entry)
+                continue
+            if len(batch) >= SQS_MAX_MESSAGES or batch_size + size > self.max_batch_bytes:
+                batches.append(batch)
+                batch, batch_size = [], 0
+            batch.append(entry)
+            batch_size += size
+        if batch:
+            batches.append(batch)
+        return batches, oversized
+
+    def _send_batch(self, batch):
+        pending = {entry['Id']: entry for entry in batch}
+        sent, failed, rejected = [], {}, {}
+        for attempt in range(1, self.max_attempts + 1):
+            errors = {}
+            try:
+                successful, failures = self.channel.put_bulk(self.queue, list(pending.values()))
+            except Exception as e:
+                logger.warn(f'[{attempt}/{self.max_attempts}] Failed pushing batch of {len(pending)} results', exc_info=e)
+                errors = {entry_id: repr(e) for entry_id in pending}
+            else:
+                for res in successful:
+                    if pending.pop(res['Id'], None) is not None:
+                        sent.append(res['Id'])
+                for res in failures:
+                    error = res.get('Message') or res.get('Code', 'Unknown')
+                    if res.get('SenderFault'):
+                        # Retrying won't help when the entry itself is invalid
+                        pending.pop(res['Id'], None)
+                        rejected[res['Id']] = error
+                    else:
+                        errors[res['Id']] = error
+            if not pending:
+                break
+            if attempt < self.max_attempts:
+                sleep(self.retry_backoff * 2 ** (attempt - 1))
+        for entry_id in pending:
+            failed[entry_id] = errors.get(entry_id, 'Unknown')
+        return sent, failed, rejected
+
+    def publish(self, messages):
+        """Publish ``messages`` and return their exact outcomes.
+
+        Returns a tuple of (sent, failed, rejected) where ``sent`` is the
+        list of published messages, ``failed`` a list of (message, error)
+        tuples worth publishing again and ``rejected`` the (message, error)
+        tuples that can never be published.
+        """
+        messages = list(messages)
+        if not messages:
+            return [], [], []
+        entries = [
+            self.channel.result_entry(str(idx), msg, self.group_id(msg))
+            for idx, msg in enumerate(messages)
+        ]
+        batches, oversized = self.pack(entries)
+        rejected = [
+            (messages[int(entry['Id'])], 'Message payload exceeds the SQS batch size limit')
+            for entry in oversized
+        ]
+        if len(batches) > 1 and self.max_workers > 1:
+            results = list(self._get_executor().map(self._send_batch, batches))
+        else:
+            results = [self._send_batch(batch) for batch in batches]
+
+        sent, failed = [], []
+        for batch_sent, batch_failed, batch_rejected in results:
+            sent.extend(messages[int(entry_id)] for entry_id in batch_sent)
+            failed.extend((messages[int(entry_id)], error) for entry_id, error in batch_failed.items())
+            rejected.extend((messages[int(entry_id)], error) for entry_id, error in batch_rejected.items())
+        return sent, failed, rejected
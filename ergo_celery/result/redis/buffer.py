@@ -1,44 +1,216 @@
-from contextlib import contextmanager
+import os
+import socket
+import threading
+import uuid
 from typing import Dict, List
 
+import redis
 from kombu.connection import Connection
 from kombu.transport.redis import Channel as RedisChannel
 from kombu.utils.json import dumps, loads
 
+from ergo_celery.result.buffer import ResultBuffer
+
+# Claims are timestamped with the clock of the Redis server, the one the workers share.
+# Writing after TIME relies on the effects replication of scripts, the default since Redis 5.
+
+# KEYS: buffer list, in-flight list, claims zset | ARGV: max count
+CLAIM_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items == 0 then
+    return items
+end
+redis.call('LTRIM', KEYS[1], #items, -1)
+for i = 1, #items, 1000 do
+    redis.call('RPUSH', KEYS[2], unpack(items, i, math.min(i + 999, #items)))
+end
+local now = redis.call('TIME')
+redis.call('ZADD', KEYS[3], tonumber(now[1]) + tonumber(now[2]) / 1000000, KEYS[2])
+return items
+"""
+
+# KEYS: buffer list, in-flight list, claims zset | ARGV: results to requeue (whole batch if none)
+REQUEUE_SCRIPT = """
+local items = ARGV
+if #items == 0 then
+    items = redis.call('LRANGE', KEYS[2], 0, -1)
+end
+for i = #items, 1, -1 do
+    redis.call('LPUSH', KEYS[1], items[i])
+end
+redis.call('DEL', KEYS[2])
+redis.call('ZREM', KEYS[3], KEYS[2])
+return #items
+"""
+
+# KEYS: buffer list, claims zset, in-flight lists | ARGV: claim timeout in seconds
+RECLAIM_SCRIPT = """
+local now = redis.call('TIME')
+local expired_at = tonumber(now[1]) + tonumber(now[2]) / 1000000 - tonumber(ARGV[1])
+local count = 0
+for k = 3, #KEYS do
+    local claimed_at = redis.call('ZSCORE', KEYS[2], KEYS[k])
+    -- Claims acknowledged or requeued since they were listed are gone
+    if claimed_at and tonumber(claimed_at) <= expired_at then
+        local items = redis.call('LRANGE', KEYS[k], 0, -1)
+        for i = #items, 1, -1 do
+            redis.call('LPUSH', KEYS[1], items[i])
+        end
+        count = count + #items
+        redis.call('DEL', KEYS[k])
+        redis.call('ZREM', KEYS[2], KEYS[k])
+    end
+end
+return count
+"""
+
+# KEYS: lease | ARGV: owner, lease duration in ms
+LEASE_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+if owner == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+if not owner then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# KEYS: lease | ARGV: owner
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+_clients_lock = threading.Lock()
+_clients_pid = None
+_clients = {}  # write broker URL => (connection, channel, client) of the current process
+
+
+def get_client(celery_app, max_connections=None, pool_timeout=None):
+    """Return the process-wide Redis client of the app's write broker.
+
+    The client is backed by a bounded connection pool that connects lazily,
+    and is rebuilt in forked child processes instead of sharing the parent's sockets.
+    Once every connection is in use, callers wait up to ``pool_timeout`` seconds for one.
+    """
+    global _clients_pid
+    pid = os.getpid()
+    conn: Connection = celery_app.connection_for_write()
+    key = conn.as_uri(include_password=True)
+    with _clients_lock:
+        if _clients_pid != pid:
+            # Inherited from the parent process: don't close them, the parent still uses them
+            _clients.clear()
+            _clients_pid = pid
+        if key not in _clients:
+            channel: RedisChannel = conn.channel()
+            if not isinstance(channel, RedisChannel):
+                channel.close()
+                conn.close()
+                raise RuntimeError(f'Using Redis result buffer but write broker does not use Redis, instead {type(channel)}')
+            params = channel._connparams()
+            params.pop('max_connections', None)
+            # kombu's pool raises once it is exhausted, this one waits for a connection instead
+            pool = redis.BlockingConnectionPool(
+                max_connections=max_connections or channel.max_connections, timeout=pool_timeout, **params)
+            _clients[key] = (conn, channel, channel.Client(connection_pool=pool))
+        else:
+            conn.release()
+        return _clients[key][2]
+
+
+class RedisResultBuffer(ResultBuffer):
+    shared = True
 
-class RedisResultBuffer(object):
     def __init__(self, name, celery_app, max_size) -> None:
-        self.name = name
-        self.celery_app = celery_app
-        self.max_size = max_size
+        super().__init__(name, celery_app, max_size)
+        self.claims_key = f'{name}:claims'
+        self.lease_key = f'{name}:lease'
+        self.lease_timeout = celery_app.conf.get('ergo_result_buffer_drain_lease_secs')
+        self.max_connections = celery_app.conf.get('ergo_result_buffer_max_connections', 10)
+        self.pool_timeout = celery_app.conf.get('ergo_result_buffer_pool_timeout_secs', 10)
+        self._pid = None
+        self._redis = None
+        self._scripts = {}
+        self._owner = None
+        self._client_lock = threading.Lock()
 
-    @contextmanager
     def _client(self):
-        conn: Connection = self.celery_app.connection_for_write()
-        channel: RedisChannel = conn.channel()
-        if not isinstance(channel, RedisChannel):
-            raise RuntimeError(f'Using Redis result buffer but write broker does not use Redis, instead {type(channel)}')
-        with channel.conn_or_acquire() as client:
-            yield client
-        channel.close()
-        conn.close()
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._client_lock:
+                if self._pid != pid:
+                    self._redis = get_client(self.celery_app, self.max_connections, self.pool_timeout)
+                    self._scripts = {
+                        script: self._redis.register_script(script)
+                        for script in (CLAIM_SCRIPT, REQUEUE_SCRIPT, RECLAIM_SCRIPT, LEASE_SCRIPT, RELEASE_SCRIPT)
+                    }
+                    self._owner = f'{socket.gethostname()}:{pid}:{uuid.uuid4().hex}'
+                    # Set last, so threads skipping the lock never see a partly set up client
+                    self._pid = pid
+        return self._redis
+
+    def _script(self, script):
+        self._client()
+        return self._scripts[script]
+
+    def _claim_key(self):
+        # Evaluated on every claim since the worker may have forked since
+        return f'{self.name}:inflight:{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}'
 
     def __len__(self):
-        with self._client() as client:
-            return client.llen(self.name)
+        return self._client().llen(self.name)
 
     def put(self, msg):
-        with self._client() as client:
-            client.rpush(self.name, dumps(msg))
-
-    def clear(self) -> List[Dict]:
-        with self._client() as client:
-            with client.pipeline(transaction=True) as pipe:
-                pipe.lrange(self.name, 0, self.max_size - 1)
-                pipe.ltrim(self.name, self.max_size, -1)
-                arr, _ = pipe.execute()
-                msgs = [
-                    loads(res.decode())
-                    for res in arr
-                ]
-                return msgs
+        # RPUSH replies with the new length, so no separate LLEN round trip is needed
+        return self._client().rpush(self.name, dumps(msg))
+
+    def claim(self):
+        token = self._claim_key()
+        arr = self._script(CLAIM_SCRIPT)(
+            keys=[self.name, token, self.claims_key], args=[self.max_size])
+        if not arr:
+            return None, []
+        msgs: List[Dict] = [
+            loads(res.decode())
+            for res in arr
+        ]
+        return token, msgs
+
+    def ack(self, token):
+        with self._client().pipeline(transaction=True) as pipe:
+            pipe.delete(token)
+            pipe.zrem(self.claims_key, token)
+            pipe.execute()
+
+    def requeue(self, token, msgs=None):
+        if msgs is not None and not msgs:
+            return self.ack(token)
+        args = [dumps(msg) for msg in msgs] if msgs else []
+        self._script(REQUEUE_SCRIPT)(
+            keys=[self.name, token, self.claims_key], args=args)
+
+    def reclaim(self):
+        # The script only touches the keys it is given, so the in-flight lists are listed first
+        claims = self._client().zrange(self.claims_key, 0, -1)
+        if not claims:
+            return 0
+        return self._script(RECLAIM_SCRIPT)(
+            keys=[self.name, self.claims_key, *claims], args=[self.claim_timeout])
+
+    def acquire_drain_lease(self):
+        if not self.lease_timeout:
+            return True
+        self._client()
+        return bool(self._script(LEASE_SCRIPT)(
+            keys=[self.lease_key], args=[self._owner, int(self.lease_timeout * 1000)]))
+
+    def release_drain_lease(self):
+        if self.lease_timeout and self._pid == os.getpid():
+            self._script(RELEASE_SCRIPT)(keys=[self.lease_key], args=[self._owner])
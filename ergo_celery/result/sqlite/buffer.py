@@ -0,0 +1,246 @@
+import os
+import sqlite3
+import threading
+import uuid
+from time import monotonic, time
+
+from kombu.utils.json import dumps, loads
+
+from ergo_celery.result.buffer import ResultBuffer
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    job_id TEXT,
+    msg TEXT NOT NULL,
+    claim TEXT,
+    claimed_at REAL,
+    owner INTEGER
+);
+CREATE INDEX IF NOT EXISTS results_claim ON results (claim);
+-- Number of pending results, kept up to date by the triggers below so it isn't counted
+CREATE TABLE IF NOT EXISTS pending (count INTEGER NOT NULL);
+INSERT INTO pending (count)
+    SELECT COUNT(*) FROM results WHERE claim IS NULL AND NOT EXISTS (SELECT 1 FROM pending);
+CREATE TRIGGER IF NOT EXISTS results_insert AFTER INSERT ON results WHEN NEW.claim IS NULL
+BEGIN
+    UPDATE pending SET count = count + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS results_delete AFTER DELETE ON results WHEN OLD.claim IS NULL
+BEGIN
+    UPDATE pending SET count = count - 1;
+END;
+CREATE TRIGGER IF NOT EXISTS results_claim AFTER UPDATE OF claim ON results
+    WHEN (OLD.claim IS NULL) != (NEW.claim IS NULL)
+BEGIN
+    UPDATE pending SET count = count + (NEW.claim IS NULL) - (OLD.claim IS NULL);
+END;
+-- Lease of the process draining the buffer
+CREATE TABLE IF NOT EXISTS lease (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL);
+"""
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SQLiteResultBuffer(ResultBuffer):
+    """Result buffer kept in a SQLite database on the local disk.
+
+    The database is kept at ``ergo_result_buffer_sqlite_path``, which must
+    be set to a location surviving restarts of the host, and is shared by the
+    processes of the worker (and by the workers of the host) through its
+    write-ahead log. Committed results
+    survive the crash of the worker; the log is flushed to disk at most every
+    ``ergo_result_buffer_sqlite_fsync_interval_secs``, so only the results
+    of that interval are at risk on a power loss (``0`` flushes on every
+    commit).
+
+    Results claimed by a process which is gone are put back on startup and
+    on every reclaim, and the database is compacted every
+    ``ergo_result_buffer_sqlite_compact_interval_secs``. As with the Redis
+    buffer, ``ergo_result_buffer_drain_lease_secs`` lets a single process
+    drain the buffer at a time.
+    """
+
+    shared = True
+
+    def __init__(self, name, celery_app, max_size) -> None:
+        super().__init__(name, celery_app, max_size)
+        conf = celery_app.conf
+        self.path = conf.get('ergo_result_buffer_sqlite_path')
+        if not self.path:
+            # A temporary directory may be wiped on reboot, along with the results waiting in it
+            raise ValueError('ergo_result_buffer_sqlite_path must be set to use the SQLite result buffer')
+        self.busy_timeout = conf.get('ergo_result_buffer_sqlite_busy_timeout_secs', 30)
+        self.fsync_interval = conf.get('ergo_result_buffer_sqlite_fsync_interval_secs', 1)
+        self.compact_interval = conf.get('ergo_result_buffer_sqlite_compact_interval_secs', 60)
+        self.lease_timeout = conf.get('ergo_result_buffer_drain_lease_secs')
+        self._pid = None
+        self._conn = None
+        self._lock = None
+        self._owner = None
+        self._synced_at = 0
+        self._compacted_at = 0
+        self._connect()
+
+    def _connect(self):
+        if self._pid == os.getpid():
+            return self._conn
+        # Connections can't cross a fork, the parent's one is left alone
+        self._lock = threading.Lock()
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+        # Only applies to a new database, so that compaction can give pages back
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute(f'PRAGMA synchronous = {"NORMAL" if self.fsync_interval else "FULL"}')
+        # Created in one transaction, so the pending count of an existing database is right
+        conn.executescript(f'BEGIN IMMEDIATE; {SCHEMA} COMMIT;')
+        self._conn = conn
+        self._owner = f'{os.getpid()}:{uuid.uuid4().hex}'
+        self._pid = os.getpid()
+        self._synced_at = monotonic()
+        with self._lock:
+            self._requeue_orphans()
+        return conn
+
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        return conn
+
+    def _requeue(self, where, params=()):
+        return self._conn.execute(
+            f'UPDATE results SET claim = NULL, claimed_at = NULL, owner = NULL WHERE {where}', params).rowcount
+
+    def _requeue_orphans(self):
+        """Put back the results claimed by processes which are gone, e.g. before a crash."""
+        owners = [owner for owner, in self._conn.execute(
+            'SELECT DISTINCT owner FROM results WHERE claim IS NOT NULL')]
+        dead = [owner for owner in owners if owner is None or not _process_alive(owner)]
+        if not dead:
+            return 0
+        conn = self._transaction()
+        try:
+            count = sum(
+                self._requeue('claim IS NOT NULL AND owner IS ?', (owner,))
+                for owner in dead
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return count
+
+    def _sync(self):
+        """Flush the write-ahead log to disk if it wasn't within the fsync interval."""
+        if not self.fsync_interval or monotonic() - self._synced_at < self.fsync_interval:
+            return
+        try:
+            fd = os.open(f'{self.path}-wal', os.O_RDONLY)
+        except FileNotFoundError:
+            return
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self._synced_at = monotonic()
+
+    def _pending(self):
+        return self._conn.execute('SELECT count FROM pending').fetchone()[0]
+
+    def __len__(self):
+        self._connect()
+        with self._lock:
+            return self._pending()
+
+    def put(self, msg):
+        conn = self._connect()
+        with self._lock:
+            conn.execute('INSERT INTO results (job_id, msg) VALUES (?, ?)', (msg.get('jobId'), dumps(msg)))
+            self._sync()
+            return self._pending()
+
+    def claim(self):
+        token = uuid.uuid4().hex
+        self._connect()
+        with self._lock:
+            conn = self._transaction()
+            try:
+                rows = conn.execute(
+                    'SELECT id, msg FROM results WHERE claim IS NULL ORDER BY id LIMIT ?', (self.max_size,)).fetchall()
+                if rows:
+                    # Pending results are claimed in order, so the batch is every one up to its last id
+                    conn.execute(
+                        'UPDATE results SET claim = ?, claimed_at = ?, owner = ? WHERE claim IS NULL AND id <= ?',
+                        (token, time(), os.getpid(), rows[-1][0]))
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        if not rows:
+            return None, []
+        return token, [loads(msg) for _, msg in rows]
+
+    def ack(self, token):
+        conn = self._connect()
+        with self._lock:
+            conn.execute('DELETE FROM results WHERE claim = ?', (token,))
+
+    def requeue(self, token, msgs=None):
+        self._connect()
+        with self._lock:
+            if msgs is None:
+                self._requeue('claim = ?', (token,))
+                return
+            conn = self._transaction()
+            try:
+                # Requeued results keep their id, so they are pushed by the next claim
+                ids = dict(conn.execute('SELECT job_id, id FROM results WHERE claim = ?', (token,)))
+                conn.execute('DELETE FROM results WHERE claim = ?', (token,))
+                conn.executemany(
+                    'INSERT INTO results (id, job_id, msg) VALUES (?, ?, ?)',
+                    [(ids.pop(msg.get('jobId'), None), msg.get('jobId'), dumps(msg)) for msg in msgs])
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+
+    def reclaim(self):
+        self._connect()
+        with self._lock:
+            count = self._requeue('claim IS NOT NULL AND claimed_at <= ?', (time() - self.claim_timeout,))
+            count += self._requeue_orphans()
+            if monotonic() - self._compacted_at >= self.compact_interval:
+                self._compact()
+        return count
+
+    def acquire_drain_lease(self):
+        if not self.lease_timeout:
+            return True
+        self._connect()
+        now = time()
+        with self._lock:
+            # Renewed by its owner, taken over by another process once expired
+            return bool(self._conn.execute(
+                'INSERT INTO lease (name, owner, expires_at) VALUES (?, ?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at '
+                'WHERE owner = excluded.owner OR expires_at <= ?',
+                (self.name, self._owner, now + self.lease_timeout, now)).rowcount)
+
+    def release_drain_lease(self):
+        if self.lease_timeout and self._pid == os.getpid():
+            with self._lock:
+                self._conn.execute('DELETE FROM lease WHERE name = ? AND owner = ?', (self.name, self._owner))
+
+    def _compact(self):
+        """Give back the pages of acknowledged results and truncate the write-ahead log."""
+        self._conn.execute('PRAGMA incremental_vacuum')
+        self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self._compacted_at = monotonic()
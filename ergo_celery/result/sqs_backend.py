@@ -1,11 +1,18 @@
+import os
+import threading
 from datetime import datetime
-from importlib import __import__
+from time import perf_counter, time
 
+from celery import signals
 from celery.backends.base import Backend
+from celery.utils.imports import symbol_by_name
 from celery.utils.log import get_logger
-from kombu.transport.SQS import SQS_MAX_MESSAGES
 
-from ergo_celery.request.transport import SQSTransport
+from ergo_celery.metrics import metrics
+from ergo_celery.result.buffer import MemoryResultBuffer
+from ergo_celery.result.codec import ResultCodec, load_blob_store
+from ergo_celery.result.flusher import ResultFlusher
+from ergo_celery.result.publisher import SQS_MAX_MESSAGES, ResultPublisher
 
 logger = get_logger(__name__)
 
@@ -22,61 +29,187 @@ RESULT_BUFFER_NAME = 'ergo.results'
 class SQSBackend(Backend):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        # Shared by the threads of a process, so they share one buffer and one flusher
+        self.thread_safe = True
         self.max_buffer_size = self.app.conf.get('ergo_result_buffer_size', SQS_MAX_MESSAGES)
         self._buffer_cls: str = self.app.conf.get('ergo_result_buffer_cls')
-        if self._buffer_cls:
-            self._setup_buffer()
-        self._pending_results = {}
+        self._setup_buffer()
+        self._codec = self._setup_codec()
         self._connection = self.connection_for_write()
+        self._publisher = ResultPublisher(
+            self._connection, self.as_name(),
+            max_workers=self.app.conf.get('ergo_result_publish_concurrency', 4),
+            max_attempts=self.app.conf.get('ergo_result_publish_max_attempts', 3),
+            retry_backoff=self.app.conf.get('ergo_result_publish_retry_backoff_secs', 0.2),
+            group_by=self.app.conf.get('ergo_result_group_by', 'task'),
+            group_shards=self.app.conf.get('ergo_result_group_shards', 8)
+        )
+        self._publisher.connect()
+        self.reclaim_interval = self.app.conf.get('ergo_result_buffer_reclaim_interval_secs', 30)
+        self._last_reclaim = 0
+        self._flusher_enabled = self.app.conf.get('ergo_result_flusher_enabled', True)
+        self._flusher = None
+        self._flusher_pid = None
+        self._flusher_stopped_pid = None
+        self._flusher_lock = threading.Lock()
+        signals.worker_process_shutdown.connect(self._on_process_shutdown, weak=False)
 
     def _setup_buffer(self):
-        try:
-            module, cls = self._buffer_cls.split(':')
-            clstype = getattr(__import__(module, fromlist=(cls,)), cls)
-            self._buffer = clstype(RESULT_BUFFER_NAME, self.app, max_size=self.max_buffer_size)
-        except (ImportError, AttributeError):
-            logger.exception('Unable to import custom buffer class')
-            self._buffer_cls = None
+        if self._buffer_cls:
+            try:
+                self._buffer = symbol_by_name(self._buffer_cls)(RESULT_BUFFER_NAME, self.app, max_size=self.max_buffer_size)
+                return
+            except (ImportError, AttributeError):
+                logger.exception('Unable to import custom buffer class')
+                self._buffer_cls = None
+        self._buffer = MemoryResultBuffer(RESULT_BUFFER_NAME, self.app, max_size=self.max_buffer_size)
+
+    def _setup_codec(self):
+        compress_threshold = self.app.conf.get('ergo_result_compress_threshold_bytes')
+        offload_threshold = self.app.conf.get('ergo_result_offload_threshold_bytes')
+        if compress_threshold is None and offload_threshold is None:
+            return None
+        blob_store = None
+        if offload_threshold is not None:
+            blob_store = load_blob_store(self.app, self.app.conf.get(
+                'ergo_result_blob_store_cls', 'ergo_celery.result.codec:LocalBlobStore'))
+        return ResultCodec(
+            compress_threshold=compress_threshold,
+            offload_threshold=offload_threshold,
+            blob_store=blob_store,
+            compression=self.app.conf.get('ergo_result_compression', 'zlib')
+        )
 
     def connection_for_write(self):
+        # Imported here, so importing the backend doesn't load boto3
+        from ergo_celery.request.transport import SQSTransport
         return self.ensure_connected(
             self.app.connection_for_write(self.as_uri(), transport=SQSTransport))
 
     def ensure_connected(self, conn):
         return conn.ensure_connection()
 
+    def warm_up(self):
+        """Resolve the result queue and create its SQS client ahead of the first push."""
+        channel = self._publisher.channel
+        queue = self.as_name()
+        channel._new_queue(queue)
+        channel.sqs(queue=channel.canonical_queue_name(queue))
+
+    def buffer_depth(self):
+        """Number of results waiting to be pushed, as seen from this process."""
+        depth = len(self._buffer)
+        if self._flusher is not None and self._flusher_pid == os.getpid():
+            depth += self._flusher.qsize()
+        return depth
+
+    @property
+    def buffer_shared(self):
+        return self._buffer.shared
+
     def should_clear_buffer(self):
-        cur_size = len(self._buffer) if self._buffer_cls else len(self._pending_results)
-        return cur_size >= self.max_buffer_size
+        return len(self._buffer) >= self.max_buffer_size
+
+    @property
+    def flusher(self):
+        # Results are stored by the process executing the task, so each pool process runs its own flusher
+        if self._flusher_stopped_pid == os.getpid():
+            return None
+        if self._flusher_pid != os.getpid():
+            with self._flusher_lock:
+                if self._flusher_pid != os.getpid():
+                    self._flusher = ResultFlusher(
+                        self,
+                        max_age=self.app.conf.get('ergo_result_max_age_secs', 0.2),
+                        queue_size=self.app.conf.get('ergo_result_queue_size', 10000),
+                        concurrency=self.app.conf.get('ergo_result_flush_concurrency', 4)
+                    )
+                    self._flusher.start()
+                    self._flusher_pid = os.getpid()
+        return self._flusher
 
-    def drain_results(self):
+    def stop_flusher(self):
+        with self._flusher_lock:
+            # No flusher is started again in this process
+            self._flusher_stopped_pid = os.getpid()
+        if self._flusher is not None and self._flusher_pid == os.getpid():
+            self._flusher.stop()
+            self._flusher = None
+            self._flusher_pid = None
+        try:
+            self._buffer.release_drain_lease()
+        except Exception:
+            logger.exception('Unable to release the drain lease')
+
+    def _on_process_shutdown(self, **kwargs):
+        try:
+            self.stop_flusher()
+        except Exception:
+            logger.exception('Failed flushing results on shutdown')
+
+    def _reclaim_results(self):
+        if time() - self._last_reclaim < self.reclaim_interval:
+            return
+        self._last_reclaim = time()
+        try:
+            reclaimed = self._buffer.reclaim()
+        except Exception:
+            logger.exception('Unable to reclaim expired results')
+        else:
+            if reclaimed:
+                logger.warn(f'Reclaimed {reclaimed} results of expired claims')
+
+    def drain_results(self, force=False):
         logger.debug('Checking any results to push...')
-        msgs = self._buffer.clear() if self._buffer_cls else self._pending_results.values()
+        if not force and not self._buffer.acquire_drain_lease():
+            logger.debug('Results are drained by another worker.')
+            return
+        self._reclaim_results()
+        started = perf_counter()
+        while self._drain_batch():
+            pass
+        metrics.observe('ergo_result_drain_seconds', perf_counter() - started)
+
+    def _drain_batch(self):
+        """Push one claimed batch of results, returning whether more may be pending."""
+        token, msgs = self._buffer.claim()
         if not msgs:
             logger.debug('Nothing to push.')
-            return
+            return False
         try:
-            success, failures = self._connection.default_channel.put_bulk(self.as_name(), msgs)
-            if failures:
-                raise RuntimeError(f'{failures}')
+            success, failures, rejected = self._publisher.publish(msgs)
         except Exception as e:
             logger.error('Failed pushing results', exc_info=e)
-        else:
-            logger.info(f'Successfully pushed {len(success)} results!')
-            self._pending_results.clear()
-
-    def _add_pending_result_to_mem(self, task_id, result):
-        if task_id not in self._pending_results:
-            self._pending_results[task_id] = result
-
-    def _add_pending_result_to_redis(self, task_id, result):
-        self._buffer.put(result)
+            success, failures, rejected = [], [(msg, repr(e)) for msg in msgs], []
+        if success:
+            logger.debug(f'Successfully pushed {len(success)} results!')
+            metrics.incr('ergo_results_published_total', len(success))
+        if rejected:
+            # Never requeued, they would be rejected again and hold back the results behind them
+            metrics.incr('ergo_results_rejected_total', len(rejected))
+            for msg, error in rejected:
+                logger.error(f'Dropping result of job {msg.get("jobId")} rejected by SQS: {error}')
+        if failures:
+            metrics.incr('ergo_result_publish_failures_total', len(failures))
+            logger.error(f'Failed pushing {len(failures)} results: {[error for _, error in failures]}')
+            self._buffer.requeue(token, [msg for msg, _ in failures])
+            return False
+        self._buffer.ack(token)
+        return len(msgs) >= self.max_buffer_size
 
     def add_pending_result(self, task_id, result):
-        if self._buffer_cls:
-            self._add_pending_result_to_redis(task_id, result)
-        else:
-            self._add_pending_result_to_mem(task_id, result)
+        return self._buffer.put(result)
+
+    def add_pending_result_safe(self, task_id, result):
+        """Buffer ``result``, retrying on failure, and return the buffer size (None if it failed)."""
+        retry_limit = 3
+        current_retry_attempt = 1
+        while current_retry_attempt <= retry_limit:
+            try:
+                return self.add_pending_result(task_id, result)
+            except Exception as ex:
+                logger.exception(f'[{current_retry_attempt}/{retry_limit}] Failed to add pending result')
+            current_retry_attempt += 1
 
     def _get_result_state(self, state, data):
         result = STATUS_MAPPING[state]
@@ -112,17 +245,15 @@ class SQSBackend(Backend):
             logger.info(f'Task "{task_id}" marked as {state}. Ignoring...')
             return
         meta = self._get_result_meta(task_id, result, state, traceback, request)
-
-        retry_limit = 3
-        current_retry_attempt = 1
-        while current_retry_attempt <= retry_limit:
-            try:
-                self.add_pending_result(task_id, meta)
-            except Exception as ex:
-                logger.exception(f'[{current_retry_attempt}/{retry_limit}] Failed to add pending result')
-            else:
-                break
-            current_retry_attempt += 1
+        if self._codec is not None:
+            meta = self._codec.encode(meta)
+        flusher = self.flusher if self._flusher_enabled else None
+        if flusher is not None and flusher.submit(task_id, meta):
+            return
+        self.add_pending_result_safe(task_id, meta)
+        if self._flusher_enabled and flusher is None:
+            # Stored after the flusher stopped, by a task ending while the worker shuts down
+            self.drain_results(force=True)
 
     def as_uri(self, include_password=True):
         return self.url.split('://', 1)[1]
@@ -0,0 +1,11 @@
+"""JSON decoding used on the hot path, backed by orjson when it is installed."""
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+if orjson is not None:
+    # orjson.JSONDecodeError subclasses json.JSONDecodeError
+    loads = orjson.loads
+else:
+    from json import loads  # noqa: F401
@@ -0,0 +1,68 @@
+import logging
+from time import perf_counter
+
+from celery import bootsteps, signals
+
+logger = logging.getLogger(__name__)
+
+
+def warm_up_broker(app, queues=()):
+    """Create the SQS clients of every predefined queue and resolve the URL of ``queues``.
+
+    Returns the number of queues warmed up.
+    """
+    # Imported here, so importing this module doesn't load boto3
+    from kombu.transport.SQS import Channel
+
+    with app.connection_for_read() as conn:
+        channel = conn.default_channel
+        if not isinstance(channel, Channel):
+            return 0
+        for queue in queues:
+            channel._new_queue(queue)
+        names = set(channel.predefined_queues) or {channel.canonical_queue_name(queue) for queue in queues}
+        for name in names:
+            channel.sqs(queue=name)
+        return len(names)
+
+
+def warm_up_backend(app):
+    warm_up = getattr(app.backend, 'warm_up', None)
+    if warm_up is not None:
+        warm_up()
+
+
+class WarmupStep(bootsteps.Step):
+    """Creates the SQS clients and resolves the queue URLs before the worker starts.
+
+    Runs while the worker is built, before the pool forks, so that child
+    processes inherit the loaded clients. Each child then warms up its
+    result queue client before running its first task, which only costs a
+    connection pool of its own. Disabled with ``ergo_warmup_enabled``.
+    """
+
+    def __init__(self, worker, **kwargs):
+        self.app = worker.app
+        self.enabled = worker.app.conf.get('ergo_warmup_enabled', True)
+
+    def create(self, worker):
+        app = self.app
+        started = perf_counter()
+        queues = [queue.name for queue in app.amqp.queues.consume_from.values()]
+        try:
+            count = warm_up_broker(app, queues)
+        except Exception:
+            logger.exception('Unable to warm up the SQS clients of the broker')
+            count = 0
+        try:
+            warm_up_backend(app)
+        except Exception:
+            logger.exception('Unable to warm up the result backend')
+        logger.info(f'Warmed up the SQS clients of {count} queues in {perf_counter() - started:.3f}s')
+        signals.worker_process_init.connect(self._on_process_init, weak=False)
+
+    def _on_process_init(self, **kwargs):
+        try:
+            warm_up_backend(self.app)
+        except Exception:
+            logger.exception('Unable to warm up the result backend')
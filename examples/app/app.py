@@ -2,8 +2,11 @@ from celery import Celery
 from celery import Task
 from kombu.transport import TRANSPORT_ALIASES
 
+from ergo_celery.metrics import MetricsStep
 from ergo_celery.request.ping_timer import SQSPingTimerStep
+from ergo_celery.result.backpressure import ResultBackpressureStep
 from ergo_celery.result.drain_timer import ResultTimerStep
+from ergo_celery.warmup import WarmupStep
 
 from . import config
 
@@ -20,3 +23,6 @@ app = Celery("app", task_cls=CeleryTask)
 app.config_from_object(config)
 app.steps['worker'].add(ResultTimerStep)
 app.steps['worker'].add(SQSPingTimerStep)
+app.steps['worker'].add(ResultBackpressureStep)
+app.steps['worker'].add(MetricsStep)
+app.steps['worker'].add(WarmupStep)
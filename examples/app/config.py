@@ -31,3 +31,6 @@ result_backend = 'ergo_celery.result.sqs_backend:SQSBackend://http://localhost:9
 ergo_result_buffer_size = 2
 ergo_result_buffer_cls = 'ergo_celery.result.redis.buffer:RedisResultBuffer'
 ergo_result_buffer_timeout_secs = 5
+ergo_result_buffer_high_watermark = 1000
+ergo_result_buffer_low_watermark = 200
+ergo_metrics_exporter = 'ergo_celery.metrics:PrometheusExporter'
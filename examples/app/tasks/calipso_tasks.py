@@ -1,5 +1,7 @@
 from time import sleep
 
+from ergo_celery.request.batch import BatchTask
+
 from ..app import app
 
 
@@ -9,3 +11,14 @@ def function(noOfDays=None):
     sleep(30)
     if noOfDays == 0:
         raise Exception('noOfDays is 0')
+
+
+@app.task(base=BatchTask, name='calipso.lookup', batch_size=20, batch_linger_ms=100)
+def lookup(kwargs_list):
+    print(f'Task called for {len(kwargs_list)} messages')
+    sleep(1)
+    # Only the messages whose noOfDays is 0 fail
+    return [
+        Exception('noOfDays is 0') if kwargs.get('noOfDays') == 0 else {'noOfDays': kwargs.get('noOfDays')}
+        for kwargs in kwargs_list
+    ]
@@ -0,0 +1,70 @@
+import socket
+import threading
+
+import pytest
+from celery import Celery
+from kombu import Connection
+
+REQUEST_QUEUE = 'fifo_req_tests'
+RESULT_QUEUE = 'fifo_res_tests'
+
+
+@pytest.fixture(scope='session')
+def redis_url():
+    redis = pytest.importorskip('redis')
+    fakeredis = pytest.importorskip('fakeredis')
+    from ergo_celery.result.redis.buffer import (CLAIM_SCRIPT, LEASE_SCRIPT,
+                                                 RECLAIM_SCRIPT,
+                                                 RELEASE_SCRIPT,
+                                                 REQUEUE_SCRIPT)
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    server = fakeredis.TcpFakeServer(('127.0.0.1', port), server_type='redis')
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # The fake server drops the connection on any error reply, NOSCRIPT included
+    client = redis.Redis(host='127.0.0.1', port=port)
+    for script in (CLAIM_SCRIPT, REQUEUE_SCRIPT, RECLAIM_SCRIPT, LEASE_SCRIPT, RELEASE_SCRIPT):
+        client.script_load(script)
+    client.close()
+    yield f'redis://127.0.0.1:{port}/0'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def app():
+    return Celery('tests', set_as_current=False)
+
+
+@pytest.fixture
+def fake_sqs():
+    fake_sqs = pytest.importorskip('benchmarks.fake_sqs')
+    fake = fake_sqs.FakeSQS([REQUEST_QUEUE, RESULT_QUEUE], max_wait=0)
+    fake_sqs.install(fake)
+    yield fake
+    fake_sqs.install(None)
+
+
+@pytest.fixture
+def transport_options():
+    from benchmarks.fake_sqs import BASE_URL
+    return {
+        'predefined_queues': {
+            name: {'url': f'{BASE_URL}/{name}'} for name in (REQUEST_QUEUE, RESULT_QUEUE)
+        },
+    }
+
+
+@pytest.fixture
+def connection(fake_sqs, transport_options):
+    from benchmarks.fake_sqs import FakeSQSTransport
+    with Connection('fakesqs://', transport=FakeSQSTransport, transport_options=transport_options) as conn:
+        yield conn
+
+
+@pytest.fixture
+def channel(connection):
+    return connection.default_channel
@@ -0,0 +1,59 @@
+import threading
+from time import sleep
+
+from ergo_celery.request.ack import AckCoalescer
+
+
+class StubSQS(object):
+    def __init__(self) -> None:
+        self.deleted = []
+        self.sent = threading.Event()
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.deleted.extend(entry['ReceiptHandle'] for entry in Entries)
+        self.sent.set()
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+
+class StubChannel(object):
+    def __init__(self) -> None:
+        self.client = StubSQS()
+
+    def sqs(self, queue=None):
+        return self.client
+
+
+def test_deletes_are_sent_after_linger():
+    channel = StubChannel()
+    coalescer = AckCoalescer(channel, linger=0.05)
+    try:
+        coalescer.add('url', 'queue', 'first')
+        assert channel.client.sent.wait(1)
+        channel.client.sent.clear()
+        # Once everything was sent, the next delete must still be sent after the linger
+        sleep(0.2)
+        coalescer.add('url', 'queue', 'second')
+        assert channel.client.sent.wait(1)
+        assert channel.client.deleted == ['first', 'second']
+    finally:
+        coalescer.close(timeout=1)
+
+
+def test_full_batches_are_sent_right_away():
+    channel = StubChannel()
+    coalescer = AckCoalescer(channel, linger=60)
+    try:
+        for idx in range(10):
+            coalescer.add('url', 'queue', str(idx))
+        assert channel.client.sent.wait(1)
+        assert channel.client.deleted == [str(idx) for idx in range(10)]
+    finally:
+        coalescer.close(timeout=1)
+
+
+def test_close_sends_pending_deletes():
+    channel = StubChannel()
+    coalescer = AckCoalescer(channel, linger=60)
+    coalescer.add('url', 'queue', 'pending')
+    coalescer.close(timeout=1)
+    assert channel.client.deleted == ['pending']
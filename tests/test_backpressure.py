@@ -0,0 +1,29 @@
+from types import SimpleNamespace
+
+import pytest
+from celery.concurrency.prefork import TaskPool as PreforkPool
+from celery.concurrency.thread import TaskPool as ThreadPool
+
+from ergo_celery.result.backpressure import ResultBackpressureStep
+
+
+class StubTimer(object):
+    def call_repeatedly(self, secs, fun, args=()):
+        return SimpleNamespace(fun=fun, cancel=lambda: None)
+
+
+@pytest.mark.parametrize('pool_cls, buffer_shared, enabled', [
+    (PreforkPool, False, False),
+    (PreforkPool, True, True),
+    (ThreadPool, False, True),
+])
+def test_enabled_when_buffer_is_seen(app, pool_cls, buffer_shared, enabled):
+    app.conf.ergo_result_buffer_high_watermark = 100
+    worker = SimpleNamespace(
+        app=SimpleNamespace(conf=app.conf, backend=SimpleNamespace(buffer_shared=buffer_shared)),
+        pool_cls=pool_cls,
+        timer=StubTimer(),
+    )
+    step = ResultBackpressureStep(worker)
+    step.start(worker)
+    assert (step.tref is not None) == enabled
@@ -0,0 +1,172 @@
+import threading
+import uuid
+from types import SimpleNamespace
+
+import pytest
+from celery import signals, states
+from celery._state import get_current_app
+from celery.exceptions import Ignore, Retry
+from billiard.einfo import ExceptionWithTraceback
+from celery.utils.timer2 import Timer
+
+from ergo_celery.request.batch import Batcher, BatchTask, RequestBatch, trace_batch
+from ergo_celery.request.heartbeat import heartbeat
+
+
+@pytest.fixture
+def app(app):
+    app.conf.result_backend = 'cache+memory://'
+    current = get_current_app()
+    app.set_current()
+    yield app
+    current.set_current()
+
+
+@pytest.fixture
+def calls():
+    return []
+
+
+@pytest.fixture
+def lookup(app, calls):
+    @app.task(base=BatchTask, name='tests.lookup', shared=False)
+    def lookup(kwargs_list):
+        calls.append(lookup.request)
+        return [kwargs['result'] for kwargs in kwargs_list]
+
+    return lookup
+
+
+def exception(einfo):
+    exc = einfo.exception
+    return exc.exc if isinstance(exc, ExceptionWithTraceback) else exc
+
+
+def trace(task, *kwargs_list):
+    """Trace a batch of ``task``, returning the ids of its items and their outcomes."""
+    # Results of every test are kept by the same in-memory cache
+    ids = [uuid.uuid4().hex for _ in kwargs_list]
+    items = [(task_id, {'task': task.name}, kwargs) for task_id, kwargs in zip(ids, kwargs_list)]
+    return ids, trace_batch(task.name, items, hostname='worker')
+
+
+def test_results_are_stored_per_item(app, lookup, calls):
+    prerun, postrun = [], []
+
+    def on_prerun(task_id, **kwargs):
+        prerun.append(task_id)
+
+    def on_postrun(task_id, state, **kwargs):
+        postrun.append((task_id, state))
+
+    signals.task_prerun.connect(on_prerun, sender=lookup)
+    signals.task_postrun.connect(on_postrun, sender=lookup)
+    try:
+        ids, outcomes = trace(lookup, {'result': 1}, {'result': ValueError('bad')}, {'result': 3})
+    finally:
+        signals.task_prerun.disconnect(on_prerun, sender=lookup)
+        signals.task_postrun.disconnect(on_postrun, sender=lookup)
+    assert [failed for failed, _, _ in outcomes] == [0, 1, 0]
+    assert isinstance(exception(outcomes[1][1]), ValueError)
+    assert [app.AsyncResult(task_id).state for task_id in ids] == [states.SUCCESS, states.FAILURE, states.SUCCESS]
+    assert app.AsyncResult(ids[2]).result == 3
+    assert len(calls) == 1
+    assert prerun == ids
+    assert postrun == list(zip(ids, [states.SUCCESS, states.FAILURE, states.SUCCESS]))
+
+
+def test_the_task_runs_with_the_request_of_the_batch(app, lookup, calls):
+    ids, _ = trace(lookup, {'result': 1}, {'result': 2})
+    request = calls[0]
+    assert request.id == ids[0]
+    assert request.batch_ids == ids
+    assert lookup.request.id is None
+
+
+def test_heartbeats_can_be_sent_from_a_batch(app, calls):
+    @app.task(base=BatchTask, name='tests.beating', shared=False)
+    def beating(kwargs_list):
+        heartbeat(0.5)
+        return [None for _ in kwargs_list]
+
+    _, outcomes = trace(beating, {})
+    assert outcomes[0][0] == 0
+
+
+def test_ignored_batches_store_no_result(app, calls):
+    @app.task(base=BatchTask, name='tests.ignoring', shared=False)
+    def ignoring(kwargs_list):
+        raise Ignore()
+
+    ids, outcomes = trace(ignoring, {}, {})
+    assert all(failed and isinstance(exception(einfo), Ignore) for failed, einfo, _ in outcomes)
+    assert app.AsyncResult(ids[0]).state == states.PENDING
+
+
+def test_retried_items_are_marked_for_retry(app, lookup):
+    ids, outcomes = trace(lookup, {'result': 1}, {'result': Retry(exc=ValueError('later'))})
+    assert isinstance(exception(outcomes[1][1]), Retry)
+    assert app.AsyncResult(ids[1]).state == states.RETRY
+
+
+def request(group):
+    return SimpleNamespace(message=SimpleNamespace(delivery_info={
+        'sqs_message': {'Attributes': {'MessageGroupId': group}}}))
+
+
+class BatcherTask(object):
+    batch_size = 3
+    batch_linger_ms = 50
+
+
+@pytest.fixture
+def timer():
+    timer = Timer()
+    yield timer
+    timer.stop()
+
+
+def test_full_batches_are_handed_over(timer):
+    batches = []
+    batcher = Batcher(BatcherTask(), SimpleNamespace(timer=timer), batches.append)
+    requests = [request('a') for _ in range(4)]
+    for req in requests:
+        batcher.add(req)
+    assert [batch.requests for batch in batches] == [requests[:3]]
+
+
+def test_batches_are_handed_over_after_linger(timer):
+    handed = threading.Semaphore(0)
+    batches = []
+
+    def handle(batch):
+        batches.append(batch)
+        handed.release()
+
+    batcher = Batcher(BatcherTask(), SimpleNamespace(timer=timer), handle)
+    first, second = request('a'), request('b')
+    batcher.add(first)
+    batcher.add(second)
+    assert handed.acquire(timeout=1)
+    assert handed.acquire(timeout=1)
+    assert sorted(batches, key=lambda batch: batch.requests[0] is second)[0].requests == [first]
+    assert [len(batch.requests) for batch in batches] == [1, 1]
+    assert all(isinstance(batch, RequestBatch) for batch in batches)
+
+
+def test_stale_timers_leave_the_next_batch_alone():
+    batches, timers = [], []
+
+    def call_after(secs, fun, args):
+        timers.append((fun, args))
+        return SimpleNamespace(cancel=lambda: None)
+
+    batcher = Batcher(BatcherTask(), SimpleNamespace(timer=SimpleNamespace(call_after=call_after)), batches.append)
+    batcher.add(request('a'))
+    batcher.add(request('a'))
+    batcher.add(request('a'))
+    batcher.add(request('a'))
+    # The timer of the first batch fires while the second one is collected
+    fun, args = timers[0]
+    fun(*args)
+    assert [len(batch.requests) for batch in batches] == [3]
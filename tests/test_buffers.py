@@ -0,0 +1,135 @@
+import uuid
+from time import sleep
+
+import pytest
+
+from ergo_celery.result.buffer import MemoryResultBuffer
+from ergo_celery.result.redis.buffer import RedisResultBuffer
+from ergo_celery.result.sqlite.buffer import SQLiteResultBuffer
+
+
+@pytest.fixture(params=['memory', 'redis', 'sqlite'])
+def buffer(request, app, tmp_path):
+    name = f'results-{uuid.uuid4().hex}'
+    if request.param == 'redis':
+        app.conf.broker_write_url = request.getfixturevalue('redis_url')
+        return RedisResultBuffer(name, app, max_size=3)
+    if request.param == 'sqlite':
+        app.conf.ergo_result_buffer_sqlite_path = str(tmp_path / 'results.sqlite3')
+        return SQLiteResultBuffer(name, app, max_size=3)
+    return MemoryResultBuffer(name, app, max_size=3)
+
+
+def job_ids(msgs):
+    return [msg['jobId'] for msg in msgs]
+
+
+def fill(buffer, count):
+    for idx in range(count):
+        buffer.put({'jobId': str(idx)})
+
+
+def test_put_returns_the_buffered_count(buffer):
+    assert [buffer.put({'jobId': str(idx)}) for idx in range(3)] == [1, 2, 3]
+    assert len(buffer) == 3
+
+
+def test_claim_takes_a_batch_in_order(buffer):
+    fill(buffer, 5)
+    token, msgs = buffer.claim()
+    assert token is not None
+    assert job_ids(msgs) == ['0', '1', '2']
+    assert len(buffer) == 2
+
+
+def test_claim_of_an_empty_buffer(buffer):
+    assert buffer.claim() == (None, [])
+
+
+def test_ack_drops_the_batch(buffer):
+    fill(buffer, 2)
+    token, _ = buffer.claim()
+    buffer.ack(token)
+    assert len(buffer) == 0
+    assert buffer.reclaim() == 0
+
+
+def test_requeue_puts_the_batch_first(buffer):
+    fill(buffer, 5)
+    token, _ = buffer.claim()
+    buffer.requeue(token)
+    assert len(buffer) == 5
+    assert job_ids(buffer.claim()[1]) == ['0', '1', '2']
+
+
+def test_requeue_of_some_results(buffer):
+    fill(buffer, 5)
+    token, msgs = buffer.claim()
+    buffer.requeue(token, [msgs[1]])
+    assert len(buffer) == 3
+    assert job_ids(buffer.claim()[1]) == ['1', '3', '4']
+    assert buffer.reclaim() == 0
+
+
+def test_reclaim_of_expired_claims(buffer):
+    fill(buffer, 2)
+    buffer.claim()
+    assert buffer.reclaim() == 0
+    buffer.claim_timeout = -1
+    assert buffer.reclaim() == 2
+    assert len(buffer) == 2
+    assert job_ids(buffer.claim()[1]) == ['0', '1']
+
+
+@pytest.fixture(params=['redis', 'sqlite'])
+def shared_buffers(request, app, tmp_path):
+    """Return a factory of buffers sharing their results, as the processes of workers do."""
+    name = f'results-{uuid.uuid4().hex}'
+    if request.param == 'redis':
+        app.conf.broker_write_url = request.getfixturevalue('redis_url')
+        return lambda: RedisResultBuffer(name, app, max_size=3)
+    app.conf.ergo_result_buffer_sqlite_path = str(tmp_path / 'results.sqlite3')
+    return lambda: SQLiteResultBuffer(name, app, max_size=3)
+
+
+def test_drain_lease_is_held_by_a_single_buffer(app, shared_buffers):
+    app.conf.ergo_result_buffer_drain_lease_secs = 30
+    first, second = shared_buffers(), shared_buffers()
+    assert first.acquire_drain_lease()
+    assert not second.acquire_drain_lease()
+    assert first.acquire_drain_lease()
+    second.release_drain_lease()
+    assert not second.acquire_drain_lease()
+    first.release_drain_lease()
+    assert second.acquire_drain_lease()
+    assert not first.acquire_drain_lease()
+
+
+def test_drain_lease_expires(app, shared_buffers):
+    app.conf.ergo_result_buffer_drain_lease_secs = 0.2
+    first, second = shared_buffers(), shared_buffers()
+    assert first.acquire_drain_lease()
+    assert not second.acquire_drain_lease()
+    sleep(0.3)
+    assert second.acquire_drain_lease()
+    assert not first.acquire_drain_lease()
+
+
+def test_every_buffer_drains_without_a_lease(shared_buffers):
+    first, second = shared_buffers(), shared_buffers()
+    assert first.acquire_drain_lease()
+    assert second.acquire_drain_lease()
+
+
+def test_sqlite_buffer_requires_a_path(app):
+    with pytest.raises(ValueError):
+        SQLiteResultBuffer('results', app, max_size=3)
+
+
+def test_sqlite_buffer_counts_results_of_an_existing_database(app, tmp_path):
+    app.conf.ergo_result_buffer_sqlite_path = str(tmp_path / 'results.sqlite3')
+    buffer = SQLiteResultBuffer('results', app, max_size=3)
+    fill(buffer, 5)
+    buffer.claim()
+    buffer._conn.execute('DROP TABLE pending')
+    assert len(SQLiteResultBuffer('results', app, max_size=3)) == 2
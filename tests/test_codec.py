@@ -0,0 +1,95 @@
+import copy
+import hashlib
+import importlib.util
+import os
+
+import pytest
+
+from ergo_celery.result.codec import (LocalBlobStore, ResultCodec,
+                                      load_blob_store)
+
+
+def result(job_id='job', size=2000):
+    return {
+        'jobId': job_id,
+        'taskId': 'task',
+        'data': {'values': ['x' * 10] * (size // 10)},
+        'metadata': {'error': {'traceback': 'Traceback ' * (size // 10)}},
+    }
+
+
+@pytest.fixture
+def blob_store(app, tmp_path):
+    app.conf.ergo_result_blob_store_path = str(tmp_path)
+    return LocalBlobStore(app)
+
+
+@pytest.mark.parametrize('compression', [
+    'zlib',
+    pytest.param('zstd', marks=pytest.mark.skipif(
+        importlib.util.find_spec('zstandard') is None, reason='zstandard is not installed')),
+])
+def test_compressed_fields_round_trip(compression):
+    codec = ResultCodec(compress_threshold=100, compression=compression)
+    meta = codec.encode(result())
+    assert meta['encoding'] == {'data': compression, 'traceback': compression}
+    assert isinstance(meta['data'], str)
+    assert len(meta['data']) < 2000
+    assert codec.decode(meta) == result()
+
+
+def test_small_fields_are_left_as_is():
+    codec = ResultCodec(compress_threshold=100)
+    meta = codec.encode(result(size=50))
+    assert 'encoding' not in meta
+    assert meta == result(size=50)
+
+
+def test_decode_follows_the_encoding_of_the_meta():
+    meta = ResultCodec(compress_threshold=100, compression='zlib').encode(result())
+    meta['encoding'] = {'data': 'zlib'}
+    traceback = meta['metadata']['error']['traceback']
+    decoded = ResultCodec(compression='zlib').decode(copy.deepcopy(meta))
+    assert decoded['data'] == result()['data']
+    assert decoded['metadata']['error']['traceback'] == traceback
+
+
+@pytest.mark.skipif(importlib.util.find_spec('zstandard') is None, reason='zstandard is not installed')
+def test_decode_does_not_depend_on_the_compression_of_the_codec():
+    meta = ResultCodec(compress_threshold=100, compression='zstd').encode(result())
+    assert ResultCodec(compression='zlib').decode(meta) == result()
+
+
+def test_offloads_metas_above_the_threshold(blob_store):
+    codec = ResultCodec(offload_threshold=1000, blob_store=blob_store)
+    small = codec.encode(result(size=50))
+    assert 'blob' not in small
+    meta = codec.encode(result())
+    assert set(meta['blob']) == {'data', 'traceback'}
+    assert meta['data'] is None
+    assert meta['metadata']['error']['traceback'] is None
+    assert codec.decode(meta) == result()
+
+
+def test_offloaded_blobs_are_keyed_by_job_and_field(blob_store):
+    codec = ResultCodec(offload_threshold=1000, blob_store=blob_store)
+    refs = codec.encode(result('job-1'))['blob']
+    assert codec.encode(result('job-1'))['blob'] == refs
+    assert codec.encode(result('job-2'))['blob']['data'] != refs['data']
+    key = hashlib.sha256('job-1\0data'.encode()).hexdigest()
+    assert refs['data'] == f'file://{os.path.join(blob_store.root, key)}'
+
+
+def test_local_blob_store_references_files(blob_store, tmp_path):
+    ref = blob_store.put('key', b'payload')
+    assert ref == f'file://{tmp_path / "key"}'
+    assert (tmp_path / 'key').read_bytes() == b'payload'
+    assert blob_store.get(ref) == b'payload'
+    assert os.listdir(tmp_path) == ['key']
+
+
+def test_blob_stores_are_loaded_from_their_path(app, tmp_path):
+    app.conf.ergo_result_blob_store_path = str(tmp_path)
+    blob_store = load_blob_store(app, 'ergo_celery.result.codec:LocalBlobStore')
+    assert isinstance(blob_store, LocalBlobStore)
+    assert blob_store.root == str(tmp_path)
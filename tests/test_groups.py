@@ -0,0 +1,98 @@
+import json
+
+import pytest
+from vine import promise
+
+from conftest import REQUEST_QUEUE
+from ergo_celery.metrics import PrometheusExporter, metrics
+from ergo_celery.request.groups import GroupScheduler
+
+
+def payload(tag):
+    return {'properties': {'delivery_tag': tag}}
+
+
+def tags(ready):
+    return [payload['properties']['delivery_tag'] for payload, _ in ready]
+
+
+def test_groups_are_served_round_robin():
+    scheduler = GroupScheduler(max_in_flight=1)
+    for group, tag in (('a', 'a1'), ('a', 'a2'), ('b', 'b1'), ('b', 'b2')):
+        scheduler.hold(group, payload(tag), 'queue', 30, now=0)
+    assert tags(scheduler.take(now=0)) == ['a1', 'b1']
+    assert len(scheduler) == 2
+    assert tags(scheduler.take(now=0)) == []
+    assert scheduler.release('b1')
+    assert not scheduler.release('b1')
+    assert tags(scheduler.take(now=0)) == ['b2']
+    assert scheduler.release('a1')
+    assert tags(scheduler.take(now=0)) == ['a2']
+    assert len(scheduler) == 0
+
+
+def test_expired_messages_are_dropped(app, monkeypatch):
+    exporter = PrometheusExporter(app)
+    monkeypatch.setattr(metrics, 'exporter', exporter)
+    scheduler = GroupScheduler(max_in_flight=1)
+    scheduler.hold('a', payload('a1'), 'queue', 30, now=0)
+    scheduler.hold('a', payload('a2'), 'queue', 30, now=20)
+    assert tags(scheduler.take(now=40)) == ['a2']
+    assert len(scheduler) == 0
+    assert 'ergo_held_messages_expired_total 1' in exporter.render()
+
+
+def test_clear_drops_held_messages():
+    scheduler = GroupScheduler(max_in_flight=2)
+    for tag in ('a1', 'a2', 'a3'):
+        scheduler.hold('a', payload(tag), 'queue', 30, now=0)
+    assert tags(scheduler.take(now=0)) == ['a1', 'a2']
+    assert scheduler.clear() == 1
+    assert len(scheduler) == 0
+
+
+@pytest.fixture
+def transport_options(transport_options):
+    return dict(transport_options, max_in_flight_per_group=1, held_poll_interval_secs=0.5)
+
+
+class StubHub(object):
+    def __init__(self) -> None:
+        self.later = []
+
+    def call_later(self, delay, callback, *args):
+        self.later.append((delay, callback, args))
+
+    def call_soon(self, callback, *args):
+        callback(*args)
+
+
+def receive(channel, fake_sqs, groups):
+    url = channel.receive_profile(REQUEST_QUEUE).url
+    for idx, group in enumerate(groups):
+        fake_sqs.send(url, json.dumps({'idx': idx}), group_id=group, deduplication_id=str(idx))
+    channel._on_messages_ready(url, REQUEST_QUEUE, {'Messages': fake_sqs.receive(url, len(groups))})
+
+
+def test_channel_holds_messages_of_busy_groups(channel, fake_sqs):
+    delivered = []
+    channel.basic_qos(0, 3, False)
+    channel.basic_consume(REQUEST_QUEUE, False, delivered.append, 'consumer')
+    receive(channel, fake_sqs, ['a', 'a', 'b'])
+    assert [message.payload['kwargs']['idx'] for message in delivered] == [0, 2]
+    assert len(channel.group_scheduler) == 1
+    delivered[0].ack()
+    channel._deliver_held()
+    assert [message.payload['kwargs']['idx'] for message in delivered] == [0, 2, 1]
+
+
+def test_channel_waits_while_held_messages_use_the_prefetch_budget(channel, fake_sqs):
+    channel.basic_qos(0, 3, False)
+    channel.basic_consume(REQUEST_QUEUE, False, lambda message: None, 'consumer')
+    receive(channel, fake_sqs, ['a', 'a', 'b'])
+    channel.hub = hub = StubHub()
+    receives = fake_sqs.calls['ReceiveMessage']
+    callback = promise()
+    channel._get_bulk_async(REQUEST_QUEUE, callback=callback)
+    assert fake_sqs.calls['ReceiveMessage'] == receives
+    assert hub.later == [(0.5, callback, ([],))]
@@ -0,0 +1,83 @@
+import socket
+from types import SimpleNamespace
+from urllib.request import urlopen
+
+import pytest
+from celery.concurrency.prefork import TaskPool as PreforkPool
+from celery.concurrency.thread import TaskPool as ThreadPool
+
+from conftest import REQUEST_QUEUE
+from ergo_celery import metrics as metrics_module
+from ergo_celery.metrics import MetricsStep, PrometheusExporter, metrics
+
+
+class StubTimer(object):
+    def call_repeatedly(self, secs, fun, args=()):
+        return SimpleNamespace(fun=fun, cancel=lambda: None)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('', 0))
+        return sock.getsockname()[1]
+
+
+def test_render(app):
+    exporter = PrometheusExporter(app, buckets=(1, 5))
+    exporter.incr('published_total', 3, {'queue': 'results'})
+    exporter.observe('drain_seconds', 2, {})
+    assert exporter.render().splitlines() == [
+        '# TYPE published_total counter',
+        'published_total{queue="results"} 3',
+        '# TYPE drain_seconds histogram',
+        'drain_seconds_bucket{le="1"} 0',
+        'drain_seconds_bucket{le="5"} 1',
+        'drain_seconds_bucket{le="+Inf"} 1',
+        'drain_seconds_sum 2.0',
+        'drain_seconds_count 1',
+    ]
+
+
+def test_pool_processes_serve_their_own_metrics(app, monkeypatch):
+    app.conf.ergo_metrics_prometheus_port = port = free_port()
+    exporter = PrometheusExporter(app)
+    exporter.start()
+    exporter.incr('received_total', 1, {})
+    monkeypatch.setattr(metrics_module, 'current_process_index', lambda: 1)
+    try:
+        exporter._on_process_init()
+        exporter.incr('published_total', 1, {})
+        assert exporter.port == port + 1
+        body = urlopen(f'http://localhost:{port + 1}/').read().decode()
+    finally:
+        exporter.stop()
+    assert 'published_total 1' in body
+    assert 'received_total' not in body
+
+
+@pytest.mark.parametrize('pool_cls, buffer_shared, sampled', [
+    (PreforkPool, False, False),
+    (PreforkPool, True, True),
+    (ThreadPool, False, True),
+])
+def test_buffer_depth_is_sampled_when_seen(app, pool_cls, buffer_shared, sampled):
+    app.conf.ergo_metrics_exporter = 'ergo_celery.metrics:StatsdExporter'
+    worker = SimpleNamespace(
+        app=SimpleNamespace(conf=app.conf, backend=SimpleNamespace(buffer_shared=buffer_shared)),
+        pool_cls=pool_cls,
+        timer=StubTimer(),
+    )
+    step = MetricsStep(worker)
+    try:
+        step.start(worker)
+        assert (step.tref is not None) == sampled
+    finally:
+        step.stop(worker)
+        metrics.configure(None)
+
+
+def test_failed_receives_are_recorded_as_empty(app, channel, monkeypatch):
+    exporter = PrometheusExporter(app)
+    monkeypatch.setattr(metrics, 'exporter', exporter)
+    channel._on_messages_ready(channel.receive_profile(REQUEST_QUEUE).url, REQUEST_QUEUE, [])
+    assert f'ergo_empty_receives_total{{queue="{REQUEST_QUEUE}"}} 1' in exporter.render()
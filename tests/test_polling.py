@@ -0,0 +1,62 @@
+import pytest
+
+from ergo_celery.request.polling import AdaptivePoller
+
+
+@pytest.fixture
+def poller():
+    return AdaptivePoller(decay=0.5, batch_window=1.0, busy_wait_time=1, idle_backoff=0.5, max_idle_interval=4)
+
+
+def test_rate_is_an_exponentially_weighted_average(poller):
+    poller.record('queue', 4, now=0)
+    assert poller.activity('queue').rate == 4
+    poller.record('queue', 10, now=1)
+    assert poller.activity('queue').rate == 7
+    poller.record('queue', 0, now=2)
+    assert poller.activity('queue').rate == 3.5
+    assert poller.activity('queue').empty_ratio == 0.5
+
+
+def test_batches_are_sized_to_the_rate(poller):
+    assert poller.max_messages('queue', 10) == 10
+    poller.record('queue', 3, now=0)
+    assert poller.max_messages('queue', 10) == 3
+    poller.record('queue', 40, now=1)
+    assert poller.max_messages('queue', 10) == 10
+    for now in range(2, 12):
+        poller.record('queue', 0, now=now)
+    assert poller.max_messages('queue', 10) == 1
+
+
+def test_idle_queues_back_off(poller):
+    poller.record('queue', 0, now=0)
+    assert poller.poll_delay('queue', now=0) == 0.5
+    poller.record('queue', 0, now=1)
+    assert poller.poll_delay('queue', now=1) == 1
+    for now in range(2, 10):
+        poller.record('queue', 0, now=now)
+    assert poller.poll_delay('queue', now=9) == 4
+    assert poller.poll_delay('queue', now=20) == 0
+    poller.record('queue', 1, now=20)
+    assert poller.poll_delay('queue', now=20) == 0
+
+
+def test_emptier_queues_wait_longer(poller):
+    poller.record('queue', 1, now=0)
+    assert poller.wait_time_seconds('queue', 4) == 4
+    poller.record('queue', 0, now=1)
+    assert poller.wait_time_seconds('queue', 4) == 12
+    poller.record('queue', 0, now=2)
+    assert poller.wait_time_seconds('queue', 4) == 16
+
+
+def test_shared_polling_favours_busy_queues(poller):
+    poller.record('busy', 5, now=0)
+    poller.record('busy', 5, now=1)
+    poller.record('other', 5, now=0)
+    poller.record('other', 5, now=1)
+    poller.record('idle', 0, now=1)
+    assert poller.wait_time_seconds('busy', 10, shared=True) == 1
+    assert poller.wait_time_seconds('busy', 10) == 10
+    assert poller.wait_time_seconds('idle', 10, shared=True) == 0
@@ -0,0 +1,111 @@
+from types import SimpleNamespace
+
+from conftest import RESULT_QUEUE
+from ergo_celery.result.publisher import ResultPublisher
+
+
+class StubChannel(object):
+    def __init__(self, sender_faults=(), server_faults=()) -> None:
+        self.sender_faults = set(sender_faults)
+        # Entry ID => number of attempts failing with an internal error
+        self.server_faults = dict(server_faults)
+        self.batches = []
+
+    def result_entry(self, entry_id, msg, group_id=None):
+        return {'Id': entry_id, 'MessageBody': msg['body'], 'MessageGroupId': group_id}
+
+    def put_bulk(self, queue, entries):
+        self.batches.append([entry['Id'] for entry in entries])
+        successful, failed = [], []
+        for entry in entries:
+            if entry['Id'] in self.sender_faults:
+                failed.append({'Id': entry['Id'], 'SenderFault': True, 'Code': 'InvalidParameterValue'})
+            elif self.server_faults.get(entry['Id']):
+                self.server_faults[entry['Id']] -= 1
+                failed.append({'Id': entry['Id'], 'SenderFault': False, 'Code': 'InternalError', 'Message': 'Try again'})
+            else:
+                successful.append({'Id': entry['Id']})
+        return successful, failed
+
+
+def make_publisher(channel):
+    return ResultPublisher(
+        SimpleNamespace(default_channel=channel), 'results', max_workers=1, retry_backoff=0, max_batch_bytes=100)
+
+
+def message(job_id, size=10):
+    return {'jobId': job_id, 'taskId': 'task', 'body': 'x' * size}
+
+
+def test_oversized_results_are_rejected():
+    channel = StubChannel()
+    sent, failed, rejected = make_publisher(channel).publish([message('0'), message('1', size=200)])
+    assert [msg['jobId'] for msg in sent] == ['0']
+    assert failed == []
+    assert [msg['jobId'] for msg, _ in rejected] == ['1']
+
+
+def test_sender_faults_are_rejected_without_retrying():
+    channel = StubChannel(sender_faults={'1'})
+    sent, failed, rejected = make_publisher(channel).publish([message('0'), message('1')])
+    assert [msg['jobId'] for msg in sent] == ['0']
+    assert failed == []
+    assert rejected == [(message('1'), 'InvalidParameterValue')]
+    assert len(channel.batches) == 1
+
+
+def test_only_failed_entries_are_retried():
+    channel = StubChannel(server_faults={'1': 1})
+    sent, failed, rejected = make_publisher(channel).publish([message('0'), message('1'), message('2')])
+    assert [msg['jobId'] for msg in sent] == ['0', '2', '1']
+    assert (failed, rejected) == ([], [])
+    assert channel.batches == [['0', '1', '2'], ['1']]
+
+
+def test_entries_failing_every_attempt_are_returned_with_their_error():
+    channel = StubChannel(server_faults={'1': 3})
+    sent, failed, rejected = make_publisher(channel).publish([message('0'), message('1')])
+    assert [msg['jobId'] for msg in sent] == ['0']
+    assert failed == [(message('1'), 'Try again')]
+    assert rejected == []
+    assert channel.batches == [['0', '1'], ['1'], ['1']]
+
+
+def large_results(count, size=30000):
+    return [{'jobId': str(idx), 'taskId': 'task', 'data': 'x' * size} for idx in range(count)]
+
+
+def test_batches_fit_the_limits_of_sqs(connection, fake_sqs):
+    publisher = ResultPublisher(connection, RESULT_QUEUE, max_workers=2)
+    sent, failed, rejected = publisher.publish(large_results(25))
+    publisher.close()
+    assert (len(sent), failed, rejected) == (25, [], [])
+    assert fake_sqs.size(connection.default_channel.receive_profile(RESULT_QUEUE).url) == 25
+    assert fake_sqs.calls['SendMessageBatch'] == 4
+
+
+def test_batches_beyond_the_limits_of_sqs_fail(connection, fake_sqs):
+    publisher = ResultPublisher(connection, RESULT_QUEUE, max_workers=1, retry_backoff=0, max_batch_bytes=10 ** 6)
+    sent, failed, rejected = publisher.publish(large_results(10))
+    assert sent == []
+    assert len(failed) == 10
+    assert 'BatchRequestTooLong' in failed[0][1]
+
+
+def test_result_entries_are_deduplicated_by_job_and_content(channel):
+    def dedup_id(entry_id, job_id, data):
+        return channel.result_entry(entry_id, {'jobId': job_id, 'taskId': 'task', 'data': data})['MessageDeduplicationId']
+
+    assert dedup_id('0', 'job', 1) == dedup_id('1', 'job', 1)
+    assert dedup_id('0', 'job', 1) != dedup_id('0', 'job', 2)
+    assert dedup_id('0', 'job', 1) != dedup_id('0', 'other', 1)
+    assert channel.result_entry('0', {'jobId': 'job', 'taskId': 'task'})['MessageGroupId'] == 'task'
+
+
+def test_republished_results_are_dropped_by_fifo_queues(connection, fake_sqs):
+    publisher = ResultPublisher(connection, RESULT_QUEUE, max_workers=1)
+    for _ in range(2):
+        sent, failed, rejected = publisher.publish([{'jobId': 'job', 'taskId': 'task', 'data': 1}])
+        assert (len(sent), failed, rejected) == (1, [], [])
+    publisher.close()
+    assert fake_sqs.size(connection.default_channel.receive_profile(RESULT_QUEUE).url) == 1
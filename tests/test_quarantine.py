@@ -0,0 +1,79 @@
+import json
+
+import pytest
+from kombu import Connection
+
+pytest.importorskip('boto3')
+
+from benchmarks.fake_sqs import FakeSQSTransport
+from conftest import REQUEST_QUEUE, RESULT_QUEUE
+from ergo_celery.metrics import PrometheusExporter, metrics
+
+UNDECODABLE = '{"x": '
+
+
+@pytest.fixture
+def exporter(app, monkeypatch):
+    exporter = PrometheusExporter(app)
+    monkeypatch.setattr(metrics, 'exporter', exporter)
+    return exporter
+
+
+@pytest.fixture
+def quarantine_options(transport_options):
+    transport_options.update(quarantine_max_receives=2, batch_acks=False)
+    return transport_options
+
+
+def decode_until_quarantined(fake_sqs, options):
+    with Connection('fakesqs://', transport=FakeSQSTransport, transport_options=options) as conn:
+        channel = conn.default_channel
+        url = channel.receive_profile(REQUEST_QUEUE).url
+        fake_sqs.send(url, UNDECODABLE, group_id='tests.add')
+        for _ in range(2):
+            messages = fake_sqs.receive(url, 1, visibility_timeout=0)
+            assert channel._decode_messages(messages, REQUEST_QUEUE, url) == []
+        return messages[0], fake_sqs.size(url)
+
+
+def test_undecodable_messages_are_quarantined_to_a_file(fake_sqs, quarantine_options, exporter, tmp_path):
+    quarantine_options['quarantine_path'] = path = str(tmp_path / 'quarantine.jsonl')
+    message, remaining = decode_until_quarantined(fake_sqs, quarantine_options)
+    assert remaining == 0
+    with open(path) as fp:
+        entries = [json.loads(line) for line in fp]
+    assert len(entries) == 1
+    assert entries[0]['messageId'] == message['MessageId']
+    assert (entries[0]['group'], entries[0]['queue'], entries[0]['receiveCount']) == ('tests.add', REQUEST_QUEUE, 2)
+    assert entries[0]['body'] == UNDECODABLE
+    assert entries[0]['error'].startswith('JSONDecodeError: ')
+    rendered = exporter.render()
+    assert f'ergo_decode_errors_total{{kind="JSONDecodeError",queue="{REQUEST_QUEUE}"}} 2' in rendered
+    assert 'ergo_messages_quarantined_total 1' in rendered
+
+
+def test_undecodable_messages_are_quarantined_to_a_queue(fake_sqs, quarantine_options, exporter):
+    quarantine_options['quarantine_queue'] = RESULT_QUEUE
+    message, remaining = decode_until_quarantined(fake_sqs, quarantine_options)
+    assert remaining == 0
+    quarantined = fake_sqs.queues[RESULT_QUEUE].messages
+    assert [(entry['Body'], entry['GroupId']) for entry in quarantined] == [(UNDECODABLE, 'tests.add')]
+    assert 'ergo_messages_quarantined_total 1' in exporter.render()
+
+
+def test_messages_stay_queued_when_the_sink_fails(fake_sqs, quarantine_options, exporter, tmp_path):
+    quarantine_options['quarantine_path'] = str(tmp_path / 'missing' / 'quarantine.jsonl')
+    _, remaining = decode_until_quarantined(fake_sqs, quarantine_options)
+    assert remaining == 1
+    assert 'ergo_quarantine_failures_total 1' in exporter.render()
+
+
+def test_messages_are_not_quarantined_before_max_receives(fake_sqs, transport_options, tmp_path):
+    transport_options['quarantine_path'] = path = tmp_path / 'quarantine.jsonl'
+    with Connection('fakesqs://', transport=FakeSQSTransport, transport_options=transport_options) as conn:
+        channel = conn.default_channel
+        url = channel.receive_profile(REQUEST_QUEUE).url
+        fake_sqs.send(url, UNDECODABLE, group_id='tests.add')
+        assert channel._decode_messages(fake_sqs.receive(url, 1), REQUEST_QUEUE, url) == []
+    assert fake_sqs.size(url) == 1
+    assert not path.exists()
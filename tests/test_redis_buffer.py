@@ -0,0 +1,45 @@
+import threading
+import uuid
+
+from ergo_celery.result.redis.buffer import RedisResultBuffer
+
+
+def test_concurrent_puts_wait_for_a_connection(app, redis_url):
+    app.conf.broker_write_url = redis_url
+    app.conf.ergo_result_buffer_max_connections = 2
+    buffer = RedisResultBuffer(f'results-{uuid.uuid4().hex}', app, max_size=10)
+    errors = []
+
+    def put_many(thread):
+        for idx in range(50):
+            try:
+                buffer.put({'jobId': f'{thread}-{idx}'})
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=put_many, args=(thread,)) for thread in range(32)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert len(buffer) == 32 * 50
+
+
+def test_threads_share_the_lease_owner_of_their_process(app, redis_url):
+    app.conf.broker_write_url = redis_url
+    app.conf.ergo_result_buffer_drain_lease_secs = 30
+    buffer = RedisResultBuffer(f'results-{uuid.uuid4().hex}', app, max_size=10)
+    barrier = threading.Barrier(16)
+    acquired = []
+
+    def acquire():
+        barrier.wait()
+        acquired.append(buffer.acquire_drain_lease())
+
+    threads = [threading.Thread(target=acquire) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert acquired == [True] * 16
@@ -0,0 +1,59 @@
+from time import monotonic, time
+
+import pytest
+from celery.contrib.testing.mocks import TaskMessage
+from celery.worker import state
+
+from ergo_celery.request.heartbeat import EXTEND, RELEASE
+from ergo_celery.request.request import SQSRequest
+
+
+@pytest.fixture
+def accept(app):
+    """Return a factory of requests accepted by the pool ``running_for`` seconds ago."""
+    app.conf.broker_transport_options = {'visibility_timeout': 1800}
+
+    @app.task(name='tests.add', shared=False, acks_late=True)
+    def add():
+        pass
+
+    accepted = []
+
+    def accept(running_for=10):
+        req = SQSRequest(TaskMessage('tests.add'), app=app)
+        req.on_accepted(pid=1, time_accepted=monotonic() - running_for)
+        accepted.append(req)
+        return req
+
+    yield accept
+    for req in accepted:
+        state.task_ready(req)
+
+
+def test_policy_extension_is_due_once_the_task_ran_long_enough(accept):
+    assert accept(running_for=10).visibility_timeout_due() is None
+    req = accept(running_for=1300)
+    assert req.visibility_timeout_due() == 3600
+    assert req.visibility_timeout_due() is None
+
+
+def test_explicit_extension_is_renewed_before_it_expires(accept):
+    req = accept()
+    assert req.on_heartbeat({'visibility': (EXTEND, 60, time())}) == 60
+    assert req.next_ping_at() < time() + 60
+
+
+def test_policy_extends_relative_to_the_explicit_extension(accept):
+    req = accept()
+    req.on_heartbeat({'visibility': (EXTEND, 0, time())})
+    new_timeout = req.visibility_timeout_due()
+    assert new_timeout == 3600
+    assert time() < req.next_ping_at() <= time() + new_timeout
+
+
+def test_released_message_is_no_longer_extended(accept):
+    req = accept()
+    assert req.on_heartbeat({'progress': 0.5, 'visibility': (RELEASE, 5, time())}) == 5
+    assert req.progress == 0.5
+    assert req.next_ping_at() is None
+    assert req.on_heartbeat({'visibility': (EXTEND, 60, time())}) is None
@@ -0,0 +1,86 @@
+import json
+
+import pytest
+from celery.app.task import Context
+
+pytest.importorskip('boto3')
+
+from benchmarks.fake_sqs import BASE_URL
+from conftest import RESULT_QUEUE
+
+
+@pytest.fixture
+def backend_app(app, fake_sqs, transport_options):
+    app.conf.update(
+        broker_transport_options=transport_options,
+        result_backend=f'benchmarks.fake_sqs:FakeSQSBackend://{BASE_URL}/{RESULT_QUEUE}',
+        ergo_result_buffer_size=3,
+        ergo_result_flusher_enabled=False,
+        ergo_result_publish_max_attempts=1,
+    )
+    yield app
+    app.backend.stop_flusher()
+
+
+@pytest.fixture
+def backend(backend_app):
+    return backend_app.backend
+
+
+def store(backend, job_id, value=1):
+    backend.store_result(job_id, {'value': value}, 'SUCCESS', request=Context(task='task'))
+
+
+def published(fake_sqs):
+    return [json.loads(message['Body'])['jobId'] for message in fake_sqs.queues[RESULT_QUEUE].messages]
+
+
+def test_results_are_pushed_in_batches(backend, fake_sqs):
+    for idx in range(7):
+        store(backend, str(idx))
+    assert backend.buffer_depth() == 7
+    backend.drain_results()
+    assert published(fake_sqs) == [str(idx) for idx in range(7)]
+    assert fake_sqs.calls['SendMessageBatch'] == 3
+    assert backend.buffer_depth() == 0
+
+
+def test_rejected_results_are_dropped(backend, fake_sqs):
+    for idx in range(7):
+        # Results above the 256 KiB limit of SQS can never be pushed
+        store(backend, str(idx), 'x' * 300 * 1024 if idx == 0 else 1)
+    backend.drain_results()
+    assert published(fake_sqs) == [str(idx) for idx in range(1, 7)]
+    assert backend.buffer_depth() == 0
+
+
+def test_failed_results_are_requeued(backend, fake_sqs):
+    for idx in range(5):
+        store(backend, str(idx))
+    fake_sqs.failure_rate = 1
+    backend.drain_results()
+    assert published(fake_sqs) == []
+    assert backend.buffer_depth() == 5
+    fake_sqs.failure_rate = 0
+    backend.drain_results()
+    assert published(fake_sqs) == [str(idx) for idx in range(5)]
+
+
+def test_results_stored_after_stop_are_pushed(backend_app, fake_sqs):
+    backend_app.conf.ergo_result_flusher_enabled = True
+    backend = backend_app.backend
+    backend.stop_flusher()
+    store(backend, 'job')
+    assert published(fake_sqs) == ['job']
+    assert backend.buffer_depth() == 0
+
+
+def test_buffer_class_is_loaded_from_its_path(backend_app, tmp_path):
+    backend_app.conf.ergo_result_buffer_cls = 'ergo_celery.result.sqlite.buffer:SQLiteResultBuffer'
+    backend_app.conf.ergo_result_buffer_sqlite_path = str(tmp_path / 'results.sqlite3')
+    assert backend_app.backend.buffer_shared
+
+
+def test_missing_buffer_class_falls_back_to_memory(backend_app):
+    backend_app.conf.ergo_result_buffer_cls = 'ergo_celery.result.missing:ResultBuffer'
+    assert not backend_app.backend.buffer_shared
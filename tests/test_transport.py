@@ -0,0 +1,102 @@
+import base64
+import json
+
+import kombu.message
+import pytest
+from kombu import Connection
+
+pytest.importorskip('boto3')
+
+from benchmarks.fake_sqs import BASE_URL, FakeSQSTransport
+from conftest import REQUEST_QUEUE, RESULT_QUEUE
+from ergo_celery.request import transport
+from ergo_celery.request.transport import ErgoChannel
+
+
+@pytest.fixture
+def predefined_clients(monkeypatch):
+    monkeypatch.setattr(ErgoChannel, '_predefined_queue_clients', {})
+    monkeypatch.setattr(ErgoChannel, '_predefined_queue_async_clients', {})
+    monkeypatch.setattr(transport, '_predefined_clients_pid', None)
+    return ErgoChannel._predefined_queue_clients
+
+
+def test_new_channels_keep_the_predefined_clients(connection, predefined_clients):
+    # The channels of the stand-in hand out fake clients, the boto3 ones come from ErgoChannel
+    ErgoChannel.sqs(connection.channel())
+    predefined_clients['queue'] = client = object()
+    ErgoChannel.sqs(connection.channel())
+    assert predefined_clients == {'queue': client}
+
+
+def test_clients_are_rebuilt_after_fork(channel, predefined_clients, monkeypatch):
+    client = ErgoChannel.sqs(channel)
+    predefined_clients['queue'] = object()
+    assert ErgoChannel.sqs(channel) is client
+    monkeypatch.setattr(transport.os, 'getpid', lambda: -1)
+    assert ErgoChannel.sqs(channel) is not client
+    assert predefined_clients == {}
+
+
+def test_failed_receives_count_as_empty(channel):
+    # kombu's asynchronous connection answers timeouts and 5XX errors with an empty list
+    channel._on_messages_ready(channel.receive_profile(REQUEST_QUEUE).url, REQUEST_QUEUE, [])
+    assert channel.poller.activity(REQUEST_QUEUE).consecutive_empty == 1
+
+
+def receive(fake_sqs, channel, *bodies):
+    url = channel.receive_profile(REQUEST_QUEUE).url
+    for body in bodies:
+        fake_sqs.send(url, body, group_id='tests.add')
+    return url, fake_sqs.receive(url, len(bodies))
+
+
+@pytest.fixture
+def json_loads(monkeypatch):
+    calls = []
+
+    def loads(body):
+        calls.append(body)
+        return json.loads(body)
+
+    monkeypatch.setattr(transport, 'json_loads', loads)
+    return calls
+
+
+def test_ergo_messages_are_decoded_once(fake_sqs, channel, json_loads, monkeypatch):
+    url, messages = receive(fake_sqs, channel, '{"x": 1}', '{"x": 2}')
+    payloads = channel._decode_messages(messages, REQUEST_QUEUE, url)
+    assert json_loads == ['{"x": 1}', '{"x": 2}']
+    monkeypatch.setattr(kombu.message, 'loads', None)  # decoding the body again would fail
+    message = channel.Message(payloads[0], channel=channel)
+    assert message.decode() == {'task': 'tests.add', 'id': messages[0]['MessageId'], 'kwargs': {'x': 1}}
+    assert message.body == b'{"x": 1}'
+    assert message.delivery_tag == messages[0]['ReceiptHandle']
+
+
+def test_base64_ergo_messages_are_decoded(fake_sqs, channel, json_loads):
+    url, messages = receive(fake_sqs, channel, base64.b64encode(b'{"x": 1}').decode(), '')
+    payloads = channel._decode_messages(messages, REQUEST_QUEUE, url)
+    assert [channel.Message(payload, channel=channel).decode()['kwargs'] for payload in payloads] == [{'x': 1}, {}]
+    assert json_loads == ['{"x": 1}', '{}']
+
+
+def test_receive_profiles_follow_the_queue_options(transport_options):
+    transport_options['predefined_queues'][REQUEST_QUEUE].update(
+        wait_time_seconds=3, visibility_timeout=60, max_messages=20)
+    transport_options['wait_time_seconds'] = 7
+    with Connection('fakesqs://', transport=FakeSQSTransport, transport_options=transport_options) as conn:
+        channel = conn.default_channel
+        request_profile = channel.receive_profile(REQUEST_QUEUE)
+        result_profile = channel.receive_profile(RESULT_QUEUE)
+    assert request_profile == (
+        f'{BASE_URL}/{REQUEST_QUEUE}', ('ApproximateReceiveCount', 'SentTimestamp', 'MessageGroupId'), 3, 60, 10)
+    assert result_profile.wait_time_seconds == 7
+    assert result_profile.visibility_timeout == channel.visibility_timeout
+
+
+def test_receive_profiles_are_built_once(channel, monkeypatch):
+    profile = channel.receive_profile(REQUEST_QUEUE)
+    monkeypatch.setattr(channel, '_new_queue', None)
+    assert channel.receive_profile(REQUEST_QUEUE) is profile
+    assert channel.receive_profile(channel.canonical_queue_name(REQUEST_QUEUE)) is profile
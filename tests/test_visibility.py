@@ -0,0 +1,96 @@
+import pytest
+
+from ergo_celery.request.visibility import (MAX_VISIBILITY_TIMEOUT,
+                                            ExponentialVisibilityPolicy,
+                                            LinearVisibilityPolicy,
+                                            VisibilityScheduler,
+                                            get_visibility_policy)
+
+
+class Running(object):
+    """Request of a running task, next extended at ``deadline``."""
+
+    def __init__(self, deadline) -> None:
+        self.deadline = deadline
+
+    def next_ping_at(self):
+        return self.deadline
+
+
+def test_linear_policy():
+    policy = LinearVisibilityPolicy(100, factor=0.5)
+    assert [policy.visibility_timeout(attempt) for attempt in (1, 2, 3)] == [100, 200, 300]
+    assert [policy.deadline(1000, attempt) for attempt in (1, 2, 3)] == [1050, 1100, 1150]
+
+
+def test_exponential_policy():
+    policy = ExponentialVisibilityPolicy(100, factor=0.5, base=3)
+    assert [policy.visibility_timeout(attempt) for attempt in (1, 2, 3)] == [100, 300, 900]
+    assert [policy.deadline(1000, attempt) for attempt in (1, 2, 3)] == [1050, 1150, 1450]
+
+
+def test_visibility_timeouts_are_capped_by_sqs():
+    policy = ExponentialVisibilityPolicy(3600)
+    assert policy.visibility_timeout(5) == MAX_VISIBILITY_TIMEOUT
+    assert policy.deadline(0, 5) == pytest.approx(0.69 * 3600 * 16)
+
+
+def test_policies_are_set_by_name_or_path(app):
+    assert type(get_visibility_policy(app, 100)) is LinearVisibilityPolicy
+    app.conf.ergo_visibility_policy = 'exponential'
+    app.conf.ergo_visibility_extension_factor = 0.5
+    policy = get_visibility_policy(app, 100)
+    assert type(policy) is ExponentialVisibilityPolicy
+    assert (policy.init_timeout, policy.factor) == (100, 0.5)
+    app.conf.ergo_visibility_policy = 'ergo_celery.request.visibility:LinearVisibilityPolicy'
+    assert type(get_visibility_policy(app, 100)) is LinearVisibilityPolicy
+
+
+def test_requests_are_due_in_deadline_order():
+    scheduler = VisibilityScheduler()
+    requests = [Running(deadline) for deadline in (30, 10, 20, 10)]
+    for req in requests:
+        scheduler.add(req)
+    assert scheduler.next_deadline() == 10
+    assert scheduler.pop_due(5) == []
+    assert scheduler.pop_due(20) == [requests[1], requests[3], requests[2]]
+    assert scheduler.next_deadline() == 30
+    assert len(scheduler) == 1
+
+
+def test_requests_without_deadline_are_not_scheduled():
+    scheduler = VisibilityScheduler()
+    scheduler.add(Running(None))
+    assert len(scheduler) == 0
+    assert scheduler.next_deadline() is None
+
+
+def test_discarded_and_rescheduled_requests_are_skipped():
+    scheduler = VisibilityScheduler()
+    first, second, third = Running(10), Running(20), Running(30)
+    for req in (first, second, third):
+        scheduler.add(req)
+    scheduler.discard(first)
+    second.deadline = 40
+    scheduler.add(second)
+    assert len(scheduler) == 2
+    assert scheduler.next_deadline() == 30
+    assert scheduler.pop_due(35) == [third]
+    assert scheduler.pop_due(50) == [second]
+    assert scheduler.next_deadline() is None
+
+
+def test_finished_requests_are_dropped_once_they_fill_the_heap():
+    scheduler = VisibilityScheduler()
+    requests = [Running(deadline) for deadline in range(100)]
+    for req in requests:
+        scheduler.add(req)
+    scheduler.retain(set(requests))
+    assert len(scheduler) == 100
+    scheduler.retain(set(requests[:10]))
+    assert len(scheduler) == 10
+    assert scheduler.pop_due(100) == requests[:10]
+
+
+def test_schedulers_are_shared_per_app(app):
+    assert VisibilityScheduler.for_app(app) is VisibilityScheduler.for_app(app)
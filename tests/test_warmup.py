@@ -0,0 +1,70 @@
+from types import SimpleNamespace
+
+import pytest
+from celery import signals
+from kombu.transport import TRANSPORT_ALIASES
+
+pytest.importorskip('boto3')
+
+from benchmarks.fake_sqs import BASE_URL, FakeSQSChannel, FakeSQSClient
+from conftest import REQUEST_QUEUE, RESULT_QUEUE
+from ergo_celery.warmup import WarmupStep, warm_up_broker
+
+
+@pytest.fixture
+def warmed_up(app, fake_sqs, transport_options, monkeypatch):
+    """Return the queues whose SQS client was created, in order."""
+    monkeypatch.setitem(TRANSPORT_ALIASES, 'fakesqs', 'benchmarks.fake_sqs:FakeSQSTransport')
+    app.conf.update(
+        broker_read_url='fakesqs://',
+        broker_transport_options=transport_options,
+        result_backend=f'benchmarks.fake_sqs:FakeSQSBackend://{BASE_URL}/{RESULT_QUEUE}',
+        task_default_queue=REQUEST_QUEUE,
+    )
+    queues = []
+
+    def sqs(channel, queue=None):
+        queues.append(queue)
+        return FakeSQSClient(fake_sqs)
+
+    monkeypatch.setattr(FakeSQSChannel, 'sqs', sqs)
+    return queues
+
+
+@pytest.fixture
+def step(app):
+    step = WarmupStep(SimpleNamespace(app=app))
+    yield step
+    signals.worker_process_init.disconnect(step._on_process_init)
+
+
+def test_broker_and_backend_are_warmed_up_before_the_pool_starts(app, warmed_up, step):
+    step.create(SimpleNamespace(app=app))
+    # Every predefined queue by the broker, then the result queue by the backend
+    assert sorted(warmed_up[:2]) == sorted([REQUEST_QUEUE, RESULT_QUEUE])
+    assert warmed_up[2:] == [RESULT_QUEUE]
+
+
+def test_pool_processes_warm_up_the_backend(app, warmed_up, step):
+    step.create(SimpleNamespace(app=app))
+    del warmed_up[:]
+    signals.worker_process_init.send(sender=None)
+    assert warmed_up == [RESULT_QUEUE]
+
+
+def test_only_sqs_brokers_are_warmed_up(app):
+    app.conf.broker_read_url = 'memory://'
+    assert warm_up_broker(app, [REQUEST_QUEUE]) == 0
+
+
+def test_warmup_failures_do_not_stop_the_worker(app, warmed_up, step, monkeypatch):
+    def failing_sqs(channel, queue=None):
+        raise RuntimeError('Unreachable')
+
+    monkeypatch.setattr(FakeSQSChannel, 'sqs', failing_sqs)
+    step.create(SimpleNamespace(app=app))
+
+
+def test_warmup_can_be_disabled(app):
+    app.conf.ergo_warmup_enabled = False
+    assert not WarmupStep(SimpleNamespace(app=app)).enabled